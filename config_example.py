@@ -10,6 +10,30 @@ s3_config = {
     "aws_secret_access_key": os.getenv("S3_SECRET_KEY", '<YOUR_SECRET_KEY>'),
     "region_name": os.getenv("S3_REGION", 'ru-msk')
 }
+# Сколько передач файлов в S3 может идти одновременно, остальные ждут своей очереди
+S3_MAX_WORKERS = 8
+# Размер пула соединений с S3, должен быть не меньше S3_MAX_WORKERS
+S3_MAX_POOL_CONNECTIONS = 10
+# Время жизни ссылок на скачивание из S3, в секундах. Ссылки кэшируются и перестают выдаваться
+# за PRESIGNED_URL_MARGIN секунд до истечения
+PRESIGNED_URL_EXPIRES = 3600
+PRESIGNED_URL_MARGIN = 300
+# Как отдавать картинки: "redirect" - перенаправлением на подписанную ссылку S3, "proxy" - самим приложением.
+# В режиме proxy файлы читаются из S3 кусками по S3_CHUNK_SIZE байт и кэшируются на диске в каталоге IMAGE_CACHE_DIR,
+# занимая не больше IMAGE_CACHE_SIZE байт
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "redirect")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "/tmp/moments_images")
+IMAGE_CACHE_SIZE = 1024 ** 3
+S3_CHUNK_SIZE = 256 * 1024
+# Варианты, в которых хранятся загруженные картинки: {название: максимальная сторона в пикселях}.
+# Вариант original хранит картинку в исходном размере, но без метаданных
+IMAGE_VARIANTS = {
+    "original": None,
+    "feed": 1080,
+    "thumbnail": 320,
+}
+# Сколько процессов пережимают картинки
+IMAGE_WORKERS = 2
 # конфигурация CORS для S3
 s3_cors_configuration = {
     'CORSRules': [{
@@ -26,11 +50,85 @@ s3_cors_configuration = {
 db_url = 'sqlite://db.sqlite3'
 # Секретный ключ для хэширования
 TOKEN_SECRET_KEY = os.getenv("TOKEN_SECRET_KEY", 'Я нюхаю цветочки и радуюсь жизни')
-# Параметры подключения к memcached
-memcached_server = ('localhost', 11211)
+# Параметры подключения к memcached. Ключи распределяются по серверам консистентным хэшированием
+memcached_servers = [('localhost', 11211)]
+# memcached - кэш в memcached, memory - кэш в памяти процесса (для тестов и локального запуска)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memcached")
+# Сколько соединений держать с каждым сервером memcached
+CACHE_POOL_SIZE = 10
+# Сколько секунд ждать ответа memcached. Не ответивший сервер считается недоступным на CACHE_RETRY_AFTER секунд,
+# и всё это время его ключи ведут себя как отсутствующие
+CACHE_TIMEOUT = 0.2
+CACHE_RETRY_AFTER = 5
+# Сколько секунд снимок авторизованного пользователя живёт в memcached и в памяти процесса. Память процесса
+# нельзя сбросить из другого процесса, поэтому там снимок должен жить недолго
+AUTH_CACHE_TTL = 60
+AUTH_LOCAL_CACHE_TTL = 5
+# Сколько секунд профиль пользователя живёт в memcached. Профиль сбрасывается при изменении, так что срок нужен
+# только на случай расхождения счётчиков
+PROFILE_CACHE_TTL = 300
+# Число итераций PBKDF2 для хэшей паролей. Если его увеличить, старые хэши пересчитаются при входе пользователей
+PASSWORD_HASH_ROUNDS = 29000
+# Сколько паролей хэшируется одновременно и сколько может ждать своей очереди. Сверх этого вход и регистрация
+# отвечают 503, чтобы перебор паролей не останавливал остальное API
+PASSWORD_HASH_WORKERS = 4
+PASSWORD_HASH_MAX_PENDING = 64
 # Параметры подключения к centrifugo
 with open("centrifugo.json", "r") as file:
     cent_config = json.load(file)
     CENTRIFUGO_API_KEY = cent_config.get("api_key")
     CENTRIFUGO_SECRET = cent_config.get("token_hmac_secret_key")
-CENTRIFUGO_API_URL = "http://centrifugo:8000/api"
+CENTRIFUGO_API_URL = os.getenv("CENTRIFUGO_API_URL", "http://centrifugo:8000/api")
+# Публикации в centrifugo отправляются фоновой задачей пачками до CENT_BATCH_SIZE команд. Если в очереди больше
+# CENT_QUEUE_SIZE команд, новые отбрасываются: уведомления всё равно хранятся в БД и отдаются при подключении
+CENT_QUEUE_SIZE = 10000
+CENT_BATCH_SIZE = 100
+# Сколько раз повторять запрос к centrifugo (с растущей паузой) и сколько секунд ждать ответа
+CENT_MAX_RETRIES = 3
+CENT_TIMEOUT = 3
+# Токен для подключения к centrifugo действует CENT_TOKEN_LIFETIME секунд. Выданный токен кэшируется и отдаётся
+# повторно, пока до его истечения больше CENT_TOKEN_REFRESH_BEFORE секунд
+CENT_TOKEN_LIFETIME = 24 * 3600
+CENT_TOKEN_REFRESH_BEFORE = 3600
+# Счётчик непрочитанных уведомлений живёт в кэше не дольше UNREAD_COUNT_TTL секунд. Уведомления старше
+# NOTIFICATION_RETENTION_DAYS дней удаляются командой python manage.py prune_notifications пачками по
+# NOTIFICATION_PRUNE_BATCH
+UNREAD_COUNT_TTL = 300
+NOTIFICATION_RETENTION_DAYS = 90
+NOTIFICATION_PRUNE_BATCH = 1000
+# Непрочитанные уведомления, которые отдаются при подключении к centrifugo, кэшируются на CONNECT_CACHE_TTL секунд.
+# При промахе кэша из БД одновременно загружаются уведомления не больше CONNECT_MAX_CONCURRENT пользователей,
+# а если своей очереди ждёт больше CONNECT_MAX_PENDING загрузок, подключение отклоняется и centrifugo его повторит
+CONNECT_CACHE_TTL = 300
+CONNECT_MAX_CONCURRENT = 10
+CONNECT_MAX_PENDING = 1000
+# Число комментариев под моментом живёт в кэше не дольше COMMENTS_COUNT_TTL секунд
+COMMENTS_COUNT_TTL = 300
+# Размер страницы в списках (лента, моменты пользователя, комментарии, поиск, уведомления) по умолчанию и наибольший
+PAGE_SIZE = 10
+MAX_PAGE_SIZE = 50
+# Поиск по тегам. Каждый запрос просматривает не больше SEARCH_WINDOW моментов на тег, поэтому время ответа
+# не зависит от популярности тега. Ранжирование по лайкам и свежести идёт в пределах SEARCH_WINDOW самых новых моментов
+SEARCH_WINDOW = 1000
+# Сколько тегов можно искать одновременно и сколько подсказок отдавать при вводе
+SEARCH_MAX_TAGS = 5
+AUTOCOMPLETE_LIMIT = 10
+# Популярные теги: считаются по моментам за последние TREND_WINDOW_HOURS часов, вклад часа затухает вдвое
+# за TREND_HALF_LIFE_HOURS часов. Пересчёт идёт в фоне раз в TREND_REFRESH_INTERVAL секунд, хранится TREND_TOP тегов
+TREND_WINDOW_HOURS = 24
+TREND_HALF_LIFE_HOURS = 6
+TREND_REFRESH_INTERVAL = 60
+TREND_TOP = 50
+# Параметры ленты. Моменты авторов, у которых подписчиков не больше FEED_FANOUT_SYNC_LIMIT, раскладываются по лентам
+# подписчиков сразу, не больше FEED_FANOUT_PULL_THRESHOLD - в фоне, а моменты более крупных авторов не раскладываются
+# вовсе и подмешиваются в ленту при её чтении
+FEED_FANOUT_SYNC_LIMIT = 100
+FEED_FANOUT_PULL_THRESHOLD = 10000
+# Размер пачки записей при раскладке момента по лентам
+FEED_FANOUT_BATCH_SIZE = 1000
+# Сколько последних моментов автора попадает в ленту сразу после подписки на него
+FEED_BACKFILL_SIZE = 50
+# Просмотры моментов копятся в памяти и сбрасываются в БД раз в VIEWS_FLUSH_INTERVAL секунд
+# либо раньше, если в буфере накопилось VIEWS_MAX_BUFFER моментов
+VIEWS_FLUSH_INTERVAL = 5
+VIEWS_MAX_BUFFER = 1000
@@ -1,9 +1,211 @@
-from pymemcache.client import base
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+import aiomcache
 
 try:
-    from config import memcached_server
+    from config import memcached_servers, CACHE_BACKEND, CACHE_TIMEOUT, CACHE_POOL_SIZE, CACHE_RETRY_AFTER
 except ModuleNotFoundError:
-    from config_example import memcached_server
+    from config_example import memcached_servers, CACHE_BACKEND, CACHE_TIMEOUT, CACHE_POOL_SIZE, CACHE_RETRY_AFTER
+
+
+class CacheBackend:
+    """
+    Интерфейс кэша. Ключи и значения - строки. Ошибки кэша наружу не выходят: недоступный кэш ведёт себя как пустой,
+    чтобы падение memcached не превращалось в падение API
+    """
+
+    async def get(self, key: str) -> str | None:
+        return (await self.get_many([key])).get(key)
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        """
+        :return: {ключ: значение} для найденных ключей
+        """
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, expire: int = 0) -> None:
+        await self.set_many({key: value}, expire)
+
+    async def set_many(self, values: dict[str, str], expire: int = 0) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def incr(self, key: str, delta: int = 1) -> int | None:
+        """
+        Атомарно увеличивает число, хранящееся в ключе
+        :return: новое значение либо None, если ключа нет
+        """
+        raise NotImplementedError
+
+    async def decr(self, key: str, delta: int = 1) -> int | None:
+        """
+        Атомарно уменьшает число, хранящееся в ключе (не ниже 0, как в memcached)
+        :return: новое значение либо None, если ключа нет
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Кэш в памяти процесса. Замена memcached для тестов и локального запуска
+    """
+
+    def __init__(self):
+        self._data: dict[str, tuple[float | None, str]] = {}
+
+    def _get(self, key: str) -> str | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        values = {key: self._get(key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    async def set_many(self, values: dict[str, str], expire: int = 0) -> None:
+        expires = time.monotonic() + expire if expire else None
+        for key, value in values.items():
+            self._data[key] = (expires, value)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def incr(self, key: str, delta: int = 1) -> int | None:
+        value = self._get(key)
+        if value is None:
+            return None
+        value = max(int(value) + delta, 0)
+        self._data[key] = (self._data[key][0], str(value))
+        return value
+
+    async def decr(self, key: str, delta: int = 1) -> int | None:
+        return await self.incr(key, -delta)
+
+
+class HashRing:
+    """
+    Консистентное хэширование ключей по серверам: при добавлении или удалении сервера переезжает только
+    небольшая часть ключей
+    """
+
+    def __init__(self, nodes: list[str], replicas: int = 100):
+        self._ring = sorted((self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [node_hash for node_hash, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:8], 16)
+
+    def get(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._ring[index][1]
+
+
+class MemcachedBackend(CacheBackend):
+    """
+    Асинхронный клиент memcached с пулом соединений на каждый сервер. Если сервер не ответил за timeout,
+    он считается недоступным на retry_after секунд, и его ключи ведут себя как отсутствующие
+    """
+
+    def __init__(self, servers: list[tuple[str, int]], pool_size: int, timeout: float, retry_after: float):
+        self.pool_size = pool_size
+        self.clients = {f"{host}:{port}": self._connect(f"{host}:{port}") for host, port in servers}
+        self.ring = HashRing(list(self.clients))
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._down_until: dict[str, float] = {}
+
+    def _connect(self, server: str) -> aiomcache.Client:
+        host, port = server.rsplit(":", 1)
+        return aiomcache.Client(host, int(port), pool_size=self.pool_size)
+
+    @staticmethod
+    def _key(key: str) -> bytes:
+        """
+        memcached принимает ключи до 250 байт без пробелов и управляющих символов. Остальные ключи хэшируются
+        """
+        encoded = key.encode("utf-8")
+        if len(encoded) <= 250 and all(32 < byte < 127 for byte in encoded):
+            return encoded
+        return b"sha1:" + hashlib.sha1(encoded).hexdigest().encode("ascii")
+
+    async def _call(self, server: str, method: str, *args, default=None):
+        """
+        Выполняет команду на сервере, пряча ошибки и таймауты
+        :param server: сервер из кольца
+        :param method: метод aiomcache.Client
+        :param default: что вернуть, если сервер недоступен
+        """
+        if self._down_until.get(server, 0) > time.monotonic():
+            return default
+        client = self.clients[server]
+        try:
+            return await asyncio.wait_for(getattr(client, method)(*args), self.timeout)
+        except (asyncio.TimeoutError, OSError) as e:
+            logging.warning(f"memcached {server} недоступен: {e!r}")
+            self._down_until[server] = time.monotonic() + self.retry_after
+            if self.clients[server] is client:
+                # Команда, прерванная таймаутом, возвращает соединение в пул с недочитанным ответом, и следующая
+                # команда на нём прочитала бы чужой ответ. Поэтому пул сервера заменяется новым
+                self.clients[server] = self._connect(server)
+        except aiomcache.ClientException:
+            # Сервер ответил ошибкой (например, incr несуществующего ключа) - это не повод считать его недоступным
+            pass
+        finally:
+            if self.clients[server] is not client:
+                # Соединения заменённого пула закрываются по мере того, как на них завершаются команды
+                await client.close()
+        return default
+
+    async def get_many(self, keys: list[str]) -> dict[str, str]:
+        by_server: dict[str, list[str]] = {}
+        for key in keys:
+            by_server.setdefault(self.ring.get(key), []).append(key)
+
+        async def get_from(server: str, server_keys: list[str]) -> dict[str, str]:
+            values = await self._call(server, "multi_get", *(self._key(key) for key in server_keys),
+                                      default=(None,) * len(server_keys))
+            return {key: value.decode("utf-8") for key, value in zip(server_keys, values) if value is not None}
+
+        result = {}
+        for values in await asyncio.gather(*(get_from(server, server_keys)
+                                             for server, server_keys in by_server.items())):
+            result.update(values)
+        return result
+
+    async def set_many(self, values: dict[str, str], expire: int = 0) -> None:
+        await asyncio.gather(*(self._call(self.ring.get(key), "set", self._key(key), value.encode("utf-8"), expire)
+                               for key, value in values.items()))
+
+    async def delete(self, key: str) -> None:
+        await self._call(self.ring.get(key), "delete", self._key(key))
+
+    async def incr(self, key: str, delta: int = 1) -> int | None:
+        return await self._call(self.ring.get(key), "incr", self._key(key), delta)
+
+    async def decr(self, key: str, delta: int = 1) -> int | None:
+        return await self._call(self.ring.get(key), "decr", self._key(key), delta)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+
 
-# memcache клиент
-mc = base.Client(server=memcached_server, allow_unicode_keys=True, encoding="utf-8")
+# Кэш приложения
+if CACHE_BACKEND == "memory":
+    cache: CacheBackend = MemoryBackend()
+else:
+    cache: CacheBackend = MemcachedBackend(memcached_servers, CACHE_POOL_SIZE, CACHE_TIMEOUT, CACHE_RETRY_AFTER)
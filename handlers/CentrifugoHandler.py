@@ -1,26 +1,247 @@
+import asyncio
+import json
+import logging
 import time
 
-from cent import Client
+import httpx
 import jwt
 
+from handlers.CacheHandler import cache
+from misc.lru import TTLCache
+from misc.metrics import metrics
+
 try:
-    from config import CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, CENTRIFUGO_SECRET
+    from config import (CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, CENTRIFUGO_SECRET, CENT_QUEUE_SIZE, CENT_BATCH_SIZE,
+                        CENT_MAX_RETRIES, CENT_TIMEOUT, CENT_TOKEN_LIFETIME, CENT_TOKEN_REFRESH_BEFORE)
 except ModuleNotFoundError:
-    from config_example import CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, CENTRIFUGO_SECRET
+    from config_example import (CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, CENTRIFUGO_SECRET, CENT_QUEUE_SIZE,
+                                CENT_BATCH_SIZE, CENT_MAX_RETRIES, CENT_TIMEOUT, CENT_TOKEN_LIFETIME,
+                                CENT_TOKEN_REFRESH_BEFORE)
 
-cent_client = Client(CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, 3)
 
+class NotificationDispatcher:
+    """
+    Асинхронная отправка команд в HTTP API centrifugo. Команды складываются в очередь и отправляются фоновой задачей
+    пачками: одинаковые публикации в разные каналы склеиваются в broadcast, а остальные команды уходят одним
+    запросом (centrifugo принимает несколько команд, разделённых переводом строки)
+    """
 
-async def get_cent_token(user_id: int) -> dict:
+    def __init__(self, api_url: str, api_key: str, queue_size: int, batch_size: int, max_retries: int,
+                 timeout: float, transport: httpx.AsyncBaseTransport | None = None):
+        """
+        :param api_url: адрес HTTP API centrifugo
+        :param api_key: ключ API
+        :param queue_size: сколько команд может ждать отправки, остальные отбрасываются
+        :param batch_size: сколько команд из очереди отправлять одним запросом
+        :param max_retries: сколько раз повторять запрос при сетевой ошибке или ошибке сервера
+        :param timeout: таймаут запроса в секундах
+        :param transport: транспорт httpx (например, httpx.MockTransport вместо настоящего centrifugo в тестах)
+        """
+        self.api_url = api_url
+        self.api_key = api_key
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.transport = transport
+        self.queue: asyncio.Queue | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        # Очередь и клиент привязаны к event loop, поэтому создаются при старте приложения
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._client = httpx.AsyncClient(transport=self.transport, timeout=self.timeout,
+                                         headers={"Authorization": f"apikey {self.api_key}"})
+        self._task = asyncio.create_task(self._worker())
+
+    async def close(self) -> None:
+        """
+        Дожидается отправки уже поставленных в очередь команд и закрывает соединения
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), self.timeout * (self.max_retries + 1))
+        except asyncio.TimeoutError:
+            logging.warning(f"Не отправлено команд в centrifugo: {self.queue.qsize()}")
+        self._task.cancel()
+        self._task = None
+        await self._client.aclose()
+
+    def _put(self, command: dict) -> None:
+        if self.queue is None:
+            logging.warning("Очередь centrifugo не запущена, команда отброшена")
+            return
+        try:
+            self.queue.put_nowait(command)
+        except asyncio.QueueFull:
+            # Уведомления хранятся в БД и будут отданы при подключении, поэтому потеря публикации некритична
+            metrics.incr("centrifugo.dropped")
+            logging.warning("Очередь centrifugo переполнена, команда отброшена")
+        metrics.gauge("centrifugo.queue_depth", self.queue.qsize())
+
+    def publish(self, channel: str, data: dict) -> None:
+        """
+        Ставит публикацию в очередь
+        :param channel: канал
+        :param data: публикуемые данные
+        """
+        self._put({"method": "publish", "params": {"channel": channel, "data": data}})
+
+    def broadcast(self, channels: list[str], data: dict) -> None:
+        """
+        Ставит в очередь одну публикацию одних и тех же данных в несколько каналов
+        :param channels: каналы
+        :param data: публикуемые данные
+        """
+        self._put({"method": "broadcast", "params": {"channels": channels, "data": data}})
+
+    def history_remove(self, channel: str) -> None:
+        """
+        Ставит в очередь очистку истории канала
+        :param channel: канал
+        """
+        self._put({"method": "history_remove", "params": {"channel": channel}})
+
+    @staticmethod
+    def coalesce(commands: list[dict]) -> list[dict]:
+        """
+        Склеивает идущие подряд публикации одних и тех же данных в разные каналы в одну команду broadcast.
+        Остальные команды не переставляются относительно публикаций, а порядок публикаций в каждом канале сохраняется
+        :param commands: команды в порядке постановки в очередь
+        :return: команды для отправки
+        """
+        result = []
+        groups: dict[str, dict] = {}
+        channels: set[str] = set()
+        for command in commands:
+            if command["method"] != "publish":
+                # Например, history_remove должен выполниться после всех публикаций перед ним и до всех после него
+                result.extend(groups.values())
+                result.append(command)
+                groups, channels = {}, set()
+                continue
+            channel = command["params"]["channel"]
+            if channel in channels:
+                # Вторая публикация в тот же канал не должна обогнать публикации между ними
+                result.extend(groups.values())
+                groups, channels = {}, set()
+            channels.add(channel)
+            key = json.dumps(command["params"]["data"], sort_keys=True)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = command
+            elif group["method"] == "publish":
+                groups[key] = {"method": "broadcast",
+                               "params": {"channels": [group["params"]["channel"], channel],
+                                          "data": command["params"]["data"]}}
+            else:
+                group["params"]["channels"].append(channel)
+        result.extend(groups.values())
+        return result
+
+    async def _worker(self) -> None:
+        while True:
+            commands = [await self.queue.get()]
+            # Всё, что накопилось в очереди за время предыдущей отправки, уходит одним запросом
+            while len(commands) < self.batch_size and not self.queue.empty():
+                commands.append(self.queue.get_nowait())
+            metrics.gauge("centrifugo.queue_depth", self.queue.qsize())
+            try:
+                await self._send(self.coalesce(commands))
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            finally:
+                for _ in commands:
+                    self.queue.task_done()
+
+    async def _send(self, commands: list[dict]) -> None:
+        body = "\n".join(json.dumps(command, ensure_ascii=False) for command in commands)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.timer("centrifugo.request"):
+                    response = await self._client.post(self.api_url, content=body.encode("utf-8"))
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    for reply in response.text.splitlines():
+                        if reply and "error" in json.loads(reply):
+                            logging.error(f"Ошибка centrifugo: {reply}")
+                    metrics.incr("centrifugo.commands", len(commands))
+                    return
+                logging.warning(f"centrifugo ответил {response.status_code}, попытка {attempt + 1}")
+            except httpx.TransportError as e:
+                logging.warning(f"centrifugo недоступен: {e!r}, попытка {attempt + 1}")
+            if attempt < self.max_retries:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        metrics.incr("centrifugo.dropped", len(commands))
+        logging.error(f"Не удалось отправить в centrifugo команд: {len(commands)}")
+
+
+notification_dispatcher = NotificationDispatcher(CENTRIFUGO_API_URL, CENTRIFUGO_API_KEY, CENT_QUEUE_SIZE,
+                                                 CENT_BATCH_SIZE, CENT_MAX_RETRIES, CENT_TIMEOUT)
+
+
+def sign_cent_token(user_id: int) -> tuple[str, int]:
     """
-    Позволяет получить токен для подписчика в centrifugo
+    Подписывает токен для подключения к centrifugo
     :param user_id: айди пользователя
-    :return: {"token": token}
+    :return: (токен, время истечения в секундах unix)
     """
+    expires = int(time.time()) + CENT_TOKEN_LIFETIME
     claims = {
         "sub": user_id,
         "channel": f"personal_notifications:{user_id}",
-        "exp": int(time.time()) + 24 * 3600,
+        "exp": expires,
     }
-    token = jwt.encode(claims, CENTRIFUGO_SECRET, algorithm="HS256")
-    return {"cent_token": token}
+    with metrics.timer("centrifugo.token_sign"):
+        return jwt.encode(claims, CENTRIFUGO_SECRET, algorithm="HS256"), expires
+
+
+async def get_cent_tokens(user_ids: list[int]) -> dict[int, str]:
+    """
+    Токены для подключения к centrifugo сразу для нескольких пользователей (например, для предзагрузки).
+    Ещё действующие токены берутся из кэша, новые подписываются, только если до истечения кэшированного
+    осталось меньше CENT_TOKEN_REFRESH_BEFORE секунд
+    :param user_ids: айди пользователей
+    :return: {айди пользователя: токен}
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    tokens, new_tokens = {}, {}
+    for user_id in user_ids:
+        token = cent_token_cache.get(user_id)
+        if token is not None:
+            tokens[user_id] = token
+    missing = [user_id for user_id in user_ids if user_id not in tokens]
+    if missing:
+        cached = await cache.get_many([f"cent_token:{user_id}" for user_id in missing])
+        now = int(time.time())
+        for user_id in missing:
+            value = cached.get(f"cent_token:{user_id}")
+            if value is not None:
+                token, expires = json.loads(value)
+            else:
+                # Cache miss
+                token, expires = sign_cent_token(user_id)
+                new_tokens[f"cent_token:{user_id}"] = json.dumps([token, expires])
+            # Токен живёт в кэше, пока до его истечения больше CENT_TOKEN_REFRESH_BEFORE секунд
+            cent_token_cache.set(user_id, token, ttl=expires - CENT_TOKEN_REFRESH_BEFORE - now)
+            tokens[user_id] = token
+        if new_tokens:
+            await cache.set_many(new_tokens, expire=CENT_TOKEN_LIFETIME - CENT_TOKEN_REFRESH_BEFORE)
+    metrics.incr("centrifugo.token_signed", len(new_tokens))
+    metrics.incr("centrifugo.token_reused", len(tokens) - len(new_tokens))
+    return tokens
+
+
+async def get_cent_token(user_id: int) -> dict:
+    """
+    Позволяет получить токен для подписчика в centrifugo
+    :param user_id: айди пользователя
+    :return: {"cent_token": token}
+    """
+    return {"cent_token": (await get_cent_tokens([user_id]))[user_id]}
+
+
+# Токены для подключения к centrifugo
+cent_token_cache = TTLCache(maxsize=10000, ttl=CENT_TOKEN_LIFETIME - CENT_TOKEN_REFRESH_BEFORE)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Type
+
+from tortoise.backends.base.client import TransactionContext
+from tortoise.expressions import F
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
+
+class CounterBuffer:
+    """
+    Буфер приращений счётчика в БД (write-behind). Приращения копятся в памяти процесса и периодически
+    сбрасываются в БД пачками вида UPDATE ... SET field = field + n WHERE id IN (...)
+    """
+
+    def __init__(self, model: Type[Model], field: str, flush_interval: float, max_buffer: int):
+        """
+        :param model: модель, в которой хранится счётчик
+        :param field: поле счётчика
+        :param flush_interval: как часто сбрасывать буфер в БД, в секундах
+        :param max_buffer: сколько разных объектов может накопиться в буфере до внепланового сброса
+        """
+        self.model = model
+        self.field = field
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._pending: dict[int, int] = defaultdict(int)
+        # Приращения, которые сейчас записываются в БД. Учитываются при чтении, пока запись не завершится
+        self._flushing: dict[int, int] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._background: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """
+        Запускает периодический сброс буфера
+        """
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Останавливает периодический сброс и записывает в БД всё, что осталось в буфере
+        """
+        tasks = list(self._background)
+        if self._task is not None:
+            self._task.cancel()
+            tasks.append(self._task)
+            self._task = None
+        # Прерванный сброс возвращает свои приращения в буфер, а внеплановые дописываются до конца
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.flush()
+        logging.info(f"Буфер счётчика {self.model.__name__}.{self.field} сброшен")
+
+    def hit(self, object_ids: list[int], delta: int = 1) -> None:
+        """
+        Увеличивает счётчик у объектов
+        :param object_ids: айди объектов
+        :param delta: приращение
+        """
+        for object_id in object_ids:
+            self._pending[object_id] += delta
+        if len(self._pending) >= self.max_buffer and not self._lock.locked():
+            task = asyncio.create_task(self.flush())
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    def pending(self, object_id: int) -> int:
+        """
+        Возвращает приращение счётчика объекта, которое ещё не записано в БД
+        :param object_id: айди объекта
+        :return: приращение
+        """
+        return self._pending.get(object_id, 0) + self._flushing.get(object_id, 0)
+
+    async def flush(self) -> None:
+        """
+        Записывает накопленные приращения в БД
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, defaultdict(int)
+            # Объекты с одинаковым приращением обновляются одним запросом
+            by_delta: dict[int, list[int]] = defaultdict(list)
+            for object_id, delta in self._flushing.items():
+                by_delta[delta].append(object_id)
+            try:
+                async with in_transaction() as connection:
+                    for delta, object_ids in by_delta.items():
+                        await (self.model
+                               .filter(id__in=object_ids)
+                               .using_db(connection)
+                               .update(**{self.field: F(self.field) + delta}))
+            except Exception as e:
+                # Возвращаем приращения в буфер, чтобы не потерять их до следующей попытки
+                logging.error(e, exc_info=True)
+                self._restore()
+            except asyncio.CancelledError:
+                # Сброс прервали (например, при остановке приложения), и транзакция откатилась
+                self._restore()
+                raise
+            finally:
+                self._flushing = {}
+
+    def _restore(self) -> None:
+        for object_id, delta in self._flushing.items():
+            self._pending[object_id] += delta
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+async def write_counters(model: Type[Model], field: str, values: dict[int, int],
+                         connection: TransactionContext | None = None) -> None:
+    """
+    Перезаписывает счётчик у всех объектов модели. Объекты, которых нет в values, получают 0
+    :param model: модель, в которой хранится счётчик
+    :param field: поле счётчика
+    :param values: {айди объекта: значение счётчика}
+    :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
+    """
+    await model.all().using_db(connection).update(**{field: 0})
+    # Объекты с одинаковым значением обновляются одним запросом
+    by_value: dict[int, list[int]] = defaultdict(list)
+    for object_id, value in values.items():
+        if value:
+            by_value[value].append(object_id)
+    for value, object_ids in by_value.items():
+        await model.filter(id__in=object_ids).using_db(connection).update(**{field: value})
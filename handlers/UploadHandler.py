@@ -1,31 +1,64 @@
-import imghdr
+import asyncio
+import hashlib
+import json
 import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import AsyncIterator, BinaryIO
 from uuid import uuid4
 
 import boto3
 import botocore.exceptions as exs
+from botocore.config import Config
 from fastapi import UploadFile
-from tortoise.backends.base.client import TransactionContext
+from starlette.requests import Request
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 from tortoise.exceptions import IntegrityError
 
 try:
-    from config import s3_config, db_url, s3_cors_configuration
+    from config import (s3_config, s3_cors_configuration, S3_MAX_WORKERS, S3_MAX_POOL_CONNECTIONS,
+                        PRESIGNED_URL_EXPIRES, PRESIGNED_URL_MARGIN, IMAGE_VARIANTS, IMAGE_WORKERS, IMAGE_DELIVERY,
+                        IMAGE_CACHE_DIR, IMAGE_CACHE_SIZE, S3_CHUNK_SIZE)
 except ModuleNotFoundError:
-    from config_example import s3_config, db_url, s3_cors_configuration
+    from config_example import (s3_config, s3_cors_configuration, S3_MAX_WORKERS, S3_MAX_POOL_CONNECTIONS,
+                                PRESIGNED_URL_EXPIRES, PRESIGNED_URL_MARGIN, IMAGE_VARIANTS, IMAGE_WORKERS,
+                                IMAGE_DELIVERY, IMAGE_CACHE_DIR, IMAGE_CACHE_SIZE, S3_CHUNK_SIZE)
 
+from handlers.CacheHandler import cache
+from misc.filecache import DiskCache
+from misc.images import make_variants, remove_files
+from misc.lru import TTLCache
+from misc.metrics import metrics
 from models.Upload import Upload
 
+# Файл стандартной аватарки в S3
+DEFAULT_AVATAR = "avatar.jpg"
+
 
 class UploadHandler:
     def __init__(self):
         self.session = boto3.session.Session()
-        self.s3_client = self.session.client(**s3_config)
+        self.s3_client = self.session.client(**s3_config, config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+        # boto3 синхронный, поэтому передача файлов идёт в отдельных потоках, чтобы не блокировать event loop
+        self.executor = ThreadPoolExecutor(max_workers=S3_MAX_WORKERS, thread_name_prefix="s3")
+        # Обработка картинок нагружает процессор, поэтому идёт в отдельных процессах
+        self.image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
         self.s3_client.put_bucket_cors(Bucket='moments_uploads', CORSConfiguration=s3_cors_configuration)
         try:
-            self.s3_client.head_object(Bucket='moments_uploads', Key="avatar.jpg")
+            self.s3_client.head_object(Bucket='moments_uploads', Key=DEFAULT_AVATAR)
         except exs.ClientError:
             with open('assets/avatar.jpg', 'rb') as data:
-                self.s3_client.upload_fileobj(data, 'moments_uploads', "avatar.jpg")
+                self.s3_client.upload_fileobj(data, 'moments_uploads', DEFAULT_AVATAR)
+        # Подписанные ссылки на скачивание: {имя файла: [ссылка, unix-время, до которого её можно выдавать]}
+        self.url_cache = TTLCache(maxsize=10000, ttl=PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN)
+        # Файлы, которые приложение отдаёт само (IMAGE_DELIVERY == "proxy")
+        self.disk_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_SIZE) if IMAGE_DELIVERY == "proxy" else None
         logging.info("S3 инициализирован")
 
     def close(self):
@@ -33,42 +66,286 @@ class UploadHandler:
         Закрывает сессию с S3
         :return:
         """
+        self.executor.shutdown(wait=True)
+        self.image_executor.shutdown(wait=True)
         self.s3_client.close()
         logging.info("Соединение с S3 закрыто")
 
-    async def upload(self, upload_file: UploadFile, connection: TransactionContext | None = None) -> Upload:
+    async def _run(self, func, *args, **kwargs):
+        """
+        Выполняет блокирующий вызов boto3 в пуле потоков S3
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    @asynccontextmanager
+    async def uploading(self, upload_file: UploadFile) -> AsyncIterator[Upload]:
         """
-        Загружает файл в S3 хранилище
+        Пережимает картинку в варианты из IMAGE_VARIANTS и загружает их в S3 хранилище. Загрузка идёт до открытия
+        транзакции, а если блок with завершится ошибкой, файлы удаляются из S3, чтобы не оставлять в хранилище
+        файлы без записи в БД:
+
+            async with upload_handler.uploading(file) as upload:
+                async with in_transaction() as connection:
+                    await upload.save(using_db=connection)
+
         :param upload_file: объект загруженного файла из FastAPI
-        :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
-        :return: объект загруженного пользователем файла
+        :return: ещё не сохранённый в БД объект загруженного пользователем файла
         """
-        # Загрузка файла в S3
+        # Картинка уходит в пул процессов через файл на диске, а не через память. Там же make_variants проверяет,
+        # что это действительно картинка
+        source = await self._run(self._spool, upload_file.file)
         try:
-            uuid = uuid4()
-            if imghdr.what(upload_file.file) is None:
-                raise IntegrityError
-            upload = await Upload.create(filename=f"{uuid}.{imghdr.what(upload_file.file)}", using_db=connection)
-            self.s3_client.upload_fileobj(upload_file.file, 'moments_uploads', upload.filename)
-        except exs.ClientError as e:
-            # Если проблема с S3, то логируем и поднимаем ошибку
+            variants = await asyncio.get_running_loop().run_in_executor(self.image_executor, make_variants,
+                                                                        source, IMAGE_VARIANTS)
+        except Exception as e:
             logging.error(e, exc_info=True)
             raise IntegrityError
-        return upload
+        finally:
+            remove_files([source])
+        uuid = uuid4()
+        filenames = {}
+        for name, path in variants.items():
+            extension = path.rsplit('.', 1)[1]
+            filenames[name] = f"{uuid}.{extension}" if name == "original" else f"{uuid}_{name}.{extension}"
+        try:
+            results = await asyncio.gather(*(self._run(self.s3_client.upload_file, path, 'moments_uploads',
+                                                       filenames[name])
+                                             for name, path in variants.items()), return_exceptions=True)
+        finally:
+            remove_files(variants.values())
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            # Если проблема с S3, то логируем, удаляем то, что успело загрузиться, и поднимаем ошибку
+            logging.error(errors[0], exc_info=errors[0])
+            await asyncio.gather(*(self.delete(filename) for filename in filenames.values()))
+            raise IntegrityError
+        upload = Upload(filename=filenames.pop("original"), variants=filenames)
+        try:
+            yield upload
+        except BaseException:
+            await asyncio.gather(*(self.delete(filename) for filename in upload.filenames().values()))
+            raise
+
+    @staticmethod
+    def _spool(file) -> str:
+        """
+        Копирует загруженный файл во временный файл кусками, не читая его в память целиком
+        :param file: файловый объект
+        :return: путь к временному файлу
+        """
+        file.seek(0)
+        with tempfile.NamedTemporaryFile(delete=False) as output:
+            shutil.copyfileobj(file, output)
+        return output.name
+
+    async def delete(self, filename: str) -> None:
+        """
+        Удаляет файл из S3 хранилища
+        :param filename: имя файла в хранилище
+        """
+        try:
+            await self._run(self.s3_client.delete_object, Bucket='moments_uploads', Key=filename)
+        except exs.ClientError as e:
+            # Файл останется в хранилище без записи в БД - некритично, но стоит отследить
+            logging.error(e, exc_info=True)
+
+    async def download(self, filename: str) -> tuple[str, float]:
+        """
+        Возвращает ссылку для скачивания файла из S3 хранилища. Ссылки кэшируются и перестают выдаваться
+        за PRESIGNED_URL_MARGIN секунд до истечения подписи
+        :param filename: имя файла в хранилище
+        :return: ссылка для скачивания файла, unix-время, до которого её можно использовать
+        """
+        cached = self.url_cache.get(filename)
+        if cached is None:
+            raw = await cache.get(f"presigned_url:{filename}")
+            if raw is not None:
+                cached = json.loads(raw)
+            else:
+                # Cache miss
+                url = self.s3_client.generate_presigned_url('get_object',
+                                                            {'Bucket': 'moments_uploads', 'Key': filename},
+                                                            ExpiresIn=PRESIGNED_URL_EXPIRES)
+                cached = [url, time.time() + PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN]
+                await cache.set(f"presigned_url:{filename}", json.dumps(cached),
+                                expire=PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN)
+            self.url_cache.set(filename, cached, ttl=cached[1] - time.time())
+        return cached[0], cached[1]
+
+    async def redirect(self, filename: str, request: Request, max_age: int | None = None) -> Response:
+        """
+        Перенаправляет на скачивание файла из S3. Браузеры и CDN могут переиспользовать перенаправление,
+        пока ссылка в нём действительна
+        :param filename: имя файла в хранилище
+        :param request: запрос, на который отвечаем (для проверки If-None-Match)
+        :param max_age: ограничение времени кэширования перенаправления, если файл за этим адресом может смениться
+        :return: 307 со ссылкой на файл либо 304, если у клиента уже есть актуальное перенаправление
+        """
+        url, valid_until = await self.download(filename)
+        cache_for = max(int(valid_until - time.time()), 0)
+        if max_age is not None:
+            cache_for = min(cache_for, max_age)
+        headers = {
+            "Cache-Control": f"public, max-age={cache_for}",
+            "ETag": f'"{hashlib.md5(url.encode("utf-8")).hexdigest()}"',
+        }
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        return RedirectResponse(url, headers=headers)
+
+    async def serve(self, filename: str, request: Request, max_age: int | None = None) -> Response:
+        """
+        Отдаёт файл из S3 способом, выбранным в IMAGE_DELIVERY: перенаправлением (см. redirect) либо самим
+        приложением (см. proxy)
+        :param filename: имя файла в хранилище
+        :param request: запрос, на который отвечаем
+        :param max_age: ограничение времени кэширования, если файл за этим адресом может смениться
+        """
+        if self.disk_cache is None:
+            return await self.redirect(filename, request, max_age)
+        return await self.proxy(filename, request, max_age)
+
+    async def proxy(self, filename: str, request: Request, max_age: int | None = None) -> Response:
+        """
+        Отдаёт файл без перенаправления: с диска, если он уже в кэше, иначе потоком из S3 с сохранением в кэш.
+        Имена файлов в хранилище не переиспользуются для другого содержимого, поэтому ETag строится по имени
+        файла, а без max_age браузер кэширует файл навсегда. Поддерживается один диапазон в заголовке Range
+        :param filename: имя файла в хранилище
+        :param request: запрос, на который отвечаем (для проверки If-None-Match, Range и If-Range)
+        :param max_age: ограничение времени кэширования, если файл за этим адресом может смениться
+        :return: 200 или 206 с содержимым файла, 304, если у клиента уже есть файл, 404 или 416
+        """
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable" if max_age is None else f"public, max-age={max_age}",
+            "ETag": f'"{hashlib.sha1(filename.encode("utf-8")).hexdigest()}"',
+            "Accept-Ranges": "bytes",
+        }
+        if self._matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        byte_range = request.headers.get("range")
+        if request.headers.get("if-range", headers["ETag"]) != headers["ETag"]:
+            # Диапазон запрошен для другой версии файла - отдаём файл целиком
+            byte_range = None
+        media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+        cached = await asyncio.to_thread(self._open_cached, filename)
+        if cached is not None:
+            metrics.incr("image_cache.hit")
+            file, size = cached
+            bounds = self._parse_range(byte_range, size)
+            if bounds is None:
+                headers["Content-Length"] = str(size)
+                return StreamingResponse(self._file_chunks(file, 0, size), headers=headers, media_type=media_type)
+            start, end = bounds
+            if start >= size:
+                file.close()
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(self._file_chunks(file, start, end - start + 1), status_code=206,
+                                     headers=headers, media_type=media_type)
+
+        metrics.incr("image_cache.miss")
+        try:
+            s3_object = await self._run(self.s3_client.get_object, Bucket='moments_uploads', Key=filename,
+                                        **({"Range": byte_range} if byte_range else {}))
+        except exs.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("NoSuchKey", "404"):
+                return Response(status_code=404)
+            if code == "InvalidRange":
+                return Response(status_code=416, headers=headers)
+            raise
+        headers["Content-Length"] = str(s3_object["ContentLength"])
+        if s3_object.get("ContentRange"):
+            # Часть файла в кэш не кладём: целиком его скачает первый запрос без Range
+            headers["Content-Range"] = s3_object["ContentRange"]
+            return StreamingResponse(self._s3_chunks(s3_object["Body"]), status_code=206, headers=headers,
+                                     media_type=media_type)
+        return StreamingResponse(self._s3_chunks(s3_object["Body"], filename), headers=headers, media_type=media_type)
+
+    @staticmethod
+    def _matches(if_none_match: str | None, etag: str) -> bool:
+        """
+        Проверяет, есть ли ETag среди перечисленных в If-None-Match
+        """
+        if if_none_match is None:
+            return False
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    def _open_cached(self, filename: str) -> tuple[BinaryIO, int] | None:
+        """
+        Открывает файл из кэша на диске. Обращается к диску, поэтому вызывается из пула потоков
+        :return: (файл, размер) либо None, если файла в кэше нет
+        """
+        file = self.disk_cache.open(filename)
+        if file is None:
+            return None
+        return file, os.fstat(file.fileno()).st_size
+
+    @staticmethod
+    def _parse_range(byte_range: str | None, size: int) -> tuple[int, int] | None:
+        """
+        Разбирает заголовок Range с одним диапазоном байт. Неверный заголовок (например, первый байт больше
+        последнего) игнорируется, как требует RFC 9110
+        :param byte_range: значение заголовка
+        :param size: размер файла
+        :return: (первый байт, последний байт) либо None, если нужно отдать файл целиком. Первый байт за концом
+        файла означает, что диапазон невыполним
+        """
+        if not byte_range or not byte_range.startswith("bytes=") or "," in byte_range:
+            return None
+        first, separator, last = byte_range[len("bytes="):].strip().partition("-")
+        if not separator or not (first + last).isdigit() or (first and last and int(first) > int(last)):
+            return None
+        if not first:
+            # Последние last байт файла, а bytes=-0 невыполним
+            suffix = int(last)
+            return (max(size - suffix, 0) if suffix else size), size - 1
+        return int(first), min(int(last), size - 1) if last else size - 1
 
-    def download(self, upload: Upload) -> str:
+    @staticmethod
+    async def _file_chunks(file: BinaryIO, start: int, length: int) -> AsyncIterator[bytes]:
         """
-        Возвращает ссылку для скачивания файла из S3 хранилища
-        :param upload: объект загруженного пользователем файла
-        :return: ссылка для скачивания файла
+        Читает часть файла с диска кусками и закрывает его
         """
-        # Время действия ссылки ограничено сервером S3
-        return self.s3_client.generate_presigned_url('get_object',
-                                                     {'Bucket': 'moments_uploads', 'Key': upload.filename})
+        try:
+            await asyncio.to_thread(file.seek, start)
+            while length > 0:
+                chunk = await asyncio.to_thread(file.read, min(S3_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            file.close()
 
-    def download_default_avatar(self) -> str:
-        return self.s3_client.generate_presigned_url('get_object',
-                                                     {'Bucket': 'moments_uploads', 'Key': "avatar.jpg"})
+    async def _s3_chunks(self, body, filename: str | None = None) -> AsyncIterator[bytes]:
+        """
+        Читает ответ S3 кусками. Если указано имя файла, файл заодно сохраняется в кэш на диске - только если
+        он дочитан до конца
+        :param body: тело ответа get_object
+        :param filename: имя файла в кэше
+        """
+        descriptor, temporary = (await asyncio.to_thread(self.disk_cache.temporary) if filename is not None
+                                 else (None, None))
+        output = os.fdopen(descriptor, "wb") if descriptor is not None else None
+        complete = False
+        try:
+            while chunk := await self._run(body.read, S3_CHUNK_SIZE):
+                if output is not None:
+                    await asyncio.to_thread(output.write, chunk)
+                yield chunk
+            complete = True
+        finally:
+            body.close()
+            if output is not None:
+                output.close()
+                if complete:
+                    await asyncio.to_thread(self.disk_cache.put, filename, temporary)
+                else:
+                    remove_files([temporary])
 
 
 # обработчик загрузок
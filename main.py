@@ -1,11 +1,18 @@
 import logging
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 from tortoise.contrib.fastapi import register_tortoise
 
-from handlers.CacheHandler import mc
+from handlers.CacheHandler import cache
+from handlers.CentrifugoHandler import notification_dispatcher
 from handlers.UploadHandler import upload_handler
+from misc.concurrency import Overloaded
+from misc.secure import password_hasher
+from models import MODELS_MODULES
+from models.Moment import view_counter
+from models.TagTrend import trending_tags
 
 try:
     from config import db_url
@@ -18,6 +25,7 @@ from routes.subscription import router as subscription_router
 from routes.like import router as like_router
 from routes.comment import router as comment_router
 from routes.notification import router as notification_router
+from routes.metrics import router as metrics_router
 
 logging.basicConfig(level=logging.INFO)
 app = FastAPI()
@@ -27,24 +35,41 @@ app.include_router(subscription_router, prefix="/subscription")
 app.include_router(like_router, prefix="/like")
 app.include_router(comment_router, prefix="/comment")
 app.include_router(notification_router, prefix="/notification")
+app.include_router(metrics_router, prefix="/metrics")
 
-# Инициализируем ORM
+
+# Обработчики событий жизненного цикла регистрируются до register_tortoise: starlette вызывает их в порядке
+# регистрации, а буфер просмотров должен успеть записаться в БД до закрытия соединений
+@app.on_event("startup")
+async def startup_event():
+    view_counter.start()
+    notification_dispatcher.start()
+    trending_tags.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await trending_tags.close()
+    await view_counter.close()
+    await notification_dispatcher.close()
+    upload_handler.close()
+    password_hasher.close()
+    await cache.close()
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    # Очередь на хэширование паролей или загрузку уведомлений переполнена - просим повторить запрос чуть позже
+    return JSONResponse(status_code=503, content={"detail": "Сервер перегружен, повторите попытку позже"},
+                        headers={"Retry-After": "1"})
+
+
+# Инициализируем ORM. Схема БД создаётся и обновляется миграциями: python manage.py migrate
 register_tortoise(
     app,
     db_url=db_url,
-    modules={'models': [
-        'models.Comment',
-        'models.CommentLike',
-        'models.Moment',
-        'models.MomentLike',
-        'models.Subscription',
-        'models.Tag',
-        'models.Upload',
-        'models.User',
-        'models.TagMoment',
-        'models.Notification',
-    ]},
-    generate_schemas=True,
+    modules={'models': MODELS_MODULES},
+    generate_schemas=False,
     add_exception_handlers=True,
 )
 origins = [
@@ -61,14 +86,3 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-
-@app.on_event("startup")
-async def startup_event():
-    pass
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    upload_handler.close()
-    mc.close()
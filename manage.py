@@ -0,0 +1,178 @@
+"""
+Служебные команды для обслуживания БД. Запуск: python manage.py <команда>
+"""
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from tortoise import Tortoise, run_async, timezone
+from tortoise.expressions import Q
+from tortoise.functions import Sum
+from tortoise.transactions import in_transaction
+
+try:
+    from config import db_url, NOTIFICATION_RETENTION_DAYS
+except ModuleNotFoundError:
+    from config_example import db_url, NOTIFICATION_RETENTION_DAYS
+
+from handlers.CounterHandler import write_counters
+from migrations import migrate
+from misc.pagination import after
+from models import MODELS_MODULES
+from models.Comment import Comment
+from models.CommentLike import CommentLike
+from models.Moment import Moment
+from models.MomentLike import MomentLike
+from models.Notification import Notification
+from models.Subscription import Subscription
+from models.Tag import Tag
+from models.TagMoment import TagMoment
+from models.TagTrend import TagTrend
+from models.Timeline import Timeline, TimelinePull
+from models.User import User
+
+
+async def rebuild_timelines():
+    """
+    Заново собирает ленты всех пользователей по их подпискам. Нужна после первого развёртывания лент
+    """
+    await Timeline.rebuild_all()
+
+
+async def reconcile_likes():
+    """
+    Пересчитывает счётчики лайков моментов и комментариев по таблицам лайков, а затем рейтинг авторов
+    """
+    await Moment.reconcile_likes()
+    await Comment.reconcile_likes()
+    async with in_transaction() as connection:
+        # Рейтинг автора - это сумма лайков под его моментами и комментариями
+        rating: dict[int, int] = {}
+        for model in (Moment, Comment):
+            for author_id, likes in await (model
+                                           .annotate(likes=Sum("likes_count"))
+                                           .group_by("author_id")
+                                           .using_db(connection)
+                                           .values_list("author_id", "likes")):
+                rating[author_id] = rating.get(author_id, 0) + (likes or 0)
+        await write_counters(User, "rating", rating, connection)
+    logging.info("Счётчики лайков и рейтинг пересчитаны")
+
+
+def is_full_scan(dialect: str, plan: list[dict]) -> bool:
+    """
+    Проверяет, читает ли план запроса какую-либо таблицу целиком
+    :param dialect: sqlite, postgres или mysql
+    :param plan: результат EXPLAIN (для sqlite - EXPLAIN QUERY PLAN)
+    """
+    if dialect == "sqlite":
+        # "SCAN moment" - полный проход по таблице, "SCAN moment USING INDEX ..." - проход по индексу
+        return any(row["detail"].startswith("SCAN") and "USING" not in row["detail"]
+                   and "CONSTANT ROW" not in row["detail"] for row in plan)
+    if dialect == "postgres":
+        return any("Seq Scan" in row["QUERY PLAN"] for row in plan)
+    return any(row["type"] == "ALL" for row in plan)
+
+
+async def find_full_scans() -> list[str]:
+    """
+    Выполняет EXPLAIN для запросов, которые делают роуты
+    :return: названия запросов, которые читают таблицу целиком
+    """
+    cursor = after((datetime.now(), 1))
+    queries = {
+        "login": User.filter(Q(nickname="user") | Q(email="user@example.com")),
+        "users by nicknames": User.filter(nickname__in=["aaa", "bbb"]),
+        "user moments": Moment.filter(Q(author_id=1) & cursor).order_by("-created_at", "-id").limit(11),
+        "hydrate moments": Moment.filter(id__in=[1, 2]),
+        "hydrate tags": TagMoment.filter(moment_id__in=[1, 2]).values("moment_id", "tag__name"),
+        "hydrate likes": MomentLike.filter(author_id=1, object_id__in=[1, 2]),
+        "search window": TagMoment.filter(tag_id=1, moment_id__lt=100).order_by("-moment_id").limit(1000),
+        "search all tags": TagMoment.filter(moment_id__in=[1, 2], tag_id__in=[3, 4]),
+        "autocomplete tags": Tag.filter(name__gte="ab", name__lt="ac").order_by("name").limit(10),
+        "autocomplete users": User.filter(nickname__gte="abc", nickname__lt="abd").order_by("nickname").limit(10),
+        "tags by names": Tag.filter(name__in=["a", "b"]),
+        "feed": Timeline.filter(Q(owner_id=1) & after((datetime.now(), 1), id_field="moment_id"))
+                        .order_by("-created_at", "-moment_id").limit(11),
+        "feed pulled authors": TimelinePull.filter(owner_id=1),
+        "feed pulled moments": Moment.filter(Q(author_id__in=[1, 2]) & cursor).order_by("-created_at", "-id").limit(11),
+        "comments": Comment.filter(Q(moment_id=1) & cursor).exclude(author_id=1).order_by("-created_at", "-id"),
+        "my comment": Comment.filter(moment_id=1, author_id=1),
+        "hydrate comments": Comment.filter(id__in=[1, 2]).values("id", "author__nickname", "text"),
+        "comments liked": CommentLike.filter(author_id=1, object_id__in=[1, 2]),
+        "comments count": Comment.filter(moment_id=1).count(),
+        "notifications": Notification.filter(Q(recipient_id=1) & cursor).order_by("-created_at", "-id").limit(11),
+        "unread notifications": Notification.unread(1).order_by("-id").limit(10),
+        "unread count": Notification.unread(1).count(),
+        "last notification": Notification.filter(recipient_id=1).order_by("-id").limit(1),
+        "trending tags": TagTrend.filter(bucket__gte=datetime.now()).values_list("tag__name", "bucket", "count"),
+        "record tag trend": TagTrend.filter(tag_id__in=[1, 2], bucket=datetime.now()),
+        "followers": Subscription.filter(author_id=1),
+        "subscriptions": Subscription.filter(subscriber_id=1),
+        "subscribed": Subscription.filter(author_id=1, subscriber_id=2),
+        "fan-out batch": Subscription.filter(author_id=1, id__gt=0).order_by("id").limit(1000),
+    }
+    connection = Tortoise.get_connection("default")
+    dialect = connection.capabilities.dialect
+    failed = []
+    for name, queryset in queries.items():
+        async with in_transaction() as transaction:
+            if dialect == "postgres":
+                # На маленькой таблице postgres выберет полный проход, даже если индекс есть
+                await transaction.execute_script("SET LOCAL enable_seqscan = off")
+            explain = "EXPLAIN QUERY PLAN" if dialect == "sqlite" else "EXPLAIN"
+            plan = await transaction.execute_query_dict(f"{explain} {queryset.sql()}")
+        if is_full_scan(dialect, plan):
+            failed.append(name)
+            logging.error(f"Запрос '{name}' читает таблицу целиком: {plan}")
+    return failed
+
+
+async def check_queries():
+    """
+    Завершается с ошибкой, если какой-то из запросов роутов читает таблицу целиком. Запускается после migrate,
+    например, в CI
+    """
+    failed = await find_full_scans()
+    if failed:
+        raise SystemExit(f"Запросы без индекса: {', '.join(failed)}")
+    logging.info("Все запросы используют индексы")
+
+
+async def reconcile_subscriptions():
+    """
+    Пересчитывает счётчики подписчиков и подписок по таблице подписок. Закэшированные профили обновятся
+    не позже чем через PROFILE_CACHE_TTL
+    """
+    await User.reconcile_subscriptions()
+    logging.info("Счётчики подписок пересчитаны")
+
+
+async def prune_notifications():
+    """
+    Удаляет уведомления старше NOTIFICATION_RETENTION_DAYS дней. Запускается по расписанию, например, из cron
+    """
+    deleted = await Notification.prune(timezone.now() - timedelta(days=NOTIFICATION_RETENTION_DAYS))
+    logging.info(f"Удалено старых уведомлений: {deleted}")
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "check_queries": check_queries,
+    "rebuild_timelines": rebuild_timelines,
+    "reconcile_likes": reconcile_likes,
+    "reconcile_subscriptions": reconcile_subscriptions,
+    "prune_notifications": prune_notifications,
+}
+
+
+async def run(command: str):
+    await Tortoise.init(db_url=db_url, modules={'models': MODELS_MODULES})
+    await COMMANDS[command]()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Служебные команды Moments")
+    parser.add_argument("command", choices=COMMANDS.keys())
+    run_async(run(parser.parse_args().command))
@@ -0,0 +1,130 @@
+"""
+Миграции схемы БД. Каждая миграция - модуль с корутиной upgrade(connection), применённые миграции записываются
+в таблицу schema_migrations. Запуск: python manage.py migrate
+"""
+import importlib
+import logging
+from typing import Type
+
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import OperationalError
+from tortoise.models import Model
+
+# Миграции в порядке применения. Новые миграции добавляются только в конец
+MIGRATIONS = [
+    "m0001_initial",
+    "m0002_timelines",
+    "m0003_like_counters",
+    "m0004_upload_variants",
+    "m0005_cursor_indexes",
+    "m0006_subscription_indexes",
+    "m0007_tag_trends",
+    "m0008_subscription_counters",
+    "m0009_notification_watermark",
+]
+
+
+async def migrate() -> None:
+    """
+    Применяет ещё не применённые миграции
+    """
+    connection = Tortoise.get_connection("default")
+    await connection.execute_script(
+        "CREATE TABLE IF NOT EXISTS schema_migrations (name VARCHAR(255) NOT NULL PRIMARY KEY)"
+    )
+    applied = {row["name"] for row in await connection.execute_query_dict("SELECT name FROM schema_migrations")}
+    for name in MIGRATIONS:
+        if name in applied:
+            continue
+        logging.info(f"Применяется миграция {name}")
+        await importlib.import_module(f"migrations.{name}").upgrade(connection)
+        # Имена миграций - константы из MIGRATIONS, поэтому их можно подставить в запрос
+        await connection.execute_script(f"INSERT INTO schema_migrations (name) VALUES ('{name}')")
+    logging.info("Схема БД в актуальном состоянии")
+
+
+async def has_column(connection: BaseDBAsyncClient, model: Type[Model], column: str) -> bool:
+    """
+    Проверяет, есть ли в таблице модели колонка. Работает на любой поддерживаемой БД
+    """
+    quote = connection.schema_generator(connection).quote
+    try:
+        # Имя колонки уточняется таблицей: иначе SQLite примет несуществующую колонку в кавычках за строку
+        table = quote(model._meta.db_table)
+        await connection.execute_query(f"SELECT {table}.{quote(column)} FROM {table} WHERE 1 = 0")
+        return True
+    except OperationalError:
+        return False
+
+
+async def add_column(connection: BaseDBAsyncClient, model: Type[Model], field: str, definition: str) -> None:
+    """
+    Добавляет колонку поля модели, если её ещё нет (таблица могла быть создана уже с ней)
+    :param connection: подключение к БД
+    :param model: модель
+    :param field: имя поля модели
+    :param definition: определение колонки после её типа, например "NOT NULL DEFAULT 0"
+    """
+    column = model._meta.fields_map[field].source_field or field
+    if await has_column(connection, model, column):
+        return
+    quote = connection.schema_generator(connection).quote
+    sql_type = model._meta.fields_map[field].get_for_dialect(connection.capabilities.dialect, "SQL_TYPE")
+    await connection.execute_script(
+        f"ALTER TABLE {quote(model._meta.db_table)} ADD COLUMN {quote(column)} {sql_type} {definition}"
+    )
+
+
+async def create_index(connection: BaseDBAsyncClient, model: Type[Model], fields: tuple[str, ...],
+                       unique: bool = False) -> None:
+    """
+    Создаёт индекс, если его ещё нет. Имя индекса совпадает с тем, что даёт generate_schemas для новых таблиц
+    :param connection: подключение к БД
+    :param model: модель
+    :param fields: поля модели
+    :param unique: уникальный индекс
+    """
+    generator = connection.schema_generator(connection)
+    columns = [model._meta.fields_map[field].source_field or field for field in fields]
+    name = generator._generate_index_name("uid" if unique else "idx", model, columns)
+    # MySQL не умеет CREATE INDEX IF NOT EXISTS - там уже существующий индекс даёт ошибку, которую пропускаем
+    exists = "" if connection.capabilities.dialect == "mysql" else "IF NOT EXISTS "
+    sql = (f"CREATE {'UNIQUE ' if unique else ''}INDEX {exists}{generator.quote(name)} "
+           f"ON {generator.quote(model._meta.db_table)} ({', '.join(generator.quote(column) for column in columns)})")
+    try:
+        await connection.execute_script(sql)
+    except OperationalError:
+        if exists:
+            raise
+        logging.info(f"Индекс {name} уже существует")
+
+
+async def drop_index(connection: BaseDBAsyncClient, model: Type[Model], fields: tuple[str, ...]) -> None:
+    """
+    Удаляет индекс, созданный generate_schemas или create_index, если он есть
+    :param connection: подключение к БД
+    :param model: модель
+    :param fields: поля модели
+    """
+    generator = connection.schema_generator(connection)
+    columns = [model._meta.fields_map[field].source_field or field if field in model._meta.fields_map else field
+               for field in fields]
+    name = generator.quote(generator._generate_index_name("idx", model, columns))
+    if connection.capabilities.dialect == "mysql":
+        # MySQL не умеет DROP INDEX IF EXISTS
+        try:
+            await connection.execute_script(f"DROP INDEX {name} ON {generator.quote(model._meta.db_table)}")
+        except OperationalError:
+            logging.info(f"Индекса {name} уже нет")
+    else:
+        await connection.execute_script(f"DROP INDEX IF EXISTS {name}")
+
+
+async def create_declared_indexes(connection: BaseDBAsyncClient) -> None:
+    """
+    Создаёт индексы из Meta.indexes всех моделей. generate_schemas создаёт их только вместе с таблицей
+    """
+    for model in Tortoise.apps["models"].values():
+        for fields in model._meta.indexes:
+            await create_index(connection, model, tuple(fields))
@@ -0,0 +1,10 @@
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Создаёт недостающие таблицы вместе с их индексами. На пустой БД создаёт всю схему, на БД, созданной
+    до появления миграций, - только таблицы, появившиеся позже (ленты)
+    """
+    await Tortoise.generate_schemas(safe=True)
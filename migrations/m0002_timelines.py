@@ -0,0 +1,14 @@
+import logging
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import add_column
+from models.User import User
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Добавляет признак автора, чьи моменты читаются в ленту при запросе. Таблицы лент создаёт m0001
+    """
+    await add_column(connection, User, "fanout_on_read", "NOT NULL DEFAULT FALSE")
+    logging.info("Ленты нужно собрать: python manage.py rebuild_timelines")
@@ -0,0 +1,16 @@
+import logging
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import add_column
+from models.Comment import Comment
+from models.Moment import Moment
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Добавляет счётчики лайков моментов и комментариев
+    """
+    await add_column(connection, Moment, "likes_count", "NOT NULL DEFAULT 0")
+    await add_column(connection, Comment, "likes_count", "NOT NULL DEFAULT 0")
+    logging.info("Счётчики лайков нужно пересчитать: python manage.py reconcile_likes")
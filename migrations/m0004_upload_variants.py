@@ -0,0 +1,12 @@
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import add_column
+from models.Upload import Upload
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Добавляет уменьшенные варианты картинок
+    """
+    # У картинок, загруженных до появления вариантов, вариантов нет (см. Upload.filenames)
+    await add_column(connection, Upload, "variants", "NULL")
@@ -0,0 +1,10 @@
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import create_declared_indexes
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Создаёт индексы под постраничную выдачу по курсору (created_at, id)
+    """
+    await create_declared_indexes(connection)
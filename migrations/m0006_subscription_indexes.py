@@ -0,0 +1,21 @@
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import create_declared_indexes, create_index
+from models.Subscription import Subscription
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Добавляет уникальность подписок и индексы под запросы из routes/
+    """
+    # Раньше повторная подписка проверялась только в коде, поэтому перед созданием уникального индекса
+    # оставляем самую раннюю из повторяющихся подписок
+    quote = connection.schema_generator(connection).quote
+    table = quote(Subscription._meta.db_table)
+    await connection.execute_script(
+        f"DELETE FROM {table} WHERE {quote('id')} NOT IN "
+        f"(SELECT id FROM (SELECT MIN({quote('id')}) AS id FROM {table} "
+        f"GROUP BY {quote('subscriber_id')}, {quote('author_id')}) AS keep)"
+    )
+    await create_index(connection, Subscription, ("subscriber", "author"), unique=True)
+    await create_declared_indexes(connection)
@@ -0,0 +1,9 @@
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Создаёт таблицу почасовой статистики тегов
+    """
+    await Tortoise.generate_schemas(safe=True)
@@ -0,0 +1,13 @@
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from migrations import add_column
+from models.User import User
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Добавляет счётчики подписчиков и подписок и заполняет их по таблице подписок
+    """
+    await add_column(connection, User, "followers_count", "NOT NULL DEFAULT 0")
+    await add_column(connection, User, "subscriptions_count", "NOT NULL DEFAULT 0")
+    await User.reconcile_subscriptions()
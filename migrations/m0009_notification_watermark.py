@@ -0,0 +1,36 @@
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.functions import Max
+
+from handlers.CounterHandler import write_counters
+from migrations import add_column, create_index, drop_index, has_column
+from models.Notification import Notification
+from models.User import User
+
+
+async def upgrade(connection: BaseDBAsyncClient) -> None:
+    """
+    Заменяет флаг read у каждого уведомления отметкой последнего прочитанного уведомления у пользователя
+    """
+    await add_column(connection, User, "last_read_notification_id", "NOT NULL DEFAULT 0")
+    await create_index(connection, Notification, ("recipient", "id"))
+    quote = connection.schema_generator(connection).quote
+    table = quote(Notification._meta.db_table)
+    if not await has_column(connection, Notification, "read"):
+        return
+
+    # Отметка ставится перед самым старым непрочитанным уведомлением, а если таких нет - на последнее уведомление.
+    # Прочитанные уведомления новее отметки снова станут непрочитанными: раньше их отмечали только все сразу,
+    # поэтому такое бывает лишь у тех, кто получил уведомление во время отметки
+    watermarks = {recipient_id: last for recipient_id, last in await (Notification
+                                                                     .annotate(last=Max("id"))
+                                                                     .group_by("recipient_id")
+                                                                     .values_list("recipient_id", "last"))}
+    for row in await connection.execute_query_dict(
+            f"SELECT {quote('recipient_id')} AS recipient_id, MIN({quote('id')}) AS first_unread FROM {table} "
+            f"WHERE {quote('read')} = {'FALSE' if connection.capabilities.dialect == 'postgres' else '0'} "
+            f"GROUP BY {quote('recipient_id')}"):
+        watermarks[row["recipient_id"]] = row["first_unread"] - 1
+    await write_counters(User, "last_read_notification_id", watermarks, connection)
+
+    await drop_index(connection, Notification, ("recipient", "read", "created_at"))
+    await connection.execute_script(f"ALTER TABLE {table} DROP COLUMN {quote('read')}")
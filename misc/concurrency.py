@@ -0,0 +1,66 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from misc.metrics import metrics
+
+T = TypeVar("T")
+
+
+class Overloaded(Exception):
+    """
+    Очередь на выполнение переполнена (хэширование паролей, загрузка уведомлений при подключении), запрос нужно
+    повторить позже
+    """
+
+
+class Limiter:
+    """
+    Ограничивает число одновременно выполняемых операций. Операции сверх max_concurrent ждут своей очереди,
+    а сверх max_pending сразу получают Overloaded: так всплеск запросов не копится в памяти и не упирается в БД
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_pending: int):
+        """
+        :param name: название для метрик
+        :param max_concurrent: сколько операций выполняется одновременно
+        :param max_pending: сколько операций может выполняться и ждать своей очереди
+        """
+        self.name = name
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_pending = max_pending
+        self._pending = 0
+
+    async def run(self, func: Callable[[], Awaitable[T]]) -> T:
+        if self._pending >= self.max_pending:
+            metrics.incr(f"{self.name}.rejected")
+            raise Overloaded()
+        self._pending += 1
+        try:
+            async with self.semaphore:
+                return await func()
+        finally:
+            self._pending -= 1
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные загрузки одного и того же: пока загрузка по ключу идёт, остальные вызовы с этим ключом
+    ждут её результата вместо того, чтобы запускать свою
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        :param key: ключ загрузки
+        :param func: загрузка, запускается, только если по ключу ничего не загружается
+        :return: результат загрузки (общий для всех ожидающих)
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        # Отмена одного ожидающего не должна отменять загрузку для остальных
+        return await asyncio.shield(call)
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO
+
+from misc.images import remove_files
+
+
+class DiskCache:
+    """
+    Кэш файлов на диске ограниченного размера, давно использованные файлы вытесняются. Файл попадает в кэш
+    переименованием уже дописанного временного файла, поэтому читатели никогда не видят его частично.
+    Каталог могут делить несколько процессов: каждый следит за размером по своему списку файлов, а файл,
+    удалённый другим процессом, считается промахом. Методы обращаются к диску, поэтому их вызывают из пула потоков
+    (asyncio.to_thread), и список файлов защищён блокировкой
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        """
+        :param directory: каталог кэша
+        :param max_size: наибольший суммарный размер файлов в байтах
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # После перезапуска подхватываем уже скачанные файлы, от давно изменённых к недавним
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.startswith("."):
+                # Временный файл: свежий может прямо сейчас дописывать другой процесс, а старый остался
+                # от загрузки, прерванной перезапуском
+                if entry.stat().st_mtime < time.time() - 3600:
+                    remove_files([entry.path])
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._size += size
+        self._evict()
+
+    def _path(self, name: str) -> str | None:
+        # Имена файлов приходят из БД, но выйти за пределы каталога кэша не должно ни одно из них
+        if not name or name.startswith(".") or os.path.basename(name) != name:
+            return None
+        return os.path.join(self.directory, name)
+
+    def open(self, name: str) -> BinaryIO | None:
+        """
+        Открывает файл из кэша. Открытый файл можно дочитать, даже если его тут же вытеснят
+        :param name: имя файла
+        :return: файл, открытый на чтение в двоичном режиме, либо None
+        """
+        path = self._path(name)
+        if path is None:
+            return None
+        with self._lock:
+            if name not in self._files:
+                return None
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            # Файл вытеснил другой процесс
+            with self._lock:
+                self._size -= self._files.pop(name, 0)
+            return None
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+        return file
+
+    def temporary(self) -> tuple[int, str]:
+        """
+        Создаёт временный файл в каталоге кэша, чтобы потом положить его в кэш переименованием
+        :return: (дескриптор, путь)
+        """
+        return tempfile.mkstemp(dir=self.directory, prefix=".part-")
+
+    def put(self, name: str, temporary_path: str) -> None:
+        """
+        Кладёт дописанный временный файл в кэш
+        :param name: имя файла
+        :param temporary_path: путь, полученный из temporary()
+        """
+        path = self._path(name)
+        if path is None:
+            remove_files([temporary_path])
+            return
+        size = os.path.getsize(temporary_path)
+        os.replace(temporary_path, path)
+        with self._lock:
+            self._size += size - self._files.pop(name, 0)
+            self._files[name] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_size and self._files:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            remove_files([os.path.join(self.directory, name)])
@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+
+def make_variants(source_path: str, sizes: dict[str, int | None]) -> dict[str, str]:
+    """
+    Проверяет, что файл - целая картинка, и пережимает её в несколько размеров. Выполняется в пуле процессов,
+    поэтому картинка передаётся путём к файлу, а не содержимым. Метаданные (в т.ч. EXIF с геопозицией) в варианты
+    не попадают
+    :param source_path: путь к исходной картинке
+    :param sizes: {название варианта: максимальная сторона в пикселях либо None, чтобы сохранить размер}
+    :return: {название варианта: путь к временному файлу варианта}. Удалить файлы должен вызывающий
+    """
+    variants = {}
+    try:
+        # verify() проверяет структуру файла без декодирования пикселей, но после него картинку нужно открыть заново
+        with Image.open(source_path) as image:
+            image.verify()
+        with Image.open(source_path) as image:
+            # Поворот из EXIF применяем к пикселям, так как сам EXIF будет отброшен
+            image = ImageOps.exif_transpose(image)
+            has_alpha = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+            image_format, extension = ("PNG", "png") if has_alpha else ("JPEG", "jpg")
+            for name, size in sizes.items():
+                variant = image.copy()
+                if size is not None:
+                    variant.thumbnail((size, size))
+                descriptor, path = tempfile.mkstemp(suffix=f".{extension}")
+                variants[name] = path
+                with os.fdopen(descriptor, "wb") as output:
+                    variant.save(output, image_format, optimize=True, quality=85)
+    except Exception:
+        remove_files(variants.values())
+        raise
+    return variants
+
+
+def remove_files(paths) -> None:
+    """
+    Удаляет временные файлы, не обращая внимания на уже удалённые
+    :param paths: пути к файлам
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
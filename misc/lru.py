@@ -0,0 +1,39 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    LRU-кэш в памяти процесса, записи которого живут ограниченное время. Используется как быстрый уровень перед
+    memcached: его нельзя сбросить из другого процесса, поэтому время жизни записей должно быть коротким
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: сколько записей хранить, самые давно использованные вытесняются
+        :param ttl: время жизни записи по умолчанию, в секундах
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Счётчики и таймеры в памяти процесса. Каждый воркер считает своё, сводить значения по воркерам должен тот,
+    кто их собирает
+    """
+
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        self.timers: dict[str, dict[str, float]] = {}
+        self.gauges: dict[str, float] = {}
+
+    def incr(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Учитывает длительность операции
+        :param name: название таймера
+        :param seconds: длительность в секундах
+        """
+        timer = self.timers.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timer["count"] += 1
+        timer["total"] += seconds
+        timer["max"] = max(timer["max"], seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timers": {name: dict(timer) for name, timer in self.timers.items()},
+        }
+
+
+metrics = Metrics()
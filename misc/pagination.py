@@ -0,0 +1,108 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+from starlette import status
+from tortoise.expressions import Q
+from tortoise.queryset import QuerySet
+
+try:
+    from config import PAGE_SIZE, MAX_PAGE_SIZE
+except ModuleNotFoundError:
+    from config_example import PAGE_SIZE, MAX_PAGE_SIZE
+
+Cursor = tuple[datetime, int]
+
+
+def encode_position(position) -> str:
+    """
+    Упаковывает позицию в списке в непрозрачную для клиента строку
+    :param position: позиция (любое значение, которое сериализуется в JSON)
+    :return: курсор
+    """
+    raw = json.dumps(position).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_position(cursor: str):
+    """
+    Распаковывает курсор, полученный от клиента. Некорректный курсор - ошибка 400
+    :param cursor: курсор
+    :return: позиция, упакованная encode_position
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    """
+    :param created_at: время создания последнего полученного объекта
+    :param id: айди последнего полученного объекта
+    :return: курсор
+    """
+    return encode_position([created_at.isoformat(), id])
+
+
+def decode_cursor(cursor: str | None) -> Cursor | None:
+    """
+    :param cursor: курсор из encode_cursor либо None (== с самого начала списка)
+    :return: (время создания, айди) либо None
+    """
+    if not cursor:
+        return None
+    try:
+        created_at, id = decode_position(cursor)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+
+
+def page_size(limit: int | None) -> int:
+    """
+    :param limit: размер страницы, запрошенный клиентом
+    :return: размер страницы в пределах от 1 до MAX_PAGE_SIZE
+    """
+    return PAGE_SIZE if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def after(cursor: Cursor | None, created_field: str = "created_at", id_field: str = "id") -> Q:
+    """
+    Условие "строго после курсора" для списка, отсортированного от новых к старым
+    :param cursor: распакованный курсор либо None
+    :param created_field: поле времени создания
+    :param id_field: поле айди
+    """
+    if cursor is None:
+        return Q()
+    created_at, id = cursor
+    return Q(**{f"{created_field}__lt": created_at}) | Q(**{created_field: created_at, f"{id_field}__lt": id})
+
+
+async def paginate(queryset: QuerySet, cursor: str | None, limit: int | None, *values: str,
+                   created_field: str = "created_at", id_field: str = "id") -> tuple[list, str | None]:
+    """
+    Keyset-пагинация от новых объектов к старым. Страница выбирается условием по (created_at, id), а не смещением,
+    поэтому с составным индексом (..., created_at, id) дальние страницы стоят столько же, сколько первая
+    :param queryset: отфильтрованный запрос
+    :param cursor: курсор из предыдущего ответа либо None
+    :param limit: размер страницы
+    :param values: какие поля вернуть (как в values_list). Если поле одно, возвращаются сами значения
+    :param created_field: поле времени создания
+    :param id_field: поле айди
+    :return: (страница, курсор следующей страницы либо None, если страница последняя)
+    """
+    limit = page_size(limit)
+    rows = await (queryset
+                  .filter(after(decode_cursor(cursor), created_field, id_field))
+                  .order_by(f"-{created_field}", f"-{id_field}")
+                  # Лишняя строка показывает, есть ли следующая страница
+                  .limit(limit + 1)
+                  .values_list(created_field, id_field, *values))
+    next_cursor = encode_cursor(*rows[limit - 1][:2]) if len(rows) > limit else None
+    rows = rows[:limit]
+    if len(values) == 1:
+        return [row[2] for row in rows], next_cursor
+    return [row[2:] for row in rows], next_cursor
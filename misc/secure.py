@@ -1,31 +1,92 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import itsdangerous
 from passlib.hash import pbkdf2_sha256
 
+from misc.concurrency import Limiter
+from misc.metrics import metrics
+
 try:
-    from config import TOKEN_SECRET_KEY
+    from config import TOKEN_SECRET_KEY, PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
 except ModuleNotFoundError:
-    from config_example import TOKEN_SECRET_KEY
+    from config_example import TOKEN_SECRET_KEY, PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
 
 # Эта штука под капотом даже автоматически генерирует соль
 token_generator = itsdangerous.URLSafeSerializer(TOKEN_SECRET_KEY)
 
+# Раньше все пароли хэшировались с общей солью - такие хэши пересчитываются при входе пользователя
+_legacy_salt = bytes(TOKEN_SECRET_KEY, encoding="utf8")
+
 
-def crypt(string: str) -> str:
+class PasswordHasher:
     """
-    Хэширует строку
-    :param string: пароль или иная строка
-    :return: хэш пароля
+    Хэширует и сверяет пароли в пуле потоков, чтобы PBKDF2 не блокировал event loop (hashlib отпускает GIL на время
+    вычисления). Число ожидающих хэширования паролей ограничено (см. misc.concurrency.Limiter): при всплеске попыток
+    входа лишние запросы сразу получают отказ, а не выстраиваются в бесконечную очередь
     """
-    return pbkdf2_sha256.using(salt=bytes(TOKEN_SECRET_KEY, encoding="utf8"), rounds=1000).hash(string)
 
+    def __init__(self, rounds: int, max_workers: int, max_pending: int):
+        """
+        :param rounds: число итераций PBKDF2 для новых хэшей. Хэши с меньшим числом итераций пересчитываются при входе
+        :param max_workers: сколько паролей хэшируется одновременно
+        :param max_pending: сколько паролей может хэшироваться и ждать своей очереди, остальные получают Overloaded
+        """
+        # Соль генерируется заново для каждого хэша и хранится в нём самом
+        self.context = pbkdf2_sha256.using(rounds=rounds, min_desired_rounds=rounds)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password")
+        self.limiter = Limiter("password_hash", max_workers, max_pending)
+        self._dummy_hash: str | None = None
 
-def verify(string: str, hashed: str) -> bool:
-    """
-    Сверяет хэш строки с данным хэшом
-    :param string: строка, для которой проверяем хэш
-    :param hashed: сверяемый хэш
-    :return: True/False
-    """
-    return pbkdf2_sha256.using(salt=bytes(TOKEN_SECRET_KEY, encoding="utf8"), rounds=1000).verify(string, hashed)
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        result = await self.limiter.run(lambda: loop.run_in_executor(self.executor, func, *args))
+        # Время включает ожидание свободного потока - именно столько хэширование добавляет к ответу
+        metrics.observe("password_hash", time.perf_counter() - started)
+        return result
+
+    async def hash(self, password: str) -> str:
+        """
+        Хэширует пароль
+        :param password: пароль
+        :return: хэш пароля с собственной солью
+        """
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> tuple[bool, str | None]:
+        """
+        Сверяет пароль с хэшом
+        :param password: пароль
+        :param hashed: сверяемый хэш
+        :return: (совпал ли пароль, новый хэш, если сохранённый устарел, иначе None)
+        """
+        return await self._run(self._verify, password, hashed)
+
+    def _verify(self, password: str, hashed: str) -> tuple[bool, str | None]:
+        try:
+            if not self.context.verify(password, hashed):
+                return False, None
+        except ValueError:
+            # Строка не является хэшом pbkdf2_sha256
+            return False, None
+        if self.context.needs_update(hashed) or self.context.from_string(hashed).salt == _legacy_salt:
+            return True, self.context.hash(password)
+        return True, None
+
+    async def dummy_verify(self, password: str) -> None:
+        """
+        Сверяет пароль с заранее посчитанным хэшом, чтобы вход под несуществующим пользователем занимал
+        столько же времени, сколько вход с неверным паролем, и не выдавал, какие логины заняты
+        :param password: пароль
+        """
+        if self._dummy_hash is None:
+            self._dummy_hash = await self.hash("")
+        await self._run(self._verify, password, self._dummy_hash)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
 
 
+password_hasher = PasswordHasher(PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
@@ -0,0 +1,55 @@
+import re
+
+# Типы слов в тексте
+TEXT = "text"
+MENTION = "mention"
+TAG = "tag"
+
+# Из упоминаний и тегов вырезается всё, кроме букв, цифр и подчёркивания
+_name_cleaner = re.compile(r'[^a-zA-Zа-яА-Я0-9_]')
+
+
+def normalize(part: str) -> str:
+    """
+    Приводит слово к имени пользователя или тега: вырезает всё, кроме букв, цифр и подчёркивания
+    :param part: слово, например "@User," или "#Tag"
+    :return: имя, например "user" или "tag"
+    """
+    return _name_cleaner.sub('', part).lower()
+
+
+def tokenize(text: str) -> list[tuple[str, str, str]]:
+    """
+    Разбивает текст на слова и находит среди них упоминания пользователей и теги
+    :param text: текст момента или комментария
+    :return: список (тип слова, исходное слово, нормализованное имя пользователя или тега)
+    """
+    tokens = []
+    for part in text.split():
+        if part[0] == "@":
+            tokens.append((MENTION, part, normalize(part)))
+        elif part[0] == "#" and 1 < len(part) < 102:
+            tokens.append((TAG, part, normalize(part)))
+        else:
+            tokens.append((TEXT, part, ''))
+    return tokens
+
+
+def names(tokens: list[tuple[str, str, str]], kind: str) -> list[str]:
+    """
+    Возвращает уникальные непустые имена слов заданного типа в порядке их появления в тексте
+    :param tokens: результат tokenize
+    :param kind: тип слова (MENTION или TAG)
+    :return: список имён
+    """
+    return list(dict.fromkeys(name for token_kind, _, name in tokens if token_kind == kind and name))
+
+
+def prefix_range(prefix: str) -> dict[str, str]:
+    """
+    Условие "начинается с prefix" в виде диапазона значений. В отличие от LIKE, диапазон использует обычный
+    индекс по полю в любой БД
+    :param prefix: непустой нормализованный префикс
+    :return: {"gte": prefix, "lt": первая строка после всех строк с этим префиксом}
+    """
+    return {"gte": prefix, "lt": prefix[:-1] + chr(ord(prefix[-1]) + 1)}
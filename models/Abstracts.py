@@ -1,4 +1,5 @@
-from tortoise import fields
+from tortoise import connections, fields
+from tortoise.backends.base.client import BaseDBAsyncClient
 from tortoise.models import Model
 
 
@@ -10,3 +11,26 @@ class CreateTimestamp(Model):
 
     class Meta:
         abstract = True
+
+    @classmethod
+    async def create_or_ignore(cls, using_db: BaseDBAsyncClient | None = None, **kwargs) -> bool:
+        """
+        Создаёт объект одним запросом INSERT ... ON CONFLICT DO NOTHING (INSERT IGNORE в MySQL). В отличие от
+        get_or_create не бывает гонки между проверкой и вставкой: дубликат отсекает уникальный индекс
+        :param using_db: соединение (например, транзакция)
+        :param kwargs: поля объекта
+        :return: True, если объект создан, и False, если такой уже есть
+        """
+        db = using_db or connections.get(cls._meta.default_connection)
+        instance = cls(**kwargs)
+        executor = db.executor_class(model=cls, db=db)
+        projection = cls._meta.fields_db_projection
+        fields_names = [name for name in projection if not cls._meta.fields_map[name].generated]
+        # Запрос собирается публичным API pypika: в MySQL on_conflict().do_nothing() превращается в INSERT IGNORE
+        query = (db.query_class.into(cls._meta.basetable)
+                 .columns(*(projection[name] for name in fields_names))
+                 .insert(*(executor.parameter(i) for i in range(len(fields_names))))
+                 .on_conflict().do_nothing())
+        values = [executor.column_map[name](getattr(instance, name), instance) for name in fields_names]
+        rows, _ = await db.execute_query(str(query), values)
+        return rows > 0
@@ -1,21 +1,34 @@
-import re
 from html import escape
 
 from tortoise import fields
 from tortoise.backends.base.client import TransactionContext
+from tortoise.functions import Count
+from tortoise.transactions import in_transaction
 
+from handlers.CacheHandler import cache
+from handlers.CounterHandler import write_counters
+from misc.tokenizer import tokenize, names, MENTION
 from models.Abstracts import CreateTimestamp
+from models.CommentLike import CommentLike
 from models.User import User
 
+try:
+    from config import COMMENTS_COUNT_TTL
+except ModuleNotFoundError:
+    from config_example import COMMENTS_COUNT_TTL
+
 
 class Comment(CreateTimestamp):
     id = fields.IntField(pk=True)
     author = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE)
     moment = fields.ForeignKeyField("models.Moment", on_delete=fields.CASCADE)
     text = fields.CharField(max_length=1024)
+    # Денормализованное число лайков, поддерживается в routes/like.py
+    likes_count = fields.IntField(default=0)
 
     class Meta:
         unique_together = ("moment", "author")
+        indexes = (("moment", "created_at", "id"),)
 
     @staticmethod
     async def parser(text: str, connection: TransactionContext | None = None) -> tuple[str, list[User]]:
@@ -25,22 +38,85 @@ class Comment(CreateTimestamp):
         :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
         :return: HTML-raw готовый комментарий, список упоминаний
         """
-        users: list[User] = []
-        text = text.split()
+        tokens = tokenize(text)
+        # Все упоминания ищем разом, а не по одному запросу на слово
+        users = await User.get_by_nicknames(names(tokens, MENTION), connection)
         escaped_description = []
-        # Проводим всё в транзакции
-        for part in text:
-            if part[0] == "@":
-                # Упоминание другого пользователя
-                string = re.sub(r'[^a-zA-Zа-яА-Я0-9]', '', part).lower()
-                user = await User.get_or_none(nickname=string, using_db=connection)
-                if user is not None:
-                    users.append(user)
-                    escaped_description.append(f'<a href="/user/{user.id}">{part}</a>')
-                else:
-                    escaped_description.append(escape(part, quote=True))
+        for kind, part, name in tokens:
+            if kind == MENTION and name in users:
+                escaped_description.append(f'<a href="/user/{users[name].id}">{escape(part, quote=True)}</a>')
             else:
                 escaped_description.append(escape(part, quote=True))
 
-        return ' '.join(escaped_description), users
+        return ' '.join(escaped_description), list(users.values())
+
+    @staticmethod
+    async def hydrate(comment_ids: list[int], user: User) -> list[dict]:
+        """
+        Собирает информацию о нескольких комментариях за фиксированное число запросов: комментарии вместе
+        с никнеймами авторов и лайки пользователя. Число лайков денормализовано в likes_count
+        :param comment_ids: айди комментариев
+        :param user: пользователь, от лица которого запрашивается информация
+        :return: информация о комментариях в порядке comment_ids (несуществующие комментарии пропускаются)
+        """
+        if not comment_ids:
+            return []
+        comments = {comment["id"]: comment for comment in await (Comment
+                                                                 .filter(id__in=comment_ids)
+                                                                 .values("id", "author_id", "author__nickname",
+                                                                         "text", "likes_count"))}
+        liked = set(await (CommentLike
+                           .filter(author=user, object_id__in=list(comments))
+                           .values_list("object_id", flat=True)))
+        return [
+            {
+                "id": comment["id"],
+                "author": comment["author_id"],
+                "author_nickname": comment["author__nickname"],
+                "text": comment["text"],
+                "likes": comment["likes_count"],
+                "liked": comment["id"] in liked
+            }
+            for comment in (comments[comment_id] for comment_id in comment_ids if comment_id in comments)
+        ]
+
+    @staticmethod
+    async def get_count(moment_id: int) -> int:
+        """
+        Возвращает число комментариев под моментом. Счётчик кэшируется и поддерживается при создании и удалении
+        комментариев
+        :param moment_id: айди момента
+        :return: число комментариев
+        """
+        cached = await cache.get(f"moment_comments:{moment_id}")
+        if cached is not None:
+            return int(cached)
+        # Cache miss
+        count = await Comment.filter(moment_id=moment_id).count()
+        await cache.set(f"moment_comments:{moment_id}", str(count), expire=COMMENTS_COUNT_TTL)
+        return count
+
+    @staticmethod
+    async def change_count(moment_id: int, delta: int) -> None:
+        """
+        Учитывает созданный или удалённый комментарий в закэшированном счётчике. Вызывается после коммита
+        :param moment_id: айди момента
+        :param delta: 1 при создании, -1 при удалении
+        """
+        if delta > 0:
+            await cache.incr(f"moment_comments:{moment_id}", delta)
+        else:
+            await cache.decr(f"moment_comments:{moment_id}", -delta)
 
+    @staticmethod
+    async def reconcile_likes() -> None:
+        """
+        Пересчитывает likes_count всех комментариев по таблице лайков
+        """
+        async with in_transaction() as connection:
+            likes = dict(await (CommentLike
+                                .annotate(count=Count("id"))
+                                .group_by("object_id")
+                                .using_db(connection)
+                                .values_list("object_id", "count")))
+            await write_counters(Comment, "likes_count", likes, connection)
@@ -1,11 +1,30 @@
-import re
+import json
+from datetime import datetime
 from html import escape
-from tortoise import fields
+
+from fastapi import HTTPException
+from starlette import status
+from tortoise import fields, timezone
 from tortoise.backends.base.client import TransactionContext
+from tortoise.exceptions import DoesNotExist
+from tortoise.functions import Count
+from tortoise.transactions import in_transaction
 
+from handlers.CacheHandler import cache
+from handlers.CounterHandler import CounterBuffer, write_counters
+from misc.lru import TTLCache
+from misc.pagination import decode_position, encode_position, page_size
+from misc.tokenizer import tokenize, names, MENTION, TAG
 from models.Abstracts import CreateTimestamp
+from models.MomentLike import MomentLike
 from models.User import User
 from models.Tag import Tag
+from models.TagMoment import TagMoment
+
+try:
+    from config import VIEWS_FLUSH_INTERVAL, VIEWS_MAX_BUFFER, SEARCH_WINDOW
+except ModuleNotFoundError:
+    from config_example import VIEWS_FLUSH_INTERVAL, VIEWS_MAX_BUFFER, SEARCH_WINDOW
 
 
 class Moment(CreateTimestamp):
@@ -14,9 +33,15 @@ class Moment(CreateTimestamp):
     title = fields.CharField(max_length=128)
     description = fields.CharField(max_length=4096)
     views = fields.IntField(default=0)
+    # Денормализованное число лайков, поддерживается в routes/like.py
+    likes_count = fields.IntField(default=0)
     picture = fields.ForeignKeyField("models.Upload", on_delete=fields.CASCADE)
     tags = fields.ManyToManyField("models.Tag", related_name="moments", through='tagmoment')
 
+    class Meta:
+        # Под keyset-пагинацию моментов автора (см. misc.pagination)
+        indexes = (("author", "created_at", "id"),)
+
     @staticmethod
     async def parser(description: str,
                      connection: TransactionContext | None = None) -> tuple[str, list[Tag], list[User]]:
@@ -26,32 +51,185 @@ class Moment(CreateTimestamp):
         :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
         :return: HTML-raw готовое описание, список тегов, список упоминаний
         """
-        users = []
-        tags = []
-        description = description.split()
+        tokens = tokenize(description)
+        # Все упоминания и теги ищем разом, а не по одному запросу на слово
+        users = await User.get_by_nicknames(names(tokens, MENTION), connection)
+        tags = await Tag.get_or_create_many(names(tokens, TAG), connection)
         escaped_description = []
-        # Проводим всё в транзакции
-        for part in description:
-            if part[0] == "@":
-                # Упоминание другого пользователя
-                string = re.sub(r'[^a-zA-Zа-яА-Я0-9_]', '', part).lower()
-                user = await User.get_or_none(nickname=string, using_db=connection)
-                if user is not None:
-                    users.append(user)
-                    escaped_description.append(f'<a href="/user/{user.id}">{part}</a>')
-                else:
-                    escaped_description.append(escape(part, quote=True))
-            elif part[0] == "#" and 1 < len(part) < 102:
-                # Тэг
-                string = re.sub(r'[^a-zA-Zа-яА-Я0-9_]', '', part).lower()
-                tag = (await Tag.get_or_create(name=string, using_db=connection))[0]
-                tags.append(tag)
-                escaped_description.append(part)
+        for kind, part, name in tokens:
+            if kind == MENTION and name in users:
+                escaped_description.append(f'<a href="/user/{users[name].id}">{escape(part, quote=True)}</a>')
             else:
                 escaped_description.append(escape(part, quote=True))
 
-        return ' '.join(escaped_description), tags, users
+        return ' '.join(escaped_description), tags, list(users.values())
+
+    @staticmethod
+    async def hydrate(moment_ids: list[int], user: User | None) -> list[dict]:
+        """
+        Собирает информацию о нескольких моментах за фиксированное число запросов
+        :param moment_ids: айди моментов
+        :param user: пользователь, от лица которого запрашивается информация (None для неавторизованного)
+        :return: информация о моментах в порядке moment_ids (несуществующие моменты пропускаются)
+        """
+        if not moment_ids:
+            return []
+        moments = {moment.id: moment for moment in await Moment.filter(id__in=moment_ids)}
+        ids = list(moments)
+        tags: dict[int, list[str]] = {moment_id: [] for moment_id in ids}
+        for moment_id, tag_name in await TagMoment.filter(moment_id__in=ids).values_list("moment_id", "tag__name"):
+            tags[moment_id].append(tag_name)
+        liked = set()
+        if user is not None:
+            liked = set(await MomentLike.filter(author=user, object_id__in=ids).values_list("object_id", flat=True))
+        # Каждую выдачу момента будем считать как один просмотр. При этом пользователь может посмотреть момент
+        # несколько раз - на это ограничений нет (похожим образом сделано, к примеру, в ютубе, хотя, конечно же,
+        # было бы неплохо добавить защиту от накрутки просмотров). В БД просмотры попадают через буфер
+        view_counter.hit(ids)
+        return [
+            {
+                "id": moment.id,
+                "title": moment.title,
+                "description": moment.description,
+                "likes": moment.likes_count,
+                "views": moment.views + view_counter.pending(moment.id),
+                "tags": tags[moment.id],
+                "author": moment.author_id,
+                "liked": moment.id in liked
+            }
+            for moment in (moments[moment_id] for moment_id in moment_ids if moment_id in moments)
+        ]
+
+    @staticmethod
+    async def search(tag_names: list[str], match_all: bool, order: str, cursor: str | None = None,
+                     limit: int | None = None) -> tuple[list[int], str | None]:
+        """
+        Ищет моменты по тегам. Каждый запрос читает ограниченное число строк, поэтому время ответа не зависит
+        от числа моментов с тегом. Страница при поиске по всем тегам может оказаться короче limit (и даже пустой):
+        это значит, что в просмотренном окне совпадений больше нет, а следующее окно откроет next_cursor
+        :param tag_names: нормализованные имена тегов
+        :param match_all: True - моменты со всеми тегами, False - хотя бы с одним
+        :param order: "recent" - от новых к старым, "rank" - по лайкам с поправкой на свежесть
+        :param cursor: курсор из предыдущего ответа
+        :param limit: размер страницы
+        :return: (айди моментов, курсор следующей страницы либо None)
+        """
+        limit = page_size(limit)
+        position = None
+        if cursor:
+            # Курсор хранит порядок выдачи, для которого он выдан: смещение в рейтинге или айди момента.
+            # bool - подкласс int, поэтому тип сравнивается точно
+            position = decode_position(cursor)
+            if not (isinstance(position, list) and len(position) == 2 and position[0] == order
+                    and type(position[1]) is int and position[1] >= 0):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+            position = position[1]
+        tags = dict(await Tag.filter(name__in=tag_names).values_list("name", "id"))
+        if not tags or match_all and len(tags) < len(tag_names):
+            return [], None
+
+        if order == "rank":
+            # Ранжируем окно самых новых совпадений целиком, страницы - это срезы ранжированного окна
+            offset = position or 0
+            moments, _ = await Moment._search_window(list(tags.values()), match_all, None, SEARCH_WINDOW)
+            ranked = Moment.rank(await Moment.filter(id__in=moments).values_list("id", "likes_count", "created_at"))
+            next_cursor = encode_position([order, offset + limit]) if len(ranked) > offset + limit else None
+            return ranked[offset:offset + limit], next_cursor
+
+        moments, exhausted = await Moment._search_window(list(tags.values()), match_all, position, limit + 1)
+        if len(moments) > limit:
+            return moments[:limit], encode_position([order, moments[limit - 1]])
+        # Совпадений в окне меньше limit, но за окном они ещё могут быть
+        return moments, encode_position([order, exhausted]) if exhausted is not None else None
+
+    @staticmethod
+    async def _search_window(tag_ids: list[int], match_all: bool, before: int | None,
+                             limit: int) -> tuple[list[int], int | None]:
+        """
+        Находит самые новые моменты с тегами
+        :param tag_ids: айди тегов
+        :param match_all: True - моменты со всеми тегами, False - хотя бы с одним
+        :param before: искать только моменты старше этого
+        :param limit: сколько моментов нужно
+        :return: (айди моментов от новых к старым, самый старый просмотренный момент, если просмотрено
+            не всё и поиск можно продолжить с него, иначе None)
+        """
+        if not match_all:
+            # Первые limit моментов объединения лежат среди первых limit моментов каждого тега
+            moments = set()
+            for tag_id in tag_ids:
+                moments.update(await TagMoment.latest(tag_id, before, limit))
+            return sorted(moments, reverse=True)[:limit], None
+        # Идём по окну моментов первого тега и оставляем те, у которых есть остальные теги
+        window = await TagMoment.latest(tag_ids[0], before, SEARCH_WINDOW)
+        others = tag_ids[1:]
+        if others and window:
+            matched = dict(await (TagMoment
+                                  .filter(moment_id__in=window, tag_id__in=others)
+                                  .annotate(tags=Count("tag_id", distinct=True))
+                                  .group_by("moment_id")
+                                  .values_list("moment_id", "tags")))
+            moments = [moment_id for moment_id in window if matched.get(moment_id) == len(others)]
+        else:
+            moments = window
+        return moments[:limit], window[-1] if len(window) == SEARCH_WINDOW else None
+
+    @staticmethod
+    def rank(moments: list[tuple[int, int, datetime]]) -> list[int]:
+        """
+        Сортирует моменты по лайкам с поправкой на свежесть: лайки делятся на возраст момента в степени 1.5,
+        поэтому новый момент с парой лайков обгоняет старый с десятком
+        :param moments: (айди, число лайков, время создания)
+        :return: айди моментов от лучших к худшим
+        """
+        now = timezone.now()
+
+        def score(moment: tuple[int, int, datetime]) -> float:
+            _, likes, created_at = moment
+            hours = max((now - created_at).total_seconds(), 0) / 3600
+            return (likes + 1) / (hours + 2) ** 1.5
 
+        return [moment[0] for moment in sorted(moments, key=score, reverse=True)]
 
+    @staticmethod
+    async def get_picture_filename(moment_id: int, size: str = "original") -> str:
+        """
+        Возвращает имя файла картинки момента в S3. Картинка момента не меняется, поэтому кэшируется надолго
+        :param moment_id: айди момента
+        :param size: вариант картинки (см. IMAGE_VARIANTS)
+        :return: имя файла. Для картинок, загруженных до появления вариантов, - имя исходной картинки
+        """
+        filenames = picture_cache.get(moment_id)
+        if filenames is None:
+            cached = await cache.get(f"moment_pictures:{moment_id}")
+            if cached is None:
+                # Cache miss
+                pictures = await Moment.filter(id=moment_id).values_list("picture__filename", "picture__variants")
+                if not pictures:
+                    raise DoesNotExist
+                filename, variants = pictures[0]
+                filenames = {"original": filename, **(variants or {})}
+                await cache.set(f"moment_pictures:{moment_id}", json.dumps(filenames), expire=24 * 3600)
+            else:
+                filenames = json.loads(cached)
+            picture_cache.set(moment_id, filenames)
+        return filenames.get(size, filenames["original"])
+
+    @staticmethod
+    async def reconcile_likes() -> None:
+        """
+        Пересчитывает likes_count всех моментов по таблице лайков
+        """
+        async with in_transaction() as connection:
+            likes = dict(await (MomentLike
+                                .annotate(count=Count("id"))
+                                .group_by("object_id")
+                                .using_db(connection)
+                                .values_list("object_id", "count")))
+            await write_counters(Moment, "likes_count", likes, connection)
 
 
+# Имена файлов картинок моментов
+picture_cache = TTLCache(maxsize=10000, ttl=3600)
+# Буфер просмотров моментов
+view_counter = CounterBuffer(Moment, "views", VIEWS_FLUSH_INTERVAL, VIEWS_MAX_BUFFER)
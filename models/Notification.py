@@ -1,22 +1,41 @@
-import logging
+import asyncio
+import json
+import time
+from datetime import datetime
 
-from cent import CentException
 from fastapi import BackgroundTasks
 from tortoise import fields
 from tortoise.backends.base.client import TransactionContext
+from tortoise.expressions import Subquery
+from tortoise.transactions import in_transaction
 
-
-from handlers.CentrifugoHandler import cent_client
+from handlers.CacheHandler import cache
+from handlers.CentrifugoHandler import notification_dispatcher
+from misc.concurrency import Limiter, SingleFlight
+from misc.metrics import metrics
 from models.Abstracts import CreateTimestamp
 from models.User import User
 
+try:
+    from config import (UNREAD_COUNT_TTL, NOTIFICATION_PRUNE_BATCH, CONNECT_CACHE_TTL, CONNECT_MAX_CONCURRENT,
+                        CONNECT_MAX_PENDING)
+except ModuleNotFoundError:
+    from config_example import (UNREAD_COUNT_TTL, NOTIFICATION_PRUNE_BATCH, CONNECT_CACHE_TTL, CONNECT_MAX_CONCURRENT,
+                                CONNECT_MAX_PENDING)
+
 
 class Notification(CreateTimestamp):
+    """
+    Уведомление пользователя. Прочитанность хранится не в уведомлении, а отметкой у получателя
+    (User.last_read_notification_id): непрочитанные - это уведомления с айди больше отметки
+    """
     id = fields.IntField(pk=True)
     text = fields.CharField(max_length=1024)
-    read = fields.BooleanField(default=False)
     recipient = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE)
 
+    class Meta:
+        indexes = (("recipient", "created_at", "id"), ("recipient", "id"))
+
     @staticmethod
     async def send_notification(user: User, html_text: str, background: BackgroundTasks,
                                 connection: TransactionContext | None = None):
@@ -26,40 +45,196 @@ class Notification(CreateTimestamp):
         :param html_text: Html-содержимое уведомления
         :param background: фоновый контекст FastAPI
         :param connection: Подключение, которое следует использовать (указание на транзакцию извне этой функции)
-        :return: Notification
         """
-        notification = await Notification.create(text=html_text, recipient=user, using_db=connection)
-        background.add_task(Notification.cent_send_notification, user, notification.text)
+        await Notification.send_notifications_bulk([user], html_text, background, connection)
 
     @staticmethod
-    async def cent_send_notification(user: User, text: str):
+    async def send_notifications_bulk(users: list[User], html_text: str, background: BackgroundTasks,
+                                      connection: TransactionContext | None = None):
         """
-        Отправляет подписчику на уведомления текст уведомления в centrifugo
-        :param user: пользователь, которому нужно отправить уведомление
+        Отправка одного и того же уведомления нескольким пользователям: все уведомления записываются одним запросом,
+        а в centrifugo уходят одной командой. Каждый пользователь получает уведомление один раз, даже если
+        встречается в списке несколько раз
+        :param users: пользователи, которым надо отправить уведомление
+        :param html_text: Html-содержимое уведомления
+        :param background: фоновый контекст FastAPI
+        :param connection: Подключение, которое следует использовать (указание на транзакцию извне этой функции)
+        """
+        recipients = list({user.id: user for user in users}.values())
+        if not recipients:
+            return
+        await Notification.bulk_create([Notification(text=html_text, recipient=user) for user in recipients],
+                                       using_db=connection)
+        background.add_task(Notification.cent_send_notifications, [user.id for user in recipients], html_text)
+        # Кэш непрочитанных обновляем уже после коммита, чтобы откат транзакции его не испортил
+        background.add_task(Notification.update_unread_cache, [user.id for user in recipients])
+
+    @staticmethod
+    async def cent_send_notifications(user_ids: list[int], text: str):
+        """
+        Отправляет подписчикам на уведомления текст уведомления в centrifugo
+        :param user_ids: айди пользователей, которым нужно отправить уведомление
         :param text: содержание уведомления
         """
-        try:
-            cent_client.publish(f"personal_notifications:{user.id}", {"data": text})
-        except CentException as e:
-            # Ошибка некритична, но её стоит отследить
-            logging.error(e, exc_info=True)
+        # Публикация только ставится в очередь, ошибки отправки логирует диспетчер
+        notification_dispatcher.broadcast([f"personal_notifications:{user_id}" for user_id in user_ids],
+                                          {"data": text})
+
+    @staticmethod
+    async def update_unread_cache(user_ids: list[int]) -> None:
+        """
+        Учитывает новое уведомление в закэшированных счётчиках непрочитанных и сбрасывает закэшированные
+        непрочитанные уведомления. Если счётчика в кэше нет, он будет посчитан по БД при следующем запросе
+        :param user_ids: айди получателей
+        """
+        await Notification._bump_unread_generation(user_ids)
+        await asyncio.gather(*(cache.incr(f"unread_notifications:{user_id}") for user_id in user_ids),
+                             *(cache.delete(f"unread_payload:{user_id}") for user_id in user_ids))
+
+    @staticmethod
+    async def _bump_unread_generation(user_ids: list[int]) -> None:
+        # Вызывается после коммита и до обновления кэша, см. _cache_unread
+        await asyncio.gather(*(cache.incr(f"unread_generation:{user_id}") for user_id in user_ids))
+
+    @staticmethod
+    async def _unread_generation(user_id: int) -> str:
+        """
+        Поколение закэшированных непрочитанных уведомлений пользователя. Меняется при каждом новом уведомлении и
+        прочтении, поэтому загрузка из БД может узнать, что её обогнала запись
+        :param user_id: айди пользователя
+        :return: поколение, запомненное до чтения из БД
+        """
+        generation = await cache.get(f"unread_generation:{user_id}")
+        if generation is None:
+            # Уникальное значение: поколение, вытесненное из кэша и заведённое заново, не совпадёт с прежним
+            generation = str(time.time_ns())
+            await cache.set(f"unread_generation:{user_id}", generation)
+        return generation
+
+    @staticmethod
+    async def _cache_unread(user_id: int, key: str, value: str, expire: int, generation: str) -> None:
+        """
+        Кладёт в кэш значение, посчитанное по БД. Если за время подсчёта пришло или было прочитано уведомление,
+        значение могло устареть, и его удаляет либо запись, либо эта проверка после сохранения
+        :param user_id: айди пользователя
+        :param key: ключ кэша
+        :param value: значение
+        :param expire: время жизни в секундах
+        :param generation: поколение, запомненное до чтения из БД (см. _unread_generation)
+        """
+        await cache.set(key, value, expire=expire)
+        if await cache.get(f"unread_generation:{user_id}") != generation:
+            await cache.delete(key)
 
     @staticmethod
-    async def get_unread_notifications(user: User):
+    def unread(user_id: int):
+        """
+        Непрочитанные уведомления пользователя. Отметка прочтения читается из БД в том же запросе, поэтому
+        закэшированный снимок пользователя не может вернуть уже прочитанные уведомления
+        :param user_id: айди пользователя
+        :return: QuerySet
+        """
+        watermark = User.filter(id=user_id).values("last_read_notification_id")
+        return Notification.filter(recipient_id=user_id, id__gt=Subquery(watermark))
+
+    @staticmethod
+    async def get_unread_notifications(user_id: int):
         # Будем отправлять не более 10 уведомлений за раз. Кроме содержимого уведомлений больше ничего не нужно
         return await (Notification
-                      .filter(recipient=user, read=False)
-                      .order_by("-created_at")
+                      .unread(user_id)
+                      .order_by("-id")
                       .limit(10)
                       .values_list("text"))
 
+    @staticmethod
+    async def get_unread_snapshot(user_id: int) -> list:
+        """
+        Последние непрочитанные уведомления для подключения к centrifugo. Берутся из кэша, а при промахе
+        загружаются из БД: одновременные подключения одного пользователя ждут одной загрузки, а число загрузок
+        ограничено, чтобы массовое переподключение после перезапуска centrifugo не положило БД.
+        Может выбросить misc.concurrency.Overloaded
+        :param user_id: айди пользователя
+        :return: то же, что и get_unread_notifications
+        """
+        cached = await cache.get(f"unread_payload:{user_id}")
+        if cached is not None:
+            metrics.incr("notification_connect.cache_hit")
+            return json.loads(cached)
+        metrics.incr("notification_connect.cache_miss")
+        return await unread_loads.do(user_id, lambda: connect_limiter.run(
+            lambda: Notification._load_unread_snapshot(user_id)))
+
+    @staticmethod
+    async def _load_unread_snapshot(user_id: int) -> list:
+        generation = await Notification._unread_generation(user_id)
+        notifications = [list(row) for row in await Notification.get_unread_notifications(user_id)]
+        await Notification._cache_unread(user_id, f"unread_payload:{user_id}", json.dumps(notifications),
+                                         CONNECT_CACHE_TTL, generation)
+        return notifications
+
+    @staticmethod
+    async def get_unread_count(user: User) -> int:
+        """
+        Возвращает число непрочитанных уведомлений. Счётчик кэшируется и поддерживается при отправке и прочтении
+        уведомлений
+        :param user: пользователь
+        :return: число непрочитанных уведомлений
+        """
+        cached = await cache.get(f"unread_notifications:{user.id}")
+        if cached is not None:
+            return int(cached)
+        # Cache miss
+        generation = await Notification._unread_generation(user.id)
+        count = await Notification.unread(user.id).count()
+        await Notification._cache_unread(user.id, f"unread_notifications:{user.id}", str(count), UNREAD_COUNT_TTL,
+                                         generation)
+        return count
+
     @staticmethod
     async def set_read_all(user: User):
-        # Помечаем все уведомления прочитанными
-        await (Notification
-               .filter(recipient=user, read=False)
-               .update(read=True))
+        # Помечаем все уведомления прочитанными: сдвигаем отметку на последнее уведомление пользователя
+        async with in_transaction() as connection:
+            last = await (Notification
+                          .filter(recipient=user)
+                          .order_by("-id")
+                          .using_db(connection)
+                          .first()
+                          .values_list("id", flat=True))
+            if last is not None:
+                # Отметка только растёт - параллельный запрос с более старым уведомлением её не откатит
+                await (User
+                       .filter(id=user.id, last_read_notification_id__lt=last)
+                       .using_db(connection)
+                       .update(last_read_notification_id=last))
+        # Кэш не обнуляем, а удаляем уже после коммита: уведомление, пришедшее между сдвигом отметки и сбросом кэша,
+        # иначе потерялось бы в счётчике. Следующее чтение посчитает непрочитанные по БД
+        await Notification._bump_unread_generation([user.id])
+        await cache.delete(f"unread_notifications:{user.id}")
+        await cache.delete(f"unread_payload:{user.id}")
         # Очищаем историю
-        cent_client.history_remove(f"personal_notifications:{user.id}")
+        notification_dispatcher.history_remove(f"personal_notifications:{user.id}")
+
+    @staticmethod
+    async def prune(before: datetime) -> int:
+        """
+        Удаляет уведомления, созданные раньше before. Удаление идёт пачками по NOTIFICATION_PRUNE_BATCH, чтобы
+        не держать долгих блокировок
+        :param before: граница хранения
+        :return: сколько уведомлений удалено
+        """
+        deleted = 0
+        while True:
+            # Айди растут вместе со временем создания, поэтому старые уведомления находятся в начале первичного ключа
+            ids = await (Notification
+                         .filter(created_at__lt=before)
+                         .order_by("id")
+                         .limit(NOTIFICATION_PRUNE_BATCH)
+                         .values_list("id", flat=True))
+            if not ids:
+                return deleted
+            deleted += await Notification.filter(id__in=ids).delete()
 
 
+# Загрузки непрочитанных уведомлений при подключении к centrifugo
+unread_loads = SingleFlight()
+connect_limiter = Limiter("notification_connect", CONNECT_MAX_CONCURRENT, CONNECT_MAX_PENDING)
@@ -7,3 +7,8 @@ class Subscription(CreateTimestamp):
     id = fields.IntField(pk=True)
     author = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name="author_subscriptions")
     subscriber = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name="subscriptions")
+
+    class Meta:
+        unique_together = ("subscriber", "author")
+        # Подписчики автора: счётчик и обход пачками при раскладке ленты (см. models.Timeline)
+        indexes = (("author", "id"),)
@@ -1,7 +1,43 @@
+from tortoise.backends.base.client import TransactionContext
 from tortoise.models import Model
 from tortoise import fields
 
+from misc.tokenizer import prefix_range
+
 
 class Tag(Model):
     id = fields.IntField(pk=True)
     name = fields.CharField(max_length=100, unique=True)
+
+    @staticmethod
+    async def get_or_create_many(names: list[str], connection: TransactionContext | None = None) -> list["Tag"]:
+        """
+        Находит теги по именам, недостающие создаёт одним запросом
+        :param names: уникальные имена тегов
+        :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
+        :return: теги в порядке names
+        """
+        if not names:
+            return []
+        tags = {tag.name: tag for tag in await Tag.filter(name__in=names).using_db(connection)}
+        missing = [name for name in names if name not in tags]
+        if missing:
+            # Тег может успеть создать параллельный запрос, поэтому конфликты игнорируем и перечитываем теги
+            await Tag.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True, using_db=connection)
+            tags.update({tag.name: tag for tag in await Tag.filter(name__in=missing).using_db(connection)})
+        return [tags[name] for name in names if name in tags]
+
+    @staticmethod
+    async def autocomplete(prefix: str, limit: int) -> list[str]:
+        """
+        Подсказывает теги по началу имени
+        :param prefix: нормализованное начало имени тега
+        :param limit: сколько тегов вернуть
+        :return: имена тегов в алфавитном порядке
+        """
+        bounds = prefix_range(prefix)
+        return await (Tag
+                      .filter(name__gte=bounds["gte"], name__lt=bounds["lt"])
+                      .order_by("name")
+                      .limit(limit)
+                      .values_list("name", flat=True))
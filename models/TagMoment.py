@@ -4,3 +4,21 @@ from tortoise import Model, fields
 class TagMoment(Model):
     moment = fields.ForeignKeyField('models.Moment', on_delete=fields.CASCADE)
     tag = fields.ForeignKeyField('models.Tag', on_delete=fields.CASCADE)
+
+    class Meta:
+        indexes = (("tag", "moment"), ("moment", "tag"))
+
+    @staticmethod
+    async def latest(tag_id: int, before: int | None, limit: int) -> list[int]:
+        """
+        Возвращает самые новые моменты с тегом. Айди моментов растут со временем их создания, поэтому порядок
+        по айди - это порядок по времени, который читается прямо из индекса (tag, moment)
+        :param tag_id: айди тега
+        :param before: вернуть только моменты старше этого (None == с самого нового)
+        :param limit: сколько моментов вернуть
+        :return: айди моментов от новых к старым
+        """
+        moments = TagMoment.filter(tag_id=tag_id)
+        if before is not None:
+            moments = moments.filter(moment_id__lt=before)
+        return await moments.order_by("-moment_id").limit(limit).values_list("moment_id", flat=True)
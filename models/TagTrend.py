@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+
+from tortoise import fields, timezone
+from tortoise.expressions import F
+from tortoise.models import Model
+
+from handlers.CacheHandler import cache
+from misc.lru import TTLCache
+from models.Tag import Tag
+
+try:
+    from config import TREND_WINDOW_HOURS, TREND_HALF_LIFE_HOURS, TREND_TOP, TREND_REFRESH_INTERVAL
+except ModuleNotFoundError:
+    from config_example import TREND_WINDOW_HOURS, TREND_HALF_LIFE_HOURS, TREND_TOP, TREND_REFRESH_INTERVAL
+
+
+def hour_start(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+class TagTrend(Model):
+    """
+    Сколько моментов с тегом выложено за час. Старые часы удаляются при пересчёте популярных тегов
+    """
+    id = fields.IntField(pk=True)
+    tag = fields.ForeignKeyField("models.Tag", on_delete=fields.CASCADE, related_name=False)
+    # Начало часа
+    bucket = fields.DatetimeField()
+    count = fields.IntField(default=0)
+
+    class Meta:
+        unique_together = ("tag", "bucket")
+        indexes = (("bucket",),)
+
+    @staticmethod
+    async def record(tags: list[Tag]) -> None:
+        """
+        Учитывает новый момент с тегами. Вызывается в фоне после создания момента, чтобы не держать транзакцию
+        создания на блокировке строк популярных тегов
+        :param tags: теги момента
+        """
+        if not tags:
+            return
+        bucket = hour_start(timezone.now())
+        # Строки текущего часа могли ещё не существовать - создаём недостающие, а затем увеличиваем все разом
+        await TagTrend.bulk_create([TagTrend(tag=tag, bucket=bucket) for tag in tags], ignore_conflicts=True)
+        await TagTrend.filter(tag_id__in=[tag.id for tag in tags], bucket=bucket).update(count=F("count") + 1)
+
+    @staticmethod
+    async def refresh() -> list[dict]:
+        """
+        Пересчитывает популярные теги за последние TREND_WINDOW_HOURS часов и кладёт их в кэш. Вклад каждого часа
+        затухает вдвое за TREND_HALF_LIFE_HOURS часов, поэтому свежие теги обгоняют вчерашние
+        :return: [{"name": имя тега, "score": очки}] от самых популярных
+        """
+        now = timezone.now()
+        since = hour_start(now) - timedelta(hours=TREND_WINDOW_HOURS)
+        await TagTrend.filter(bucket__lt=since).delete()
+        scores: dict[str, float] = {}
+        for name, bucket, count in await TagTrend.filter(bucket__gte=since).values_list("tag__name", "bucket", "count"):
+            age = max((now - bucket).total_seconds(), 0) / 3600
+            scores[name] = scores.get(name, 0) + count * 0.5 ** (age / TREND_HALF_LIFE_HOURS)
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:TREND_TOP]
+        trending = [{"name": name, "score": round(score, 3)} for name, score in top]
+        await cache.set("trending_tags", json.dumps(trending), expire=TREND_REFRESH_INTERVAL * 3)
+        trending_cache.set("trending_tags", trending)
+        return trending
+
+
+class TrendingTags:
+    """
+    Периодический пересчёт популярных тегов. Запрос популярных тегов читает только кэш
+    """
+
+    def __init__(self, refresh_interval: float):
+        """
+        :param refresh_interval: как часто пересчитывать популярные теги, в секундах
+        """
+        self.refresh_interval = refresh_interval
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await TagTrend.refresh()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            await asyncio.sleep(self.refresh_interval)
+
+    @staticmethod
+    async def get(limit: int) -> list[dict]:
+        """
+        Возвращает популярные теги из кэша
+        :param limit: сколько тегов вернуть (не больше TREND_TOP)
+        :return: [{"name": имя тега, "score": очки}] от самых популярных
+        """
+        trending = trending_cache.get("trending_tags")
+        if trending is None:
+            cached = await cache.get("trending_tags")
+            # Пока фоновый пересчёт ни разу не выполнился, популярных тегов нет
+            trending = json.loads(cached) if cached is not None else []
+            trending_cache.set("trending_tags", trending)
+        return trending[:limit]
+
+
+# Популярные теги в памяти процесса: обновляются пересчётом раз в TREND_REFRESH_INTERVAL секунд
+trending_cache = TTLCache(maxsize=1, ttl=TREND_REFRESH_INTERVAL)
+trending_tags = TrendingTags(TREND_REFRESH_INTERVAL)
@@ -0,0 +1,214 @@
+import logging
+
+from fastapi import BackgroundTasks
+from tortoise import fields
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.expressions import Q
+from tortoise.functions import Count
+from tortoise.models import Model
+
+from misc.pagination import after, decode_cursor, encode_cursor, page_size
+from models.Moment import Moment
+from models.Subscription import Subscription
+from models.User import User
+
+try:
+    from config import (FEED_FANOUT_SYNC_LIMIT, FEED_FANOUT_PULL_THRESHOLD, FEED_FANOUT_BATCH_SIZE,
+                        FEED_BACKFILL_SIZE)
+except ModuleNotFoundError:
+    from config_example import (FEED_FANOUT_SYNC_LIMIT, FEED_FANOUT_PULL_THRESHOLD, FEED_FANOUT_BATCH_SIZE,
+                                FEED_BACKFILL_SIZE)
+
+
+class Timeline(Model):
+    """
+    Предрассчитанная лента пользователя: по одной записи на каждый момент, который он должен увидеть в ленте
+    """
+    id = fields.IntField(pk=True)
+    owner = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name="timeline")
+    author = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name=False)
+    moment = fields.ForeignKeyField("models.Moment", on_delete=fields.CASCADE, related_name=False)
+    # Время создания момента, а не записи в ленте
+    created_at = fields.DatetimeField()
+
+    class Meta:
+        unique_together = ("owner", "moment")
+        indexes = (("owner", "created_at", "moment"),)
+
+    @staticmethod
+    async def distribute(moment: Moment, author: User, background: BackgroundTasks) -> None:
+        """
+        Раскладывает новый момент по лентам подписчиков автора (fan-out-on-write)
+        :param moment: новый момент
+        :param author: автор момента
+        :param background: фоновый контекст FastAPI
+        """
+        # Автор пришёл из закэшированного снимка, поэтому флаг и число подписчиков перечитываем из БД -
+        # одним запросом по первичному ключу вместо подсчёта подписок
+        fanout_on_read, followers = await (User
+                                           .filter(id=author.id)
+                                           .first()
+                                           .values_list("fanout_on_read", "followers_count"))
+        if fanout_on_read:
+            # Подписчики получат момент при чтении ленты
+            return
+        if followers >= FEED_FANOUT_PULL_THRESHOLD:
+            # Автор стал слишком крупным - переводим его на подмешивание при чтении
+            background.add_task(Timeline.switch_to_pull, author)
+        elif followers > FEED_FANOUT_SYNC_LIMIT:
+            background.add_task(Timeline.push, moment)
+        else:
+            await Timeline.push(moment)
+
+    @staticmethod
+    async def push(moment: Moment) -> None:
+        """
+        Добавляет момент в ленты всех подписчиков его автора
+        :param moment: момент
+        """
+        last_subscription = 0
+        while True:
+            # Идём по подпискам пачками, чтобы не держать в памяти всех подписчиков крупного автора
+            batch = await (Subscription
+                           .filter(author_id=moment.author_id, id__gt=last_subscription)
+                           .order_by("id")
+                           .limit(FEED_FANOUT_BATCH_SIZE)
+                           .values_list("id", "subscriber_id"))
+            if not batch:
+                break
+            await Timeline.bulk_create([
+                Timeline(owner_id=subscriber_id, author_id=moment.author_id, moment_id=moment.id,
+                         created_at=moment.created_at)
+                for _, subscriber_id in batch
+            ], ignore_conflicts=True)
+            last_subscription = batch[-1][0]
+
+    @staticmethod
+    async def switch_to_pull(author: User) -> None:
+        """
+        Переводит автора на подмешивание его моментов в ленты при чтении (fan-out-on-read)
+        :param author: автор
+        """
+        # Сначала выставляем флаг, чтобы новые подписчики сразу получали TimelinePull при подписке. Флаг меняется
+        # условным UPDATE, поэтому при нескольких одновременных моментах автора переключение выполнится один раз
+        if not await User.filter(id=author.id, fanout_on_read=False).update(fanout_on_read=True):
+            return
+        await author.clear_cache()
+        last_subscription = 0
+        while True:
+            batch = await (Subscription
+                           .filter(author=author, id__gt=last_subscription)
+                           .order_by("id")
+                           .limit(FEED_FANOUT_BATCH_SIZE)
+                           .values_list("id", "subscriber_id"))
+            if not batch:
+                break
+            await TimelinePull.bulk_create([
+                TimelinePull(owner_id=subscriber_id, author_id=author.id) for _, subscriber_id in batch
+            ], ignore_conflicts=True)
+            last_subscription = batch[-1][0]
+        logging.info(f"Моменты автора {author.id} теперь подмешиваются в ленты при чтении")
+
+    @staticmethod
+    async def follow(owner_id: int, author: User, using_db: BaseDBAsyncClient | None = None) -> None:
+        """
+        Наполняет ленту пользователя моментами автора после подписки
+        :param owner_id: айди подписчика
+        :param author: автор, флаг fanout_on_read которого уже перечитан из БД
+        :param using_db: транзакция, в которой создаётся подписка
+        """
+        if author.fanout_on_read:
+            await TimelinePull.get_or_create(owner_id=owner_id, author_id=author.id, using_db=using_db)
+            return
+        moments = await (Moment
+                         .filter(author=author)
+                         .using_db(using_db)
+                         .order_by("-id")
+                         .limit(FEED_BACKFILL_SIZE)
+                         .values_list("id", "created_at"))
+        await Timeline.bulk_create([
+            Timeline(owner_id=owner_id, author_id=author.id, moment_id=moment_id, created_at=created_at)
+            for moment_id, created_at in moments
+        ], ignore_conflicts=True, using_db=using_db)
+
+    @staticmethod
+    async def unfollow(owner_id: int, author: User) -> None:
+        """
+        Убирает моменты автора из ленты пользователя после отписки
+        :param owner_id: айди подписчика
+        :param author: автор
+        """
+        await Timeline.filter(owner_id=owner_id, author=author).delete()
+        await TimelinePull.filter(owner_id=owner_id, author=author).delete()
+
+    @staticmethod
+    async def read(owner: User, cursor: str | None = None, limit: int | None = None) -> tuple[list[int], str | None]:
+        """
+        Возвращает страницу ленты пользователя
+        :param owner: пользователь
+        :param cursor: курсор из предыдущего ответа (None == с самого начала ленты)
+        :param limit: размер страницы
+        :return: (айди моментов от новых к старым, курсор следующей страницы либо None)
+        """
+        position, limit = decode_cursor(cursor), page_size(limit)
+        moments = await (Timeline
+                         .filter(Q(owner=owner) & after(position, id_field="moment_id"))
+                         .order_by("-created_at", "-moment_id")
+                         .limit(limit + 1)
+                         .values_list("created_at", "moment_id"))
+        # Крупных авторов немного, поэтому их моменты дешевле подмешать при чтении
+        pull_authors = await TimelinePull.filter(owner=owner).values_list("author_id", flat=True)
+        if pull_authors:
+            moments = sorted(set(moments) | set(await (Moment
+                                                       .filter(Q(author_id__in=pull_authors) & after(position))
+                                                       .order_by("-created_at", "-id")
+                                                       .limit(limit + 1)
+                                                       .values_list("created_at", "id"))), reverse=True)
+        next_cursor = encode_cursor(*moments[limit - 1]) if len(moments) > limit else None
+        return [moment_id for _, moment_id in moments[:limit]], next_cursor
+
+    @staticmethod
+    async def rebuild_all() -> None:
+        """
+        Заново собирает ленты всех пользователей по их подпискам
+        """
+        big_authors = await (Subscription
+                             .annotate(followers=Count("id"))
+                             .group_by("author_id")
+                             .filter(followers__gte=FEED_FANOUT_PULL_THRESHOLD)
+                             .values_list("author_id", flat=True))
+        await User.filter(id__in=big_authors).update(fanout_on_read=True)
+        # Авторы, у которых подписчиков стало меньше порога, возвращаются к раскладке при записи: их моменты
+        # попадут в ленты через follow ниже, а подмешивание при чтении больше не нужно
+        small_authors = await (User
+                               .filter(fanout_on_read=True)
+                               .exclude(id__in=big_authors)
+                               .values_list("id", flat=True))
+        if small_authors:
+            await User.filter(id__in=small_authors).update(fanout_on_read=False)
+            await TimelinePull.filter(author_id__in=small_authors).delete()
+        last_subscription = 0
+        while True:
+            batch = await (Subscription
+                           .filter(id__gt=last_subscription)
+                           .order_by("id")
+                           .limit(FEED_FANOUT_BATCH_SIZE)
+                           .prefetch_related("author"))
+            if not batch:
+                break
+            for subscription in batch:
+                await Timeline.follow(subscription.subscriber_id, subscription.author)
+            last_subscription = batch[-1].id
+        logging.info("Ленты пользователей пересобраны")
+
+
+class TimelinePull(Model):
+    """
+    Крупный автор, моменты которого не раскладываются по лентам подписчиков, а подмешиваются в ленту при чтении
+    """
+    id = fields.IntField(pk=True)
+    owner = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name="timeline_pulls")
+    author = fields.ForeignKeyField("models.User", on_delete=fields.CASCADE, related_name=False)
+
+    class Meta:
+        unique_together = ("owner", "author")
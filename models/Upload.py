@@ -5,4 +5,14 @@ from models.Abstracts import CreateTimestamp
 
 class Upload(CreateTimestamp):
     id = fields.IntField(pk=True)
+    # Имя исходной картинки в S3 (пережатой, без метаданных)
     filename = fields.CharField(max_length=1000)
+    # Уменьшенные варианты картинки: {название варианта: имя файла в S3}
+    variants = fields.JSONField(default=dict)
+
+    def filenames(self) -> dict[str, str]:
+        """
+        Возвращает имена файлов всех вариантов картинки, включая исходную (вариант "original")
+        :return: {название варианта: имя файла в S3}
+        """
+        return {"original": self.filename, **self.variants}
@@ -1,19 +1,36 @@
 import base64
+import hashlib
+import json
 import re
+from datetime import datetime
 from typing import Annotated
 
 from fastapi import Depends, HTTPException
 from itsdangerous import BadSignature
 from starlette import status
 from tortoise import fields
+from tortoise.backends.base.client import TransactionContext
 from tortoise.exceptions import DoesNotExist, ValidationError
+from tortoise.expressions import Q
+from tortoise.functions import Count
+from tortoise.transactions import in_transaction
 from tortoise.validators import MinLengthValidator
 
-from handlers.CacheHandler import mc
-from misc.secure import crypt, token_generator
+from handlers.CacheHandler import cache
+from handlers.CounterHandler import write_counters
+from misc.lru import TTLCache
+from misc.metrics import metrics
+from misc.secure import password_hasher, token_generator
+from misc.tokenizer import prefix_range
 from models.Abstracts import CreateTimestamp
+from models.Subscription import Subscription
 from models.validators import EmailValidator
 
+try:
+    from config import AUTH_CACHE_TTL, AUTH_LOCAL_CACHE_TTL, PROFILE_CACHE_TTL
+except ModuleNotFoundError:
+    from config_example import AUTH_CACHE_TTL, AUTH_LOCAL_CACHE_TTL, PROFILE_CACHE_TTL
+
 
 class User(CreateTimestamp):
     id = fields.IntField(pk=True)
@@ -23,20 +40,65 @@ class User(CreateTimestamp):
     avatar = fields.OneToOneField("models.Upload", on_delete=fields.SET_NULL, null=True, default=None)
     uploads = fields.ManyToManyField("models.Upload", on_delete=fields.SET_NULL)
     rating = fields.IntField(default=0)
+    # Моменты автора не раскладываются по лентам подписчиков, а подмешиваются в ленту при чтении (см. models.Timeline)
+    fanout_on_read = fields.BooleanField(default=False)
+    # Денормализованные счётчики подписчиков и подписок, поддерживаются в routes/subscription.py
+    followers_count = fields.IntField(default=0)
+    subscriptions_count = fields.IntField(default=0)
+    # Айди последнего прочитанного уведомления: непрочитанные - те, что новее (см. models.Notification)
+    last_read_notification_id = fields.IntField(default=0)
 
     @staticmethod
-    def crypt_password(password: str) -> str:
-        # Используем кэш
-        encrypted = mc.get(f"crypt_password:{password}")
-        if encrypted is None:
-            # Cache miss
-            encrypted = crypt(password)
-            mc.set(f"crypt_password:{password}", encrypted)
-            return encrypted
-        else:
-            return encrypted.decode("utf-8")
+    async def crypt_password(password: str) -> str:
+        """
+        Хэширует пароль с собственной солью. Может выбросить misc.concurrency.Overloaded
+        :param password: пароль
+        :return: хэш пароля
+        """
+        return await password_hasher.hash(password)
+
+    async def check_password(self, password: str) -> bool:
+        """
+        Сверяет пароль пользователя. Устаревший хэш (общая соль или меньше итераций, чем сейчас в настройках)
+        заменяется новым. Токены содержат хэш пароля, поэтому при такой замене остальные сессии пользователя
+        завершаются, как при смене пароля. Может выбросить misc.concurrency.Overloaded
+        :param password: пароль
+        :return: True/False
+        """
+        matches, new_hash = await password_hasher.verify(password, self.password)
+        if new_hash is not None:
+            metrics.incr("login.rehashed")
+            self.password = new_hash
+            await self.save(update_fields=["password"])
+            await self.clear_cache()
+        return matches
+
+    @staticmethod
+    async def authenticate(login: str, password: str) -> "User | None":
+        """
+        Находит пользователя по никнейму или почте одним запросом и сверяет пароль. Время ответа не зависит от того,
+        существует ли пользователь. Может выбросить misc.concurrency.Overloaded
+        :param login: никнейм или почта
+        :param password: пароль
+        :return: пользователь либо None, если логин или пароль неверны
+        """
+        login = login.lower().strip()
+        # Фильтр по полю проверяет значение его валидаторами, поэтому ищем только по тем полям, которым логин подходит
+        conditions = [Q(**{field: login}) for field in ("nickname", "email") if User.is_valid(field, login)]
+        users = await User.filter(Q(*conditions, join_type=Q.OR)).limit(2) if conditions else []
+        # Никнейм одного пользователя может совпасть с почтой другого - никнейм в приоритете, как и раньше
+        user = next((user for user in users if user.nickname == login), users[0] if users else None)
+        if user is None:
+            metrics.incr("login.unknown_user")
+            await password_hasher.dummy_verify(password)
+            return None
+        if not await user.check_password(password):
+            metrics.incr("login.wrong_password")
+            return None
+        metrics.incr("login.success")
+        return user
 
-    def get_token(self) -> str:
+    async def get_token(self) -> str:
         """
         Получить токен сессии
         :return: токен
@@ -44,39 +106,218 @@ class User(CreateTimestamp):
         # Пароль тоже включаем в нагрузку. Тогда если юзер сменит пароль на одном девайсе, то со всех остальных
         # он выйдет автоматически, т.к. старые токены перестанут работать.
         # Используем кэш
-        token = mc.get(f"user_token:{self.id}")
+        token = await cache.get(f"user_token:{self.id}")
         if token is None:
             # Cache miss
             token = token_generator.dumps({'id': self.id, 'password': self.password})
-            mc.set(f"user_token:{self.id}", token)
-            return token
+            await cache.set(f"user_token:{self.id}", token)
+        return token
+
+    @staticmethod
+    def is_valid(field: str, value) -> bool:
+        """
+        Проверяет значение валидаторами поля модели
+        :param field: имя поля
+        :param value: значение
+        :return: True/False
+        """
+        try:
+            User._meta.fields_map[field].validate(value)
+            return True
+        except ValidationError:
+            return False
+
+    @staticmethod
+    async def autocomplete(prefix: str, limit: int) -> list[dict]:
+        """
+        Подсказывает пользователей по началу никнейма
+        :param prefix: нормализованное начало никнейма
+        :param limit: сколько пользователей вернуть
+        :return: [{"id": ..., "nickname": ...}] в алфавитном порядке никнеймов
+        """
+        bounds = prefix_range(prefix)
+        if User.is_valid("nickname", bounds["gte"]):
+            users = User.filter(nickname__gte=bounds["gte"], nickname__lt=bounds["lt"])
         else:
-            return token.decode('utf-8')
+            # Фильтр проверяет значение валидаторами поля, а префикс короче минимального никнейма их не пройдёт.
+            # LIKE не проверяется, а сортировка по никнейму всё равно идёт по индексу
+            users = User.filter(nickname__startswith=prefix)
+        return await (users
+                      .order_by("nickname")
+                      .limit(limit)
+                      .values("id", "nickname"))
+
+    @staticmethod
+    async def get_by_nicknames(nicknames: list[str],
+                               connection: TransactionContext | None = None) -> dict[str, "User"]:
+        """
+        Находит пользователей по никнеймам одним запросом
+        :param nicknames: никнеймы
+        :param connection: подключение, которое следует использовать (указание на транзакцию извне этой функции)
+        :return: {никнейм: пользователь} для найденных пользователей
+        """
+        # Фильтр проверяет значения валидаторами поля: имя, которое не может быть никнеймом, сорвало бы весь запрос
+        nicknames = [nickname for nickname in nicknames if User.is_valid("nickname", nickname)]
+        if not nicknames:
+            return {}
+        return {user.nickname: user for user in await User.filter(nickname__in=nicknames).using_db(connection)}
 
     @staticmethod
     async def get_from_token(token: str):
         """
-        Возвращает пользователя из токена
+        Возвращает пользователя из токена. Снимок пользователя кэшируется, поэтому большинство запросов
+        обходится без обращения к БД
         :param token: токен
         :return: User
         """
         try:
             payload = token_generator.loads(token)
-            user = await User.get(id=payload.get('id'))
-            if user.password != payload.get('password'):
+            user_id, password = payload.get('id'), payload.get('password')
+            snapshot = auth_cache.get(user_id)
+            if snapshot is None:
+                cached = await cache.get(f"auth_user:{user_id}")
+                if cached is None:
+                    # Cache miss
+                    snapshot = (await User.get(id=user_id)).snapshot()
+                    await cache.set(f"auth_user:{user_id}", json.dumps(snapshot), expire=AUTH_CACHE_TTL)
+                else:
+                    snapshot = json.loads(cached)
+                auth_cache.set(user_id, snapshot)
+            if snapshot["password_version"] != password_version(password):
                 # Неверный пароль равносилен несуществующему пользователю
                 raise DoesNotExist
         except (DoesNotExist, BadSignature):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
         else:
-            return user
+            return User.from_snapshot(snapshot, password)
+
+    def snapshot(self) -> dict:
+        """
+        Снимок пользователя для кэша. Вместо хэша пароля хранится только его отпечаток
+        :return: поля пользователя, пригодные для JSON
+        """
+        snapshot = {}
+        for field in self._meta.fields_db_projection:
+            if field == "password":
+                continue
+            value = getattr(self, field)
+            snapshot[field] = value.isoformat() if isinstance(value, datetime) else value
+        snapshot["password_version"] = password_version(self.password)
+        return snapshot
+
+    @staticmethod
+    def from_snapshot(snapshot: dict, password: str) -> "User":
+        """
+        Восстанавливает пользователя из снимка. Снимок может немного отставать от БД, поэтому сохранять такого
+        пользователя следует только с update_fields
+        :param snapshot: снимок пользователя
+        :param password: хэш пароля (берётся из токена, прошедшего проверку)
+        :return: User
+        """
+        values = {field: value for field, value in snapshot.items() if field != "password_version"}
+        user = User(**values, password=password)
+        user._saved_in_db = True
+        return user
+
+    @staticmethod
+    async def get_from_token_optional(token: str | None = None):
+        """
+        То же, что и get_from_token, но для эндпоинтов, доступных и без авторизации
+        :param token: токен либо None
+        :return: User либо None
+        """
+        if token is None:
+            return None
+        return await User.get_from_token(token)
+
+    @staticmethod
+    async def get_avatar_filename(user_id: int, size: str = "original") -> str | None:
+        """
+        Возвращает имя файла аватарки пользователя в S3
+        :param user_id: айди пользователя
+        :param size: вариант картинки (см. IMAGE_VARIANTS)
+        :return: имя файла либо None, если аватарка не загружена
+        """
+        filenames = avatar_cache.get(user_id)
+        if filenames is None:
+            cached = await cache.get(f"user_avatars:{user_id}")
+            if cached is None:
+                # Cache miss
+                avatars = await User.filter(id=user_id).values_list("avatar__filename", "avatar__variants")
+                if not avatars:
+                    raise DoesNotExist
+                filename, variants = avatars[0]
+                # Отсутствие аватарки тоже кэшируем - пустым словарём
+                filenames = {"original": filename, **(variants or {})} if filename is not None else {}
+                await cache.set(f"user_avatars:{user_id}", json.dumps(filenames), expire=24 * 3600)
+            else:
+                filenames = json.loads(cached)
+            avatar_cache.set(user_id, filenames)
+        return filenames.get(size, filenames.get("original"))
+
+    async def clear_avatar_cache(self) -> None:
+        """
+        Удаляет имя файла аватарки пользователя из кэша. В других процессах оно проживёт не дольше avatar_cache.ttl
+        :return: None
+        """
+        avatar_cache.delete(self.id)
+        await cache.delete(f"user_avatars:{self.id}")
 
     async def clear_cache(self) -> None:
         """
-        Удаляет токен пользователя из кэша
+        Удаляет токен и снимок пользователя из кэша. В других процессах снимок проживёт не дольше auth_cache.ttl
         :return: None
         """
-        mc.delete(f"user_token:{self.id}")
+        auth_cache.delete(self.id)
+        await cache.delete(f"auth_user:{self.id}")
+        await cache.delete(f"user_token:{self.id}")
+
+    @staticmethod
+    async def get_profile(user_id: int) -> dict:
+        """
+        Возвращает профиль пользователя. Профиль кэшируется и сбрасывается при изменении данных или счётчиков
+        :param user_id: айди пользователя
+        :return: {"id", "email", "nickname", "rating", "reg_date", "followers", "subscriptions"}
+        """
+        cached = await cache.get(f"user_profile:{user_id}")
+        if cached is not None:
+            return json.loads(cached)
+        # Cache miss
+        user = await User.get(id=user_id)
+        profile = {
+            "id": user.id,
+            "email": user.email,
+            "nickname": user.nickname,
+            "rating": user.rating,
+            "reg_date": user.created_at.isoformat(),
+            "followers": user.followers_count,
+            "subscriptions": user.subscriptions_count,
+        }
+        await cache.set(f"user_profile:{user_id}", json.dumps(profile), expire=PROFILE_CACHE_TTL)
+        return profile
+
+    @staticmethod
+    async def clear_profile_cache(*user_ids: int) -> None:
+        """
+        Удаляет профили пользователей из кэша
+        :param user_ids: айди пользователей
+        """
+        for user_id in user_ids:
+            await cache.delete(f"user_profile:{user_id}")
+
+    @staticmethod
+    async def reconcile_subscriptions() -> None:
+        """
+        Пересчитывает followers_count и subscriptions_count всех пользователей по таблице подписок
+        """
+        async with in_transaction() as connection:
+            for field, group_by in (("followers_count", "author_id"), ("subscriptions_count", "subscriber_id")):
+                counts = dict(await (Subscription
+                                     .annotate(count=Count("id"))
+                                     .group_by(group_by)
+                                     .using_db(connection)
+                                     .values_list(group_by, "count")))
+                await write_counters(User, field, counts, connection)
 
     @staticmethod
     async def validate_password(password: str):
@@ -86,5 +327,19 @@ class User(CreateTimestamp):
                                   "иметь длину от 8 до 128 символов")
 
 
-UserDep = Annotated[User, Depends(User.get_from_token)]
+def password_version(password: str) -> str:
+    """
+    Отпечаток хэша пароля. Меняется вместе с паролем, но не раскрывает сам хэш
+    :param password: хэш пароля
+    :return: отпечаток
+    """
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()[:16]
 
+
+# Снимки авторизованных пользователей
+auth_cache = TTLCache(maxsize=10000, ttl=AUTH_LOCAL_CACHE_TTL)
+# Имена файлов аватарок пользователей
+avatar_cache = TTLCache(maxsize=10000, ttl=30)
+
+UserDep = Annotated[User, Depends(User.get_from_token)]
+OptionalUserDep = Annotated[User | None, Depends(User.get_from_token_optional)]
@@ -0,0 +1,15 @@
+# Модули с моделями, которые регистрируются в tortoise
+MODELS_MODULES = [
+    'models.Comment',
+    'models.CommentLike',
+    'models.Moment',
+    'models.MomentLike',
+    'models.Subscription',
+    'models.Tag',
+    'models.Upload',
+    'models.User',
+    'models.TagMoment',
+    'models.Notification',
+    'models.Timeline',
+    'models.TagTrend',
+]
@@ -3,11 +3,10 @@ import logging
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 import tortoise.exceptions as exs
 from starlette import status
-from tortoise.expressions import Q
 from tortoise.transactions import in_transaction
 
+from misc.pagination import paginate
 from models.Comment import Comment
-from models.CommentLike import CommentLike
 from models.Moment import Moment
 from models.Notification import Notification
 from models.User import UserDep
@@ -33,17 +32,17 @@ async def create_comment(user: UserDep, moment_id: int, text: str, background_ta
                 raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                                     detail="Комментарий под этим моментом уже стоит")
             text, recipients = await Comment.parser(text, connection)
-            comment = await Comment.create(author=user, moment=moment, text=text, using_db=connection)
-            for recipient in recipients:
-                # Отправляем уведомления пользователям, которых упомянули
-                await Notification.send_notification(
-                    user=recipient,
-                    html_text=f"Пользователь <a href=\"/user/{user.id}\">@{user.nickname}</a> упомянул вас в своём "
-                              f"комментарии под <a href=\"/moment/{moment.id}\">моментом</a>",
-                    background=background_tasks,
-                    connection=connection
-                )
+            await Comment.create(author=user, moment=moment, text=text, using_db=connection)
+            # Отправляем уведомления пользователям, которых упомянули
+            await Notification.send_notifications_bulk(
+                users=recipients,
+                html_text=f"Пользователь <a href=\"/user/{user.id}\">@{user.nickname}</a> упомянул вас в своём "
+                          f"комментарии под <a href=\"/moment/{moment.id}\">моментом</a>",
+                background=background_tasks,
+                connection=connection
+            )
             logging.info(f"Пользователь {user.id} оставил комментарий на пост {moment.id}")
+        await Comment.change_count(moment.id, 1)
         return {"status": "success"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такой момент не существует")
@@ -62,31 +61,31 @@ async def delete_comment(user: UserDep, comment_id: int):
         if comment.author != user:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
         await comment.delete()
+        await Comment.change_count(comment.moment_id, -1)
         return {"status": "success", "message": "Комментарий успешно удалён"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такой комментарий не существует")
 
 
 @router.get("/get_comments")
-async def get_moment_comments(user: UserDep, moment_id: int, last_comment: int = 0):
+async def get_moment_comments(user: UserDep, moment_id: int, cursor: str | None = None, limit: int | None = None,
+                              expand: bool = False):
     """
     Возвращает комментарии под моментом
     :param user: пользователь
     :param moment_id: айди момента, под которым хотим получить комментарии
-    :param last_comment: айди последнего полученного комментария
-    :return: комментарии в виде {"comments": [...]}
+    :param cursor: курсор из предыдущего ответа (None == с самого нового комментария)
+    :param limit: размер страницы
+    :param expand: вернуть вместо айди комментариев информацию о них (как в /get_comment, плюс "id")
+    :return: комментарии в виде {"total": ..., "comments": [...], "next_cursor": курсор следующей страницы либо null}
     """
     try:
         moment = await Moment.get(id=moment_id)
-        comments = Comment.filter(moment=moment)
+        page, next_cursor = await paginate(Comment.filter(moment=moment).exclude(author=user), cursor, limit, "id")
         return {
-            "total": await comments.count(),
-            "comments": await (comments
-                               .order_by("-created_at")
-                               .exclude(Q(id__lt=last_comment))
-                               .exclude(author=user)
-                               .limit(10)
-                               .values_list("id", flat=True))
+            "total": await Comment.get_count(moment.id),
+            "comments": await Comment.hydrate(page, user) if expand else page,
+            "next_cursor": next_cursor
         }
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
@@ -100,17 +99,10 @@ async def get_moment_comment(user: UserDep, comment_id: int):
     :param comment_id: айди комментария
     :return: информация в виде {"author": айди_автора, "text": "содержание комментария", "likes": количество_лайков}
     """
-    try:
-        comment = await Comment.get(id=comment_id).prefetch_related("author")
-        return {
-            "author": comment.author.id,
-            "author_nickname": comment.author.nickname,
-            "text": comment.text,
-            "likes": await CommentLike.filter(object=comment).count(),
-            "liked": await CommentLike.filter(author=user, object=comment).exists()
-        }
-    except exs.DoesNotExist:
+    comments = await Comment.hydrate([comment_id], user)
+    if not comments:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return comments[0]
 
 
 @router.get("/my_comment")
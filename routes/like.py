@@ -3,12 +3,14 @@ import logging
 from fastapi import APIRouter, HTTPException
 import tortoise.exceptions as exs
 from starlette import status
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
 
 from models.Comment import Comment
 from models.CommentLike import CommentLike
 from models.Moment import Moment
 from models.MomentLike import MomentLike
-from models.User import UserDep
+from models.User import UserDep, User
 
 router = APIRouter()
 
@@ -16,15 +18,16 @@ router = APIRouter()
 @router.post("/like_moment")
 async def like_moment(user: UserDep, moment_id: int):
     try:
-        moment = await Moment.get(id=moment_id).prefetch_related("author")
-        if moment.author == user:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нельзя ставить лайк себе")
-        # Проверяем, возможно лайк уже поставлен
-        if not await MomentLike.exists(author=user, object=moment):
-            await MomentLike.create(author=user, object=moment)
-        author = moment.author
-        author.rating += 1
-        await author.save()
+        async with in_transaction() as connection:
+            moment = await Moment.get(id=moment_id, using_db=connection)
+            if moment.author_id == user.id:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нельзя ставить лайк себе")
+            # Счётчики меняем, только если лайка ещё не было
+            if await MomentLike.create_or_ignore(author=user, object=moment, using_db=connection):
+                await Moment.filter(id=moment.id).using_db(connection).update(likes_count=F("likes_count") + 1)
+                await User.filter(id=moment.author_id).using_db(connection).update(rating=F("rating") + 1)
+        # Рейтинг автора мог измениться
+        await User.clear_profile_cache(moment.author_id)
         return {"status": "success"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такого момента не существует")
@@ -33,13 +36,14 @@ async def like_moment(user: UserDep, moment_id: int):
 @router.post("/unlike_moment")
 async def unlike_moment(user: UserDep, moment_id: int):
     try:
-        moment = await Moment.get(id=moment_id).prefetch_related("author")
-        # Проверяем, возможно лайк и так не стоит
-        if await MomentLike.exists(author=user, object=moment):
-            await (await MomentLike.get(author=user, object=moment)).delete()
-        author = moment.author
-        author.rating -= 1
-        await author.save()
+        async with in_transaction() as connection:
+            moment = await Moment.get(id=moment_id, using_db=connection)
+            # Счётчики меняем, только если лайк действительно был удалён
+            if await MomentLike.filter(author=user, object=moment).using_db(connection).delete():
+                await Moment.filter(id=moment.id).using_db(connection).update(likes_count=F("likes_count") - 1)
+                await User.filter(id=moment.author_id).using_db(connection).update(rating=F("rating") - 1)
+        # Рейтинг автора мог измениться
+        await User.clear_profile_cache(moment.author_id)
         return {"status": "success"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такого момента не существует")
@@ -48,15 +52,16 @@ async def unlike_moment(user: UserDep, moment_id: int):
 @router.post("/like_comment")
 async def like_comment(user: UserDep, comment_id: int):
     try:
-        comment = await Comment.get(id=comment_id).prefetch_related("author")
-        if comment.author == user:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нельзя ставить лайк себе")
-        # Проверяем, возможно лайк на комментарий уже поставлен
-        if not await CommentLike.exists(author=user, object=comment):
-            await CommentLike.create(author=user, object=comment)
-        author = comment.author
-        author.rating += 1
-        await author.save()
+        async with in_transaction() as connection:
+            comment = await Comment.get(id=comment_id, using_db=connection)
+            if comment.author_id == user.id:
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нельзя ставить лайк себе")
+            # Счётчики меняем, только если лайка ещё не было
+            if await CommentLike.create_or_ignore(author=user, object=comment, using_db=connection):
+                await Comment.filter(id=comment.id).using_db(connection).update(likes_count=F("likes_count") + 1)
+                await User.filter(id=comment.author_id).using_db(connection).update(rating=F("rating") + 1)
+        # Рейтинг автора мог измениться
+        await User.clear_profile_cache(comment.author_id)
         return {"status": "success"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такого комментария не существует")
@@ -65,13 +70,14 @@ async def like_comment(user: UserDep, comment_id: int):
 @router.post("/unlike_comment")
 async def unlike_comment(user: UserDep, comment_id: int):
     try:
-        comment = await Comment.get(id=comment_id).prefetch_related("author")
-        # Проверяем, возможно лайк и так не стоит
-        if await CommentLike.exists(author=user, object=comment):
-            await (await CommentLike.get(author=user, object=comment)).delete()
-        author = comment.author
-        author.rating -= 1
-        await author.save()
+        async with in_transaction() as connection:
+            comment = await Comment.get(id=comment_id, using_db=connection)
+            # Счётчики меняем, только если лайк действительно был удалён
+            if await CommentLike.filter(author=user, object=comment).using_db(connection).delete():
+                await Comment.filter(id=comment.id).using_db(connection).update(likes_count=F("likes_count") - 1)
+                await User.filter(id=comment.author_id).using_db(connection).update(rating=F("rating") - 1)
+        # Рейтинг автора мог измениться
+        await User.clear_profile_cache(comment.author_id)
         return {"status": "success"}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такого комментария не существует")
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+
+from misc.metrics import metrics
+
+router = APIRouter()
+
+
+@router.get("")
+async def get_metrics():
+    """
+    Метрики текущего воркера: счётчики, текущие значения и таймеры (число замеров, суммарное и максимальное время)
+    """
+    return metrics.snapshot()
@@ -1,44 +1,55 @@
 import logging
 
-from fastapi import APIRouter, UploadFile, HTTPException, BackgroundTasks
+from fastapi import APIRouter, UploadFile, HTTPException, BackgroundTasks, Query
 import tortoise.exceptions as exs
 from starlette import status
-from starlette.responses import RedirectResponse
-from tortoise.expressions import Q
+from starlette.requests import Request
 from tortoise.transactions import in_transaction
 
 from handlers.UploadHandler import upload_handler
+from misc.pagination import paginate
+from misc.tokenizer import normalize
 from models.Moment import Moment
-from models.MomentLike import MomentLike
 from models.Notification import Notification
-from models.Subscription import Subscription
-from models.TagMoment import TagMoment
-from models.User import UserDep, User
+from models.Tag import Tag
+from models.TagTrend import TagTrend, trending_tags
+from models.Timeline import Timeline
+from models.User import UserDep, User, OptionalUserDep
+
+try:
+    from config import IMAGE_VARIANTS, SEARCH_MAX_TAGS, AUTOCOMPLETE_LIMIT, TREND_TOP
+except ModuleNotFoundError:
+    from config_example import IMAGE_VARIANTS, SEARCH_MAX_TAGS, AUTOCOMPLETE_LIMIT, TREND_TOP
 
 router = APIRouter()
 
+# Сколько моментов можно запросить через /moment/get_many за раз
+MAX_HYDRATE_MOMENTS = 50
+
 
 @router.post("/create")
 async def moment_create(user: UserDep, file: UploadFile, title: str, description: str,
                         background_tasks: BackgroundTasks):
     try:
-        async with in_transaction() as connection:
-            upload = await upload_handler.upload(file, connection)
-            description, tags, recipients = await Moment.parser(description, connection)
-            moment = await Moment.create(author=user, title=title, description=description, picture=upload,
-                                         using_db=connection)
-            for tag in tags:
-                # Добавляем теги к посту
-                await moment.tags.add(tag, using_db=connection)
-            for recipient in recipients:
+        async with upload_handler.uploading(file) as upload:
+            async with in_transaction() as connection:
+                await upload.save(using_db=connection)
+                description, tags, recipients = await Moment.parser(description, connection)
+                moment = await Moment.create(author=user, title=title, description=description, picture=upload,
+                                             using_db=connection)
+                if tags:
+                    # Добавляем теги к посту одним запросом
+                    await moment.tags.add(*tags, using_db=connection)
                 # Отправляем уведомления пользователям, которых упомянули
-                await Notification.send_notification(
-                    user=recipient,
+                await Notification.send_notifications_bulk(
+                    users=recipients,
                     html_text=f"Пользователь <a href=\"/user/{user.id}\">@{user.nickname}</a> упомянул вас в своём "
                               f"<a href=\"/moment/{moment.id}\">моменте</a>",
                     background=background_tasks,
                     connection=connection
                 )
+        await Timeline.distribute(moment, user, background_tasks)
+        background_tasks.add_task(TagTrend.record, tags)
         logging.info(f"Пользователь {user.id} выложил новый пост {moment.id}")
         return {"status": "success"}
     except exs.IntegrityError as e:
@@ -50,73 +61,102 @@ async def moment_create(user: UserDep, file: UploadFile, title: str, description
 
 
 @router.get("/picture")
-async def get_moment_picture(moment_id: int):
+async def get_moment_picture(request: Request, moment_id: int, size: str = "original"):
+    if size not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неизвестный размер картинки")
     try:
-        moment = await Moment.get(id=moment_id).prefetch_related("picture")
-        return RedirectResponse(upload_handler.download(moment.picture))
+        return await upload_handler.serve(await Moment.get_picture_filename(moment_id, size), request)
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @router.get("/get")
 async def get_moment_info(user: UserDep, moment_id: int):
-    try:
-        moment = await Moment.get(id=moment_id).prefetch_related("tags", "author")
-        # Каждый такой запрос от фронтенда будем считать как один просмотр. При этом пользователь может посмотреть
-        # момент несколько раз - на это ограничений нет (похожим образом сделано, к примеру, в ютубе, хотя,
-        # конечно же, было бы неплохо добавить защиту от накрутки просмотров)
-        moment.views += 1
-        await moment.save()
-        return {
-            "title": moment.title,
-            "description": moment.description,
-            "likes": await MomentLike.filter(object=moment).count(),
-            "views": moment.views,
-            "tags": [tag.name for tag in moment.tags],
-            "author": moment.author.id,
-            "liked": await MomentLike.filter(author=user, object=moment).exists()
-        }
-    except exs.DoesNotExist:
+    moments = await Moment.hydrate([moment_id], user)
+    if not moments:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return moments[0]
+
+
+@router.get("/get_many")
+async def get_moments_info(user: UserDep, moment_ids: list[int] = Query()):
+    """
+    Возвращает информацию сразу о нескольких моментах. Несуществующие моменты пропускаются
+    :param user: пользователь
+    :param moment_ids: айди моментов (не более MAX_HYDRATE_MOMENTS)
+    :return: {"moments": [...]} в том же формате, что и /moment/get
+    """
+    if len(moment_ids) > MAX_HYDRATE_MOMENTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Можно запросить не более {MAX_HYDRATE_MOMENTS} моментов за раз")
+    return {"moments": await Moment.hydrate(moment_ids, user)}
 
 
 @router.get("/user_moments")
-async def user_moments(user_id: int, last_moment: int = 0):
+async def user_moments(client: OptionalUserDep, user_id: int, cursor: str | None = None, limit: int | None = None,
+                       expand: bool = False):
     try:
         user = await User.get(id=user_id)
-        return {
-            "moments": await Moment
-            .filter(author=user)
-            .order_by("-created_at")
-            .exclude(Q(id__lt=last_moment))
-            .limit(10)
-            .values_list("id", flat=True)
-        }
+        moments, next_cursor = await paginate(Moment.filter(author=user), cursor, limit, "id")
+        return {"moments": await Moment.hydrate(moments, client) if expand else moments, "next_cursor": next_cursor}
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @router.get("/feed")
-async def feed(user: UserDep, last_moment: int = 0):
-    subscriptions = await Subscription.filter(subscriber=user).values_list("author_id", flat=True)
-    return {
-        "moments": await Moment
-        .filter(Q(author_id__in=subscriptions))
-        .exclude(Q(id__lt=last_moment))
-        .order_by("-created_at")
-        .limit(10)
-        .values_list("id", flat=True)
-    }
+async def feed(user: UserDep, cursor: str | None = None, limit: int | None = None, expand: bool = False):
+    moments, next_cursor = await Timeline.read(user, cursor, limit)
+    return {"moments": await Moment.hydrate(moments, user) if expand else moments, "next_cursor": next_cursor}
 
 
 @router.get("/search")
-async def search(phrase: str, last_moment: int = 0):
-    possible_user = await User.get_or_none(nickname=phrase)
+async def search(client: OptionalUserDep, phrase: str, match_all: bool = False, order: str = "rank",
+                 cursor: str | None = None, limit: int | None = None, expand: bool = False):
+    """
+    Ищет моменты по тегам
+    :param phrase: теги через пробел, с решёткой или без
+    :param match_all: True - моменты со всеми тегами, False - хотя бы с одним из них
+    :param order: "rank" - по лайкам с поправкой на свежесть, "recent" - от новых к старым
+    :return: {"moments": [...], "next_cursor": ..., "user": айди пользователя, если фраза - его никнейм}
+    """
+    if order not in ("rank", "recent"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неизвестный порядок выдачи")
+    tag_names = list(dict.fromkeys(name for name in map(normalize, phrase.split()) if name))
+    if len(tag_names) > SEARCH_MAX_TAGS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Можно искать не более {SEARCH_MAX_TAGS} тегов за раз")
+    possible_user = None
+    if len(tag_names) == 1 and User.is_valid("nickname", tag_names[0]):
+        possible_user = await User.get_or_none(nickname=tag_names[0])
+    moments, next_cursor = await Moment.search(tag_names, match_all, order, cursor, limit)
     return {
-        "moments": await TagMoment
-        .filter(Q(tag__name=phrase))
-        .exclude(Q(id__lt=last_moment))
-        .limit(10)
-        .values_list("moment_id", flat=True),
+        "moments": await Moment.hydrate(moments, client) if expand else moments,
+        "next_cursor": next_cursor,
         "user": possible_user.id if possible_user is not None else None
     }
+
+
+@router.get("/autocomplete")
+async def autocomplete(prefix: str):
+    """
+    Подсказки при вводе поискового запроса: теги и пользователи, имена которых начинаются с prefix
+    :param prefix: начало имени тега или никнейма (можно с # или @)
+    :return: {"tags": ["имя", ...], "users": [{"id": ..., "nickname": ...}, ...]}
+    """
+    prefix = normalize(prefix)
+    if not prefix:
+        return {"tags": [], "users": []}
+    return {
+        "tags": await Tag.autocomplete(prefix, AUTOCOMPLETE_LIMIT),
+        "users": await User.autocomplete(prefix, AUTOCOMPLETE_LIMIT),
+    }
+
+
+@router.get("/trending_tags")
+async def get_trending_tags(limit: int = 10):
+    """
+    Популярные теги последних часов. Список пересчитывается в фоне, запрос читает только кэш
+    :param limit: сколько тегов вернуть (не больше TREND_TOP)
+    :return: {"tags": [{"name": имя тега, "score": очки}, ...]}
+    """
+    return {"tags": await trending_tags.get(max(1, min(limit, TREND_TOP)))}
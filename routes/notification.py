@@ -1,7 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from starlette import status
 from starlette.requests import Request
-from tortoise.expressions import Q
 
+from misc.metrics import metrics
+from misc.pagination import paginate
 from models.Notification import Notification
 from models.User import UserDep, User
 
@@ -14,10 +16,20 @@ async def connect(request: Request):
     Специальный хэндлер для centrifugo, не предназначен для вызова с фронта. Выдаёт права пользователю
     и отправляет все непрочитанные уведомления
     """
-    # Пользователь подключается к centrifugo, нужно отдать центрифуге айди юзера и все непрочитанные уведомления
-    user_token = (await request.json()).get("data").get("token")
-    user = await User.get_from_token(user_token)
-    notifications = await Notification.get_unread_notifications(user)
+    # Пользователь подключается к centrifugo, нужно отдать центрифуге айди юзера и все непрочитанные уведомления.
+    # После перезапуска centrifugo сюда разом приходят все клиенты, поэтому и пользователь, и уведомления
+    # по возможности берутся из кэша
+    with metrics.timer("notification_connect"):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        data = body.get("data") if isinstance(body, dict) else None
+        token = data.get("token") if isinstance(data, dict) else None
+        if not isinstance(token, str):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        user = await User.get_from_token(token)
+        notifications = await Notification.get_unread_snapshot(user.id)
     return {"result": {"user": str(user.id), "channels": [f"personal_notifications:{user.id}"], "data": notifications}}
 
 
@@ -31,16 +43,23 @@ async def set_read(user: UserDep):
     return {"success": True}
 
 
+@router.get("/unread_count")
+async def unread_count(user: UserDep):
+    """
+    Получить число непрочитанных уведомлений
+    :param user: токен пользователя
+    """
+    return {"count": await Notification.get_unread_count(user)}
+
+
 @router.get("/read")
-async def read(user: UserDep, last_read: int = 0):
+async def read(user: UserDep, cursor: str | None = None, limit: int | None = None):
     """
-    Получить 10 уведомлений, начиная с last_read
-    :param last_read: айди последнего прочитанного уведомления (0 == получить все уведомления, начиная с первого)
+    Получить страницу уведомлений, от новых к старым
+    :param cursor: курсор из предыдущего ответа (None == получить уведомления, начиная с самого нового)
+    :param limit: размер страницы
     :param user: токен пользователя
+    :return: {"notifications": [[айди, текст], ...], "next_cursor": курсор следующей страницы либо null}
     """
-    return await (Notification
-                  .filter(recipient=user)
-                  .order_by("-created_at")
-                  .exclude(Q(id__lt=last_read))
-                  .limit(10)
-                  .values_list("id", "text"))
+    notifications, next_cursor = await paginate(Notification.filter(recipient=user), cursor, limit, "id", "text")
+    return {"notifications": notifications, "next_cursor": next_cursor}
@@ -3,8 +3,11 @@ import logging
 from fastapi import APIRouter, HTTPException
 import tortoise.exceptions as exs
 from starlette import status
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
 
 from models.Subscription import Subscription
+from models.Timeline import Timeline
 from models.User import User, UserDep
 
 router = APIRouter()
@@ -15,13 +18,26 @@ async def subscribe(user: UserDep, author_id: int):
     try:
         if user.id == author_id:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="На себя подписаться нельзя")
-        author = await User.get(id=author_id)
-        # Проверяем, возможно пользователь уже подписан
-        if not await Subscription.exists(author=author, subscriber=user):
-            await Subscription.create(author=author, subscriber=user)
-        logging.info(f"Пользователь {user.id} подписался на {author.id}")
+        async with in_transaction() as connection:
+            # Счётчики меняем, только если подписки ещё не было. Несуществующего автора отсекает внешний ключ
+            created = await Subscription.create_or_ignore(author_id=author_id, subscriber=user, using_db=connection)
+            if created:
+                await (User.filter(id=author_id).using_db(connection)
+                       .update(followers_count=F("followers_count") + 1))
+                await (User.filter(id=user.id).using_db(connection)
+                       .update(subscriptions_count=F("subscriptions_count") + 1))
+                # UPDATE счётчика держит строку автора до коммита, поэтому Timeline.switch_to_pull либо уже выставил
+                # флаг и мы его видим, либо дождётся коммита и сам найдёт эту подписку
+                author = await User.get(id=author_id).using_db(connection)
+                await Timeline.follow(user.id, author, using_db=connection)
+        if created:
+            await User.clear_profile_cache(author_id, user.id)
+        elif not await User.exists(id=author_id):
+            # INSERT IGNORE в MySQL молча пропускает и нарушение внешнего ключа
+            raise exs.DoesNotExist
+        logging.info(f"Пользователь {user.id} подписался на {author_id}")
         return {"status": "success"}
-    except exs.DoesNotExist:
+    except (exs.DoesNotExist, exs.IntegrityError):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Такой автор не существует")
 
 
@@ -29,9 +45,17 @@ async def subscribe(user: UserDep, author_id: int):
 async def unsubscribe(user: UserDep, author_id: int):
     try:
         author = await User.get(id=author_id)
-        # Проверяем, подписан ли пользователь
-        if await Subscription.exists(author=author, subscriber=user):
-            await (await Subscription.get(author=author, subscriber=user)).delete()
+        async with in_transaction() as connection:
+            # Счётчики меняем, только если подписка действительно была удалена
+            deleted = await Subscription.filter(author=author, subscriber=user).using_db(connection).delete()
+            if deleted:
+                await (User.filter(id=author.id).using_db(connection)
+                       .update(followers_count=F("followers_count") - 1))
+                await (User.filter(id=user.id).using_db(connection)
+                       .update(subscriptions_count=F("subscriptions_count") - 1))
+        if deleted:
+            await User.clear_profile_cache(author.id, user.id)
+            await Timeline.unfollow(user.id, author)
         logging.info(f"Пользователь {user.id} отписался от {author.id}")
         return {"status": "success"}
     except exs.DoesNotExist:
@@ -3,14 +3,19 @@ import logging
 from fastapi import APIRouter, UploadFile, HTTPException
 import tortoise.exceptions as exs
 from starlette import status
-from starlette.responses import RedirectResponse
+from starlette.requests import Request
 from tortoise.transactions import in_transaction
 
 from handlers.CentrifugoHandler import get_cent_token
-from handlers.UploadHandler import upload_handler
+from handlers.UploadHandler import upload_handler, DEFAULT_AVATAR
 from models.Subscription import Subscription
 from models.User import User, UserDep
 
+try:
+    from config import IMAGE_VARIANTS
+except ModuleNotFoundError:
+    from config_example import IMAGE_VARIANTS
+
 router = APIRouter()
 
 
@@ -18,7 +23,8 @@ router = APIRouter()
 async def user_register(email: str, nickname: str, password: str):
     try:
         await User.validate_password(password)
-        user = await User.create(email=email.lower(), nickname=nickname.lower(), password=User.crypt_password(password))
+        user = await User.create(email=email.lower(), nickname=nickname.lower(),
+                                 password=await User.crypt_password(password))
         logging.info(f"Зарегистрирован пользователь {user.id}")
         return {"status": "success"}
     except exs.IntegrityError:
@@ -30,14 +36,10 @@ async def user_register(email: str, nickname: str, password: str):
 
 @router.post("/login")
 async def user_login(login: str, password: str):
-    try:
-        user = await User.get_or_none(nickname=login.lower().strip(), password=User.crypt_password(password))
-        if user is None:
-            # Если не нашли по никнейму, то пробуем найти по почте
-            user = await User.get(email=login.lower().strip(), password=User.crypt_password(password))
-        return {"status": "success", "token": user.get_token()}
-    except (exs.DoesNotExist, exs.ValidationError):
+    user = await User.authenticate(login, password)
+    if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return {"status": "success", "token": await user.get_token()}
 
 
 @router.put("/update_info")
@@ -47,7 +49,9 @@ async def user_update_info(user: UserDep, email: str | None, nickname: str | Non
     if nickname is not None:
         user.nickname = nickname.lower().strip()
     try:
-        await user.save()
+        await user.save(update_fields=["email", "nickname"])
+        await user.clear_cache()
+        await User.clear_profile_cache(user.id)
     except exs.IntegrityError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=r"Пользователь с такой почтой и\или никнеймом уже существует")
@@ -60,10 +64,13 @@ async def user_update_info(user: UserDep, email: str | None, nickname: str | Non
 @router.put("/update_avatar")
 async def user_update_avatar(user: UserDep, file: UploadFile):
     try:
-        async with in_transaction() as connection:
-            upload = await upload_handler.upload(file, connection)
-            user.avatar = upload
-            await user.save(using_db=connection)
+        async with upload_handler.uploading(file) as upload:
+            async with in_transaction() as connection:
+                await upload.save(using_db=connection)
+                user.avatar = upload
+                await user.save(update_fields=["avatar_id"], using_db=connection)
+        await user.clear_cache()
+        await user.clear_avatar_cache()
         return {"status": "success"}
     except exs.IntegrityError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Произошла неожиданная ошибка")
@@ -71,61 +78,57 @@ async def user_update_avatar(user: UserDep, file: UploadFile):
 
 @router.put("/update_password")
 async def user_update_password(user: UserDep, current_password: str, new_password: str):
-    if user.password != User.crypt_password(current_password):
+    if not await user.check_password(current_password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверный пароль")
     try:
         await User.validate_password(new_password)
+        user.password = await User.crypt_password(new_password)
+        # !!! Пользователь вылетит, так как его токен станет невалидным!
+        await user.save(update_fields=["password"])
         # Если обновляем пароль, то чистим кэш
         await user.clear_cache()
-        user.password = User.crypt_password(new_password)
-        # !!! Пользователь вылетит, так как его токен станет невалидным!
-        await user.save()
         return {"status": "success"}
     except (exs.IntegrityError, exs.ValidationError):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Новый пароль некорректен")
 
 
 @router.get("/avatar")
-async def get_avatar(user_id: int):
+async def get_avatar(request: Request, user_id: int, size: str = "original"):
+    if size not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неизвестный размер картинки")
     try:
-        user = await User.get(id=user_id).prefetch_related("avatar")
-        if user.avatar is None:
-            # Если аватарки нет, то отображаем стандартную
-            return RedirectResponse(upload_handler.download_default_avatar())
-        return RedirectResponse(upload_handler.download(user.avatar))
+        # Если аватарки нет, то отображаем стандартную. Аватарку можно сменить, поэтому кэшируем ненадолго
+        filename = await User.get_avatar_filename(user_id, size) or DEFAULT_AVATAR
+        return await upload_handler.serve(filename, request, max_age=60)
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @router.get("/my_info")
 async def get_my_info(user: UserDep):
-    return {
-        "id": user.id,
-        "email": user.email,
-        "nickname": user.nickname,
-        "rating": user.rating,
-        "reg_date": user.created_at,
-        "followers": await Subscription.filter(author=user).count(),
-        "subscriptions": await Subscription.filter(subscriber=user).count()
-    }
+    return await User.get_profile(user.id)
 
 
 @router.get("/user_info")
 async def get_info(client: UserDep, user_id: int):
     try:
-        user = await User.get(id=user_id)
         return {
-            "id": user.id,
-            "email": user.email,
-            "nickname": user.nickname,
-            "rating": user.rating,
-            "reg_date": user.created_at,
-            "followers": await Subscription.filter(author=user).count(),
-            "subscriptions": await Subscription.filter(subscriber=user).count(),
-            "subscribed": await Subscription.filter(author=user, subscriber=client).exists()
+            **await User.get_profile(user_id),
+            "subscribed": await Subscription.exists(author_id=user_id, subscriber=client)
         }
     except exs.DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
+@router.get("/cent_token")
+async def cent_token(user: UserDep):
+    """
+    Получить токен для подключения к centrifugo
+    :param user: токен пользователя
+    :return: {"cent_token": токен}
+    """
+    return await get_cent_token(user.id)
+
+
 # TODO: Добавить возможность авторизации через SSO
+
@@ -0,0 +1,41 @@
+"""
+Общие фикстуры тестов. Тесты не требуют внешних сервисов: кэш живёт в памяти процесса, БД - SQLite в памяти.
+Запуск из корня репозитория: python -m pytest
+"""
+import os
+from collections import OrderedDict
+
+# Переменные окружения читаются config_example при импорте, поэтому выставляются до импорта модулей приложения
+os.environ.setdefault("CACHE_BACKEND", "memory")
+# config_example читает centrifugo.json относительно рабочего каталога
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from tortoise import Tortoise  # noqa: E402
+
+from handlers.CacheHandler import cache  # noqa: E402
+from handlers.CentrifugoHandler import cent_token_cache  # noqa: E402
+from migrations import migrate  # noqa: E402
+from models import MODELS_MODULES  # noqa: E402
+from models.Moment import picture_cache  # noqa: E402
+from models.TagTrend import trending_cache  # noqa: E402
+from models.User import auth_cache, avatar_cache  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(monkeypatch):
+    """
+    Чистая БД, собранная миграциями, как в production, и пустые кэши: айди в новой БД снова начинаются с 1
+    """
+    monkeypatch.setattr(cache, "_data", {})
+    for local_cache in (auth_cache, avatar_cache, picture_cache, trending_cache, cent_token_cache):
+        monkeypatch.setattr(local_cache, "_data", OrderedDict())
+    await Tortoise.init(db_url="sqlite://:memory:", modules={"models": MODELS_MODULES})
+    await migrate()
+    yield
+    await Tortoise.close_connections()
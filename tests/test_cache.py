@@ -0,0 +1,54 @@
+"""
+MemcachedBackend: медленный ответ сервера не должен достаться следующей команде на том же соединении
+"""
+import asyncio
+
+import pytest
+
+from handlers.CacheHandler import MemcachedBackend
+
+TIMEOUT = 0.1
+# Сколько сервер думает над ключом slow, в секундах
+STALL = 0.3
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Отвечает на get/gets значением value-<ключ>, на ключ slow - с задержкой
+    """
+    try:
+        while line := await reader.readline():
+            keys = line.split()[1:]
+            if b"slow" in keys:
+                await asyncio.sleep(STALL)
+            for key in keys:
+                value = b"value-" + key
+                writer.write(b"VALUE %s 0 %d 1\r\n%s\r\n" % (key, len(value), value))
+            writer.write(b"END\r\n")
+            await writer.drain()
+    except ConnectionError:
+        # Клиент закрыл соединение, не дождавшись ответа
+        pass
+    writer.close()
+
+
+@pytest.fixture
+async def memcached():
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    async with server:
+        yield server.sockets[0].getsockname()[1]
+
+
+@pytest.mark.anyio
+async def test_timed_out_reply_is_not_read_by_next_command(memcached):
+    cache = MemcachedBackend([("127.0.0.1", memcached)], pool_size=1, timeout=TIMEOUT, retry_after=0)
+    try:
+        assert await cache.get("a") == "value-a"
+        # Сервер не успел ответить: кэш ведёт себя как пустой
+        assert await cache.get("slow") is None
+        # Запоздалый ответ приходит, пока соединение свободно
+        await asyncio.sleep(STALL)
+        assert await cache.get("b") == "value-b"
+        assert await cache.get_many(["c", "d"]) == {"c": "value-c", "d": "value-d"}
+    finally:
+        await cache.close()
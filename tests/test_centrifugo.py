@@ -0,0 +1,103 @@
+"""
+NotificationDispatcher: команды уходят в centrifugo пачками, одинаковые публикации склеиваются в broadcast
+"""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from handlers.CentrifugoHandler import NotificationDispatcher
+
+# Сколько отвечает centrifugo на один запрос, в секундах
+REQUEST_DELAY = 0.05
+
+
+class FakeCentrifugo:
+    def __init__(self, statuses: list[int] | None = None):
+        self.statuses = statuses or []
+        self.requests: list[list[dict]] = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(REQUEST_DELAY)
+        commands = [json.loads(line) for line in request.content.decode().splitlines()]
+        self.requests.append(commands)
+        status = self.statuses.pop(0) if self.statuses else 200
+        return httpx.Response(status, text="\n".join("{}" for _ in commands))
+
+    @property
+    def commands(self) -> list[dict]:
+        return [command for commands in self.requests for command in commands]
+
+
+def make_dispatcher(centrifugo: FakeCentrifugo, batch_size: int = 100) -> NotificationDispatcher:
+    dispatcher = NotificationDispatcher("http://centrifugo/api", "key", 10000, batch_size, 2, 5,
+                                        transport=httpx.MockTransport(centrifugo.handle))
+    dispatcher.start()
+    return dispatcher
+
+
+@pytest.mark.anyio
+async def test_same_payload_is_broadcast_in_one_request():
+    centrifugo = FakeCentrifugo()
+    dispatcher = make_dispatcher(centrifugo)
+    for user_id in range(50):
+        dispatcher.publish(f"personal_notifications:{user_id}", {"type": "new_moment", "moment_id": 1})
+    dispatcher.history_remove("personal_notifications:1")
+    await dispatcher.close()
+
+    assert len(centrifugo.requests) == 1
+    broadcast, history_remove = centrifugo.requests[0]
+    assert broadcast["method"] == "broadcast"
+    assert broadcast["params"]["channels"] == [f"personal_notifications:{user_id}" for user_id in range(50)]
+    assert history_remove == {"method": "history_remove", "params": {"channel": "personal_notifications:1"}}
+
+
+def test_history_remove_is_not_reordered():
+    def publish(user_id: int, moment_id: int) -> dict:
+        return {"method": "publish", "params": {"channel": f"personal_notifications:{user_id}",
+                                                "data": {"type": "new_moment", "moment_id": moment_id}}}
+
+    history_remove = {"method": "history_remove", "params": {"channel": "personal_notifications:1"}}
+    commands = NotificationDispatcher.coalesce([publish(1, 1), publish(2, 1), history_remove, publish(3, 1),
+                                                publish(1, 2), publish(1, 1)])
+    # Публикация в канал 1 после очистки его истории остаётся после неё, а не склеивается с первой.
+    # Повторная публикация в канал 1 не обгоняет предыдущую публикацию в него
+    assert commands == [
+        {"method": "broadcast", "params": {"channels": ["personal_notifications:1", "personal_notifications:2"],
+                                           "data": {"type": "new_moment", "moment_id": 1}}},
+        history_remove,
+        publish(3, 1),
+        publish(1, 2),
+        publish(1, 1),
+    ]
+
+
+@pytest.mark.anyio
+async def test_commands_are_batched():
+    centrifugo = FakeCentrifugo()
+    dispatcher = make_dispatcher(centrifugo, batch_size=100)
+    publishes = 1000
+    started = time.perf_counter()
+    for user_id in range(publishes):
+        dispatcher.publish(f"personal_notifications:{user_id}", {"type": "new_comment", "comment_id": user_id})
+    await dispatcher.close()
+    elapsed = time.perf_counter() - started
+
+    assert len(centrifugo.requests) == publishes // 100
+    assert [command["params"]["channel"] for command in centrifugo.commands] == \
+           [f"personal_notifications:{user_id}" for user_id in range(publishes)]
+    # По запросу на публикацию это заняло бы publishes * REQUEST_DELAY
+    assert elapsed < publishes * REQUEST_DELAY / 10
+
+
+@pytest.mark.anyio
+async def test_server_errors_are_retried():
+    centrifugo = FakeCentrifugo(statuses=[500, 503])
+    dispatcher = make_dispatcher(centrifugo)
+    dispatcher.publish("personal_notifications:1", {"type": "new_moment", "moment_id": 1})
+    await dispatcher.close()
+
+    assert len(centrifugo.requests) == 3
+    assert centrifugo.requests[0] == centrifugo.requests[-1]
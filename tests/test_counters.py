@@ -0,0 +1,51 @@
+"""
+CounterBuffer: приращения не теряются, даже если приложение останавливается посреди сброса
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from tortoise.transactions import in_transaction
+
+from handlers import CounterHandler
+from handlers.CounterHandler import CounterBuffer
+from models.User import User
+
+
+@pytest.mark.anyio
+async def test_close_during_flush_keeps_increments(db, monkeypatch):
+    user = await User.create(email="user@example.com", nickname="user", password="password")
+    flushing = asyncio.Event()
+
+    @asynccontextmanager
+    async def slow_transaction():
+        async with in_transaction() as connection:
+            yield connection
+            # Изменения уже отправлены, но транзакция ещё не зафиксирована
+            flushing.set()
+            await asyncio.sleep(1)
+
+    monkeypatch.setattr(CounterHandler, "in_transaction", slow_transaction)
+    buffer = CounterBuffer(User, "rating", flush_interval=0.01, max_buffer=1000)
+    buffer.start()
+    buffer.hit([user.id], 5)
+    await flushing.wait()
+    # Периодический сброс сейчас внутри транзакции
+    monkeypatch.setattr(CounterHandler, "in_transaction", in_transaction)
+    await buffer.close()
+
+    await user.refresh_from_db()
+    assert user.rating == 5
+    assert buffer.pending(user.id) == 0
+
+
+@pytest.mark.anyio
+async def test_close_waits_for_background_flush(db):
+    users = [await User.create(email=f"user{i}@example.com", nickname=f"user{i}", password="password")
+             for i in range(3)]
+    buffer = CounterBuffer(User, "rating", flush_interval=3600, max_buffer=2)
+    buffer.start()
+    # Буфер переполнен: сброс запускается в фоне
+    buffer.hit([user.id for user in users])
+    await buffer.close()
+    assert await User.filter(rating=1).count() == len(users)
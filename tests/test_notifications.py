@@ -0,0 +1,61 @@
+"""
+Кэш непрочитанных уведомлений: значение, посчитанное по БД до записи, не должно остаться в кэше после неё
+"""
+import pytest
+
+from handlers.CacheHandler import cache
+from models.Notification import Notification
+from models.User import User
+
+
+@pytest.fixture
+async def user(db):
+    return await User.create(email="user@example.com", nickname="user", password="password")
+
+
+def race_before_caching(monkeypatch, write):
+    """
+    Выполняет write (один раз) между чтением непрочитанных из БД и сохранением результата в кэш
+    """
+    original_set = cache.set
+    raced = False
+
+    async def set_after_write(key: str, value: str, expire: int = 0):
+        nonlocal raced
+        if key.startswith(("unread_notifications:", "unread_payload:")) and not raced:
+            raced = True
+            await write()
+        await original_set(key, value, expire)
+
+    monkeypatch.setattr(cache, "set", set_after_write)
+
+
+async def send(user: User, text: str):
+    await Notification.create(text=text, recipient=user)
+    # То же, что делает фоновая задача send_notifications_bulk после коммита
+    await Notification.update_unread_cache([user.id])
+
+
+@pytest.mark.anyio
+async def test_count_sees_notification_sent_during_load(user, monkeypatch):
+    await send(user, "first")
+    race_before_caching(monkeypatch, lambda: send(user, "second"))
+    assert await Notification.get_unread_count(user) == 1
+    assert await Notification.get_unread_count(user) == 2
+
+
+@pytest.mark.anyio
+async def test_snapshot_sees_notification_sent_during_load(user, monkeypatch):
+    await send(user, "first")
+    race_before_caching(monkeypatch, lambda: send(user, "second"))
+    assert await Notification.get_unread_snapshot(user.id) == [["first"]]
+    assert await Notification.get_unread_snapshot(user.id) == [["second"], ["first"]]
+
+
+@pytest.mark.anyio
+async def test_count_sees_read_all_during_load(user, monkeypatch):
+    await send(user, "first")
+    race_before_caching(monkeypatch, lambda: Notification.set_read_all(user))
+    assert await Notification.get_unread_count(user) == 1
+    assert await Notification.get_unread_count(user) == 0
+    assert await Notification.get_unread_snapshot(user.id) == []
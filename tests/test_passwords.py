@@ -0,0 +1,129 @@
+"""
+PasswordHasher: PBKDF2 считается вне event loop, лишние попытки входа отбрасываются, у каждого хэша своя соль
+"""
+import asyncio
+import time
+
+import pytest
+
+from misc.concurrency import Overloaded
+from misc.metrics import metrics
+from misc.secure import PasswordHasher
+
+ROUNDS = 20000
+# Для замера задержек хэш должен быть заметно дольше шага планировщика
+SLOW_ROUNDS = 200000
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(ROUNDS, max_workers=2, max_pending=1000)
+    yield hasher
+    hasher.close()
+
+
+def p99(samples: list[float]) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+@pytest.fixture
+def slow_hasher():
+    hasher = PasswordHasher(SLOW_ROUNDS, max_workers=2, max_pending=8)
+    yield hasher
+    hasher.close()
+
+
+def hash_time(hasher: PasswordHasher) -> tuple[str, float]:
+    """
+    :return: (хэш пароля password, сколько секунд занимает одно хэширование)
+    """
+    started = time.perf_counter()
+    hashed = hasher.context.hash("password")
+    return hashed, time.perf_counter() - started
+
+
+@pytest.mark.anyio
+async def test_hashing_does_not_block_event_loop(slow_hasher):
+    hashed, single = hash_time(slow_hasher)
+
+    # Пока идут входы, другие запросы (здесь - короткие sleep) должны обслуживаться без задержки
+    latencies = []
+    stop = asyncio.Event()
+
+    async def other_requests():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            latencies.append(time.perf_counter() - started - 0.005)
+
+    probe = asyncio.create_task(other_requests())
+    try:
+        results = await asyncio.gather(*(slow_hasher.verify("password", hashed) for _ in range(8)))
+    finally:
+        stop.set()
+    await probe
+
+    assert all(ok for ok, _ in results)
+    # Если бы PBKDF2 считался в event loop, задержка доходила бы до времени хэша и больше
+    assert p99(latencies) < single / 2
+
+
+@pytest.mark.anyio
+async def test_login_latency_is_bounded_during_burst(slow_hasher):
+    hashed, single = hash_time(slow_hasher)
+    max_pending = slow_hasher.limiter.max_pending
+
+    async def login() -> tuple[bool, float]:
+        started = time.perf_counter()
+        try:
+            await slow_hasher.verify("password", hashed)
+            accepted = True
+        except Overloaded:
+            accepted = False
+        return accepted, time.perf_counter() - started
+
+    # Всплеск входов в несколько раз больше, чем помещается в очередь
+    results = await asyncio.gather(*(login() for _ in range(max_pending * 5)))
+    accepted = [latency for ok, latency in results if ok]
+    rejected = [latency for ok, latency in results if not ok]
+
+    assert len(accepted) == max_pending
+    # Принятый вход ждёт не больше max_pending хэширований, даже если все они идут на одном ядре.
+    # Без ограничения очереди последний вход ждал бы все max_pending * 5
+    assert p99(accepted) < max_pending * single * 1.5
+    # Отказ приходит сразу, не дожидаясь хэширования
+    assert max(rejected) < single / 2
+
+
+@pytest.mark.anyio
+async def test_overloaded_requests_are_rejected():
+    hasher = PasswordHasher(ROUNDS, max_workers=1, max_pending=2)
+    rejected = metrics.counters.get("password_hash.rejected", 0)
+    try:
+        results = await asyncio.gather(*(hasher.hash("password") for _ in range(10)), return_exceptions=True)
+    finally:
+        hasher.close()
+    assert sum(isinstance(result, Overloaded) for result in results) == 8
+    assert sum(isinstance(result, str) for result in results) == 2
+    assert metrics.counters["password_hash.rejected"] - rejected == 8
+
+
+@pytest.mark.anyio
+async def test_each_hash_has_own_salt(hasher):
+    first, second = await hasher.hash("password"), await hasher.hash("password")
+    assert first != second
+    assert await hasher.verify("password", first) == (True, None)
+    assert await hasher.verify("wrong", second) == (False, None)
+
+
+@pytest.mark.anyio
+async def test_weaker_hash_is_upgraded(hasher):
+    weaker = PasswordHasher(ROUNDS // 2, max_workers=1, max_pending=1)
+    try:
+        hashed = await weaker.hash("password")
+    finally:
+        weaker.close()
+    ok, upgraded = await hasher.verify("password", hashed)
+    assert ok and upgraded is not None
+    assert hasher.context.from_string(upgraded).rounds == ROUNDS
@@ -0,0 +1,11 @@
+"""
+Запросы роутов должны использовать индексы на схеме, которую создают миграции
+"""
+import pytest
+
+from manage import find_full_scans
+
+
+@pytest.mark.anyio
+async def test_queries_use_indexes(db):
+    assert await find_full_scans() == []
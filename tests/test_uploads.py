@@ -0,0 +1,160 @@
+"""
+Передачи в S3 не должны останавливать event loop, а режим proxy отдаёт файлы из кэша на диске с поддержкой Range.
+S3 подменяется клиентом в памяти, который, как и boto3, блокирует поток на время каждой передачи
+"""
+import asyncio
+import io
+import time
+
+import boto3
+import httpx
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import FastAPI, Request, UploadFile
+from tortoise.exceptions import IntegrityError
+
+from config_example import IMAGE_VARIANTS, S3_MAX_WORKERS
+from misc.filecache import DiskCache
+from misc.metrics import metrics
+
+# Сколько длится одна передача в S3, в секундах
+S3_DELAY = 0.2
+UPLOADS = 8
+
+
+class SlowS3:
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+
+    def put_bucket_cors(self, **kwargs):
+        pass
+
+    def head_object(self, **kwargs):
+        return {}
+
+    def upload_file(self, path: str, bucket: str, key: str):
+        time.sleep(S3_DELAY)
+        with open(path, "rb") as file:
+            self.objects[key] = file.read()
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key]), "ContentLength": len(self.objects[Key])}
+
+    def delete_object(self, Bucket: str, Key: str):
+        self.objects.pop(Key, None)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = SlowS3()
+    monkeypatch.setattr(boto3.session.Session, "client", lambda self, *args, **kwargs: client)
+    return client
+
+
+@pytest.fixture
+def upload_handler(s3):
+    from handlers.UploadHandler import UploadHandler
+    handler = UploadHandler()
+    yield handler
+    handler.close()
+
+
+async def worst_loop_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """
+    Насколько позже положенного просыпается корутина, пока не выставлен stop
+    :return: наибольшее опоздание в секундах
+    """
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+@pytest.mark.anyio
+async def test_concurrent_uploads_keep_event_loop_responsive(db, s3, upload_handler):
+    with open("assets/avatar.jpg", "rb") as file:
+        picture = file.read()
+
+    async def upload():
+        async with upload_handler.uploading(UploadFile(io.BytesIO(picture), filename="picture.jpg")) as result:
+            return result
+
+    stop = asyncio.Event()
+    lag = asyncio.create_task(worst_loop_lag(stop))
+    started = time.perf_counter()
+    uploads = await asyncio.gather(*(upload() for _ in range(UPLOADS)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    lag = await lag
+
+    transfers = UPLOADS * len(IMAGE_VARIANTS)
+    assert all(filename in s3.objects for upload in uploads for filename in upload.filenames().values())
+    # Передачи идут одновременно в пуле из S3_MAX_WORKERS потоков, а не одна за другой
+    assert elapsed < transfers * S3_DELAY / min(S3_MAX_WORKERS, transfers) * 2
+    # Пока идут передачи, event loop продолжает обслуживать другие корутины
+    assert lag < S3_DELAY / 2
+
+
+@pytest.mark.anyio
+async def test_broken_pictures_are_rejected(s3, upload_handler):
+    with open("assets/avatar.jpg", "rb") as file:
+        picture = file.read()
+    # Не картинка и обрезанная картинка отбрасываются при пережатии в пуле процессов
+    for content in (b"not a picture", picture[:len(picture) // 2]):
+        with pytest.raises(IntegrityError):
+            async with upload_handler.uploading(UploadFile(io.BytesIO(content), filename="picture.jpg")):
+                pass
+    assert not s3.objects
+
+
+@pytest.fixture
+async def proxy(upload_handler, tmp_path):
+    upload_handler.disk_cache = DiskCache(str(tmp_path), 1024 ** 2)
+    app = FastAPI()
+
+    @app.get("/files/{filename}")
+    async def get_file(filename: str, request: Request):
+        return await upload_handler.serve(filename, request)
+
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        yield client
+
+
+@pytest.mark.anyio
+async def test_proxy_serves_cached_file_with_ranges(s3, proxy):
+    content = bytes(range(100))
+    s3.objects["picture.jpg"] = content
+
+    # Первый запрос скачивает файл из S3 и кладёт его в кэш, дальше файл читается с диска
+    response = await proxy.get("/files/picture.jpg")
+    assert response.status_code == 200 and response.content == content
+    hits = metrics.counters.get("image_cache.hit", 0)
+    response = await proxy.get("/files/picture.jpg")
+    assert response.status_code == 200 and response.content == content
+    assert metrics.counters["image_cache.hit"] == hits + 1
+
+    response = await proxy.get("/files/picture.jpg", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206 and response.content == content[10:20]
+    assert response.headers["Content-Range"] == "bytes 10-19/100"
+    response = await proxy.get("/files/picture.jpg", headers={"Range": "bytes=-10"})
+    assert response.status_code == 206 and response.content == content[-10:]
+    # Неверный диапазон игнорируется, а невыполнимый даёт 416
+    for invalid in ("bytes=20-10", "bytes=abc", "items=0-10"):
+        response = await proxy.get("/files/picture.jpg", headers={"Range": invalid})
+        assert response.status_code == 200 and response.content == content
+    response = await proxy.get("/files/picture.jpg", headers={"Range": "bytes=100-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+
+@pytest.mark.anyio
+async def test_proxy_missing_file(proxy):
+    response = await proxy.get("/files/missing.jpg")
+    assert response.status_code == 404
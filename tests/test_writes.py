@@ -0,0 +1,164 @@
+"""
+Лайки и подписки: повторные и одновременные запросы не должны расходиться счётчики с числом строк
+"""
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from tortoise.transactions import in_transaction
+
+from models.Comment import Comment
+from models.CommentLike import CommentLike
+from models.Moment import Moment
+from models.MomentLike import MomentLike
+from models.Subscription import Subscription
+from models.Timeline import Timeline, TimelinePull
+from models.Upload import Upload
+from models.User import User
+from routes import like, subscription
+
+app = FastAPI()
+app.include_router(like.router)
+app.include_router(subscription.router)
+
+USERS = 10
+REPEATS = 5
+
+
+@pytest.fixture
+async def client(db):
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        yield client
+
+
+async def create_users(count: int) -> list[tuple[User, str]]:
+    users = []
+    for i in range(count):
+        user = await User.create(email=f"user{i}@example.com", nickname=f"user{i}", password="password")
+        users.append((user, await user.get_token()))
+    return users
+
+
+async def create_moment(author: User) -> Moment:
+    picture = await Upload.create(filename="picture.jpg")
+    return await Moment.create(author=author, title="title", description="description", picture=picture)
+
+
+@pytest.mark.anyio
+async def test_create_or_ignore(db):
+    author, subscriber = (user for user, _ in await create_users(2))
+    assert await Subscription.create_or_ignore(author=author, subscriber=subscriber)
+    assert not await Subscription.create_or_ignore(author=author, subscriber=subscriber)
+    subscriptions = await Subscription.filter(author=author, subscriber=subscriber)
+    assert len(subscriptions) == 1
+    assert subscriptions[0].created_at is not None
+
+    # Внутри транзакции вставка видна только после фиксации и откатывается вместе с ней
+    with pytest.raises(RuntimeError):
+        async with in_transaction() as connection:
+            assert await Subscription.create_or_ignore(author=subscriber, subscriber=author, using_db=connection)
+            assert not await Subscription.create_or_ignore(author=subscriber, subscriber=author, using_db=connection)
+            raise RuntimeError
+    assert not await Subscription.exists(author=subscriber, subscriber=author)
+
+
+@pytest.mark.anyio
+async def test_parallel_subscriptions(client):
+    (author, _), *subscribers = await create_users(USERS)
+
+    async def subscribe(token: str):
+        response = await client.post("/subscribe", params={"token": token, "author_id": author.id})
+        assert response.status_code == 200
+
+    # Каждый подписывается несколько раз одновременно
+    await asyncio.gather(*(subscribe(token) for _, token in subscribers for _ in range(REPEATS)))
+    await author.refresh_from_db()
+    assert author.followers_count == await Subscription.filter(author=author).count() == USERS - 1
+    for subscriber, _ in subscribers:
+        await subscriber.refresh_from_db()
+        assert subscriber.subscriptions_count == 1
+
+    async def unsubscribe(token: str):
+        response = await client.post("/unsubscribe", params={"token": token, "author_id": author.id})
+        assert response.status_code == 200
+
+    # Подписки и отписки вперемешку
+    await asyncio.gather(*(action(token) for _, token in subscribers for action in (unsubscribe, subscribe) * 2))
+    await author.refresh_from_db()
+    assert author.followers_count == await Subscription.filter(author=author).count()
+    for subscriber, _ in subscribers:
+        await subscriber.refresh_from_db()
+        assert subscriber.subscriptions_count == await Subscription.filter(subscriber=subscriber).count()
+
+    response = await client.post("/subscribe", params={"token": subscribers[0][1], "author_id": author.id + USERS})
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_subscribe_during_switch_to_pull(client, monkeypatch):
+    (author, _), (subscriber, token) = await create_users(2)
+    await create_moment(author)
+    create_or_ignore = Subscription.create_or_ignore
+
+    async def switch_before_insert(**kwargs):
+        # Автор переходит на подмешивание при чтении после того, как роут прочитал его, но до вставки подписки:
+        # switch_to_pull уже прошёл по подпискам и эту не увидел
+        await Timeline.switch_to_pull(author)
+        return await create_or_ignore(**kwargs)
+
+    monkeypatch.setattr(Subscription, "create_or_ignore", switch_before_insert)
+    response = await client.post("/subscribe", params={"token": token, "author_id": author.id})
+    assert response.status_code == 200
+    assert await TimelinePull.exists(owner=subscriber, author=author)
+    assert len((await Timeline.read(subscriber))[0]) == 1
+
+
+@pytest.mark.anyio
+async def test_rebuild_returns_small_authors_to_push(db):
+    author, subscriber = (user for user, _ in await create_users(2))
+    moment = await create_moment(author)
+    await Subscription.create(author=author, subscriber=subscriber)
+    await Timeline.switch_to_pull(author)
+
+    # Подписчиков меньше FEED_FANOUT_PULL_THRESHOLD, поэтому пересборка возвращает раскладку при записи
+    await Timeline.rebuild_all()
+    await author.refresh_from_db()
+    assert not author.fanout_on_read
+    assert not await TimelinePull.exists(author=author)
+    assert await Timeline.read(subscriber) == ([moment.id], None)
+
+
+@pytest.mark.anyio
+async def test_parallel_likes(client):
+    (author, _), *likers = await create_users(USERS)
+    moment = await create_moment(author)
+    comment = await Comment.create(author=author, moment=moment, text="comment")
+
+    async def request(path: str, token: str, **params):
+        response = await client.post(path, params={"token": token, **params})
+        assert response.status_code == 200
+
+    await asyncio.gather(*(request(path, token, **params)
+                           for _, token in likers for _ in range(REPEATS)
+                           for path, params in (("/like_moment", {"moment_id": moment.id}),
+                                                ("/like_comment", {"comment_id": comment.id}))))
+    await moment.refresh_from_db()
+    await comment.refresh_from_db()
+    await author.refresh_from_db()
+    assert moment.likes_count == await MomentLike.filter(object=moment).count() == USERS - 1
+    assert comment.likes_count == await CommentLike.filter(object=comment).count() == USERS - 1
+    assert author.rating == 2 * (USERS - 1)
+
+    # Лайки и снятия лайков вперемешку
+    await asyncio.gather(*(request(path, token, **params)
+                           for _, token in likers for _ in range(REPEATS)
+                           for path, params in (("/unlike_moment", {"moment_id": moment.id}),
+                                                ("/like_moment", {"moment_id": moment.id}),
+                                                ("/unlike_comment", {"comment_id": comment.id}))))
+    await moment.refresh_from_db()
+    await comment.refresh_from_db()
+    await author.refresh_from_db()
+    assert moment.likes_count == await MomentLike.filter(object=moment).count()
+    assert comment.likes_count == await CommentLike.filter(object=comment).count() == 0
+    assert author.rating == moment.likes_count + comment.likes_count